@@ -0,0 +1,164 @@
+"""
+Opt-in compiled execution of the stepwise forward of the kinetic models.
+"""
+import warnings
+import torch
+import torch.nn as nn
+from kinetic.custom_modules import RingBuffer
+
+BACKENDS = ('compile', 'trace', 'eager')
+
+def flatten_hs(hs, mode='single'):
+    """
+    Splits a hidden state into a tuple of tensors and the index of the most
+    recent ring buffer entry (None unless mode is 'multiple').
+
+    hs - hidden state as obtained through kinetic.utils.get_hs
+    mode - str
+        'single', 'multiple' or 'double'
+    """
+    if mode == 'single':
+        return (hs,), None
+    elif mode == 'double':
+        return tuple(hs), None
+    elif mode == 'multiple':
+        return (hs[0], hs[1].data), hs[1].idx
+    raise Exception('Invalid mode')
+
+def unflatten_hs(states, idx=None, mode='single'):
+    """
+    Inverse of flatten_hs
+    """
+    if mode == 'single':
+        return states[0]
+    elif mode == 'double':
+        return tuple(states)
+    elif mode == 'multiple':
+        return [states[0], RingBuffer(states[1], idx)]
+    raise Exception('Invalid mode')
+
+class StepFunction(nn.Module):
+    '''
+    Runs one step of a kinetic model with the hidden state as explicit tensor
+    arguments. The ring buffer index of the 'multiple' mode is fixed at
+    construction, so one StepFunction is needed for each index.
+    '''
+    def __init__(self, model, mode='single', idx=None):
+        super().__init__()
+        self.model = model
+        self.mode = mode
+        self.idx = idx
+
+    def forward(self, x, *states):
+        hs = unflatten_hs(states, self.idx, self.mode)
+        out, hs = self.model(x, hs)
+        states, _ = flatten_hs(hs, self.mode)
+        return (out,) + tuple(states)
+
+class CompiledModel:
+    '''
+    Compiled inference for the models in kinetic/models.py. Calls have the
+    same signature as the model, (x, hs) -> (out, hs), and run without gradients.
+
+    A step function is compiled the first time an input and state shape is seen.
+    It is run a few times on that input and checked against the eager model, then
+    cached. If a backend fails to compile or does not match the eager outputs, the
+    next one in BACKENDS is used. The eager model is the final fallback.
+
+    Forward hooks registered on the model's submodules are not guaranteed to
+    be called. Put the model in the desired mode before the first call; the
+    cache is not invalidated by model.train() or model.eval().
+    '''
+    def __init__(self, model, hs_mode='single', backend='compile', n_warmup=2, atol=1e-5, verbose=False):
+        """
+        model - torch Module
+            one of the models in kinetic/models.py
+        hs_mode - str
+            the hidden state mode used with the model. 'single', 'multiple' or 'double'
+        backend - str
+            the first backend to try. 'compile' uses torch.compile, 'trace' uses
+            torch.jit.trace and 'eager' runs the model as is. Tracing records
+            the python control flow (i.e. the hidden state mode branches) of the
+            step being traced, which is fixed for each cached step function
+        n_warmup - int
+            number of steps run with each newly compiled step function
+        atol - float
+            largest absolute difference to the eager outputs accepted during warm up
+        """
+        assert backend in BACKENDS
+        self.model = model
+        self.hs_mode = hs_mode
+        self.backends = BACKENDS[BACKENDS.index(backend):]
+        self.n_warmup = n_warmup
+        self.atol = atol
+        self.verbose = verbose
+        self.cache = dict()
+
+    def __call__(self, x, hs):
+        states, idx = flatten_hs(hs, self.hs_mode)
+        key = (tuple(x.shape), x.dtype, str(x.device), tuple(tuple(s.shape) for s in states))
+        if key not in self.cache:
+            self.cache[key] = self.warm_up(x, states)
+        backend, steps = self.cache[key]
+        with torch.no_grad():
+            outs = steps[idx](x, *states)
+        if idx is not None:
+            idx = (idx+1) % states[1].shape[1]
+        return outs[0], unflatten_hs(outs[1:], idx, self.hs_mode)
+
+    @property
+    def backend(self):
+        """
+        The backend used for the most recently cached shape. None before the first call.
+        """
+        if len(self.cache) == 0:
+            return None
+        return list(self.cache.values())[-1][0]
+
+    def warm_up(self, x, states):
+        """
+        Compiles and checks a step function for every ring buffer index using the
+        first backend that succeeds.
+
+        returns the backend name and a dict of step functions keyed by ring buffer index
+        """
+        idxs = [None]
+        if self.hs_mode == 'multiple':
+            idxs = list(range(states[1].shape[1]))
+        for backend in self.backends:
+            try:
+                steps = {idx: self.build(backend, x, states, idx) for idx in idxs}
+                if backend != 'eager':
+                    for idx in idxs:
+                        self.check(steps[idx], idx, x, states)
+                if self.verbose:
+                    print("Using {} backend for input shape {}".format(backend, tuple(x.shape)))
+                return backend, steps
+            except Exception as e:
+                warnings.warn("{} backend failed, falling back: {}".format(backend, e))
+        raise Exception('No backend succeeded')
+
+    def build(self, backend, x, states, idx):
+        step = StepFunction(self.model, self.hs_mode, idx)
+        if backend == 'compile':
+            return torch.compile(step, dynamic=False)
+        elif backend == 'trace':
+            # The ring buffer index is a constant of each step function
+            with torch.no_grad(), warnings.catch_warnings():
+                warnings.simplefilter('ignore', torch.jit.TracerWarning)
+                return torch.jit.trace(step, (x, *[s.clone() for s in states]), check_trace=False)
+        return step
+
+    def check(self, step, idx, x, states):
+        """
+        Runs the step function n_warmup times and compares it against the eager model.
+        """
+        eager = StepFunction(self.model, self.hs_mode, idx)
+        with torch.no_grad():
+            truth = eager(x, *[s.clone() for s in states])
+            for i in range(self.n_warmup):
+                outs = step(x, *[s.clone() for s in states])
+        for t, o in zip(truth, outs):
+            diff = (t - o).abs().max().item()
+            if diff > self.atol:
+                raise Exception("compiled outputs differ from eager outputs by {}".format(diff))
@@ -34,6 +34,10 @@ _C.Model.k_inits.ksr = 0.
 _C.Model.k_inits.ksr_2 = 0.
 _C.Model.dt = 0.01
 _C.Model.scale_shift_chan = False
+_C.Model.readout = 'dense'
+_C.Model.readout_window = None
+_C.Model.centers = None
+_C.Model.fused = False
 
 _C.Data = CfgNode()
 _C.Data.img_shape = _C.img_shape
@@ -60,4 +64,11 @@ _C.Scheduler.mode = 'max'
 _C.Scheduler.factor = 0.2
 _C.Scheduler.patience = 2
 _C.Scheduler.verbose = 'True'
-_C.Scheduler.min_lr = 0
\ No newline at end of file
+_C.Scheduler.min_lr = 0
+
+_C.Search = CfgNode()
+_C.Search.asha = False
+_C.Search.keys = []
+_C.Search.values = []
+_C.Search.min_epochs = 1
+_C.Search.eta = 3
@@ -228,33 +228,193 @@ class Kinetics(nn.Module):
                 2: I1
                 3: I2
         """
-        dt = self.dt
-        ka  = self.ka.abs() * rate * pop[:, 0]
+        return kinetics_step(rate, pop, self.dt, **self.rates())
+
+    def run(self, rate, pop, n_steps):
+        """
+        Advances the populations n_steps steps under a constant rate. The rate
+        constants are rectified once for the whole run.
+
+        rate - FloatTensor (B, C, N)
+        pop - FloatTensor (B, S, C, N)
+        n_steps - int
+
+        returns the populations after each step (B, n_steps, S, C, N)
+        """
+        rates = self.rates()
+        pops = []
+        for _ in range(n_steps):
+            _, pop = kinetics_step(rate, pop, self.dt, **rates)
+            pops.append(pop)
+        return torch.stack(pops, dim=1)
+
+    def rates(self, chan=None):
+        """
+        Returns the rectified rate constants as a dict of (C, 1) tensors.
+
+        chan - int or None
+            if argued, the rate constants are expanded to chan channels
+        """
+        rates = {'ka': self.ka, 'kfi': self.kfi, 'kfr': self.kfr, 'ksi': self.ksi, 'ksr': self.ksr}
         if self.ka_offset:
-            ka += self.ka_2.abs() * pop[:, 0]
-        kfi = self.kfi.abs() * pop[:,1]
-        kfr = self.kfr.abs() * pop[:,2]
-        ksi = self.ksi.abs() * pop[:,2]
-        ksr = self.ksr.abs() * pop[:, 3]
+            rates['ka_2'] = self.ka_2
         if self.ksr_gain:
-            ksr += self.ksr_2.abs() * rate * pop[:, 3]
-        new_pop = torch.zeros_like(pop)
-        new_pop[:, 0] = pop[:, 0] + dt * (- ka + kfr)
-        new_pop[:, 1] = pop[:, 1] + dt * (- kfi + ka)
-        new_pop[:, 2] = pop[:, 2] + dt * (- kfr - ksi + kfi + ksr)
-        new_pop[:, 3] = pop[:, 3] + dt * (- ksr + ksi)
-        return new_pop[:, 1], new_pop
-    
+            rates['ksr_2'] = self.ksr_2
+        rates = {k: v.abs() for k, v in rates.items()}
+        if chan is not None:
+            rates = {k: v.expand(chan, 1) for k, v in rates.items()}
+        return rates
+
+def kinetics_activation(rate, pop, dt, ka, kfi, ka_2=None, **kwargs):
+    """
+    Computes only the new active state of a kinetics step. Gives the same values as
+    the active state returned by kinetics_step.
+    """
+    ka  = ka * rate * pop[:, 0]
+    if ka_2 is not None:
+        ka += ka_2 * pop[:, 0]
+    kfi = kfi * pop[:,1]
+    return pop[:, 1] + dt * (- kfi + ka)
+
+def kinetics_step(rate, pop, dt, ka, kfi, kfr, ksi, ksr, ka_2=None, ksr_2=None):
+    """
+    Single euler step of the four state kinetics model.
+
+    rate - FloatTensor (B, C, N)
+    pop - FloatTensor (B, S, C, N)
+    ka, kfi, kfr, ksi, ksr, ka_2, ksr_2 - FloatTensors (C, 1) or (1, 1)
+        rectified rate constants. ka_2 and ksr_2 are only used if not None
+
+    returns the new active state (B, C, N) and the new populations (B, S, C, N)
+    """
+    ka  = ka * rate * pop[:, 0]
+    if ka_2 is not None:
+        ka += ka_2 * pop[:, 0]
+    kfi = kfi * pop[:,1]
+    kfr = kfr * pop[:,2]
+    ksi = ksi * pop[:,2]
+    ksr = ksr * pop[:, 3]
+    if ksr_2 is not None:
+        ksr += ksr_2 * rate * pop[:, 3]
+    new_pop = torch.zeros_like(pop)
+    new_pop[:, 0] = pop[:, 0] + dt * (- ka + kfr)
+    new_pop[:, 1] = pop[:, 1] + dt * (- kfi + ka)
+    new_pop[:, 2] = pop[:, 2] + dt * (- kfr - ksi + kfi + ksr)
+    new_pop[:, 3] = pop[:, 3] + dt * (- ksr + ksi)
+    return new_pop[:, 1], new_pop
+
+def kinetics_steady_state(rate, ka, kfi, kfr, ksi, ksr, ka_2=None, ksr_2=None, **kwargs):
+    """
+    Populations held fixed by kinetics_step under a constant rate. Solves the
+    balance equations of the four states in closed form, written so that a
+    zero activation rate gives the resting state (1, 0, 0, 0).
+
+    rate - FloatTensor (B, C, N)
+    ka, kfi, kfr, ksi, ksr, ka_2, ksr_2 - FloatTensors (C, 1) or (1, 1)
+        rectified rate constants as in kinetics_step
+
+    returns the populations (B, S, C, N)
+    """
+    act = ka * rate
+    if ka_2 is not None:
+        act = act + ka_2
+    rec = ksr
+    if ksr_2 is not None:
+        rec = rec + ksr_2 * rate
+    pop = torch.broadcast_tensors(kfr * kfi * rec, kfr * act * rec, act * kfi * rec, act * kfi * ksi)
+    pop = torch.stack(pop, dim=1)
+    return pop / pop.sum(1, keepdim=True)
+
+class RingBuffer:
+    """
+    Fixed length history of tensors stored in a single preallocated (B, D, ...)
+    tensor. Used in place of a deque(maxlen=D) of (B, ...) tensors. New entries
+    overwrite the oldest entry and idx tracks the position of the most recent
+    one, so the chronological order of the buffer is the storage order rolled
+    by shift = idx+1.
+
+    Entries are written in place when gradients are disabled. Otherwise the
+    buffer is copied so that earlier versions stay valid for backpropagation.
+    Buffers returned by detach share memory with the original.
+    """
+    def __init__(self, data, idx=-1):
+        """
+        data - FloatTensor (B, D, ...)
+            the initial history
+        idx - int
+            position of the most recent entry. The default treats
+            data as already being in chronological order.
+        """
+        self.data = data
+        self.idx = idx % data.shape[1]
+
+    @property
+    def maxlen(self):
+        return self.data.shape[1]
+
+    @property
+    def shift(self):
+        """
+        The roll along dim 1 that puts the storage order into chronological order.
+        """
+        return (self.idx+1) % self.maxlen
+
+    def append(self, x):
+        """
+        x - FloatTensor (B, ...)
+        """
+        idx = (self.idx+1) % self.maxlen
+        if torch.is_grad_enabled():
+            index = torch.LongTensor([idx]).to(self.data.device)
+            self.data = self.data.index_copy(1, index, x[:,None])
+        else:
+            self.data[:,idx] = x
+        self.idx = idx
+
+    def ordered(self):
+        """
+        Returns the history in chronological order as a (B, D, ...) tensor.
+        The oldest entry comes first.
+        """
+        if self.shift == 0:
+            return self.data
+        return torch.roll(self.data, -self.shift, dims=1)
+
+    def detach(self):
+        return RingBuffer(self.data.detach(), self.idx)
+
+    def clone(self):
+        return RingBuffer(self.data.clone(), self.idx)
+
+    def to(self, device):
+        return RingBuffer(self.data.to(device), self.idx)
+
+    def __len__(self):
+        return self.maxlen
+
 class Temperal_Filter(nn.Module):
     def __init__(self, tem_len, spatial):
         super().__init__()
         self.spatial = spatial
         spatial_dims = np.ones(spatial).astype(np.int32).tolist()
         self.filter = nn.Parameter(torch.rand(tem_len, *spatial_dims))
+        # Rolls the filter along the temporal dim. Set to the shift of a
+        # RingBuffer to filter its unordered data.
+        self.shift = 0
 
     def forward(self, x):
-        out = (x * self.filter).sum(axis=-self.spatial-1)
-        return out
+        """
+        x - FloatTensor (..., D, *spatial)
+        """
+        filt = self.filter.reshape(-1)
+        if self.shift != 0:
+            filt = torch.roll(filt, self.shift)
+        if self.spatial == 0:
+            return torch.matmul(x, filt)
+        shape = x.shape
+        x = x.reshape(*shape[:len(shape)-self.spatial], -1)
+        out = torch.matmul(filt, x)
+        return out.reshape(*shape[:len(shape)-self.spatial-1], *shape[len(shape)-self.spatial:])
     
 class Chan_Temperal_Filter(nn.Module):
     def __init__(self, chan, tem_len, spatial):
@@ -266,7 +426,140 @@ class Chan_Temperal_Filter(nn.Module):
     def forward(self, x):
         out = (x * self.filter).sum(axis=-self.spatial-1)
         return out
-                                  
+
+class FactorizedReadout(nn.Module):
+    '''
+    Ganglion readout factorized into a gaussian spatial mask and a set of channel weights for each cell.
+    '''
+    def __init__(self, chan, shape, n_units, bias=False, centers=None, offset=0, init_std=2., window=None):
+        """
+        chan - int
+            number of channels of the incoming activations
+        shape - list-like (H, W)
+            spatial shape of the incoming activations
+        n_units - int
+            number of ganglion cells
+        bias - bool
+            if true, each cell gets a learned bias
+        centers - list-like (n_units, 2) or None
+            receptive field centers (row, col) in image coordinates. if None or if
+            the number of centers does not match n_units, every mask starts in the
+            middle of the layer
+        offset - int
+            distance between image and layer coordinates, i.e. the sum of (k-1)//2
+            over the preceding kernel sizes
+        init_std - float
+            initial standard deviation of the gaussian masks in layer units
+        window - odd int or None
+            side length of the window around each center that the masks are truncated
+            to. The truncation is applied in training and evaluation alike, so the dense
+            and the sparse paths compute the same readout, but only the sparse path used
+            in evaluation mode skips the activations outside the windows. should cover a
+            few stds of the masks. if None, the masks cover the full field
+        """
+        super().__init__()
+        self.chan = chan
+        self.shape = tuple(shape)
+        self.n_units = n_units
+        self.offset = offset
+        self.window = window
+        if window is not None:
+            assert window % 2 == 1 and window <= min(self.shape)
+
+        mu = torch.ones(n_units, 2) * torch.FloatTensor([(s-1)/2 for s in self.shape])
+        if centers is not None and np.asarray(centers).ndim == 2 and len(centers) == n_units:
+            mu = torch.FloatTensor(np.asarray(centers, dtype=np.float32)) - offset
+            mu[:, 0] = mu[:, 0].clamp(0, self.shape[0]-1)
+            mu[:, 1] = mu[:, 1].clamp(0, self.shape[1]-1)
+        self.mu = nn.Parameter(mu)
+        self.log_std = nn.Parameter(torch.ones(n_units, 2) * np.log(init_std))
+        self.chan_weight = nn.Parameter(torch.randn(n_units, chan) / np.sqrt(chan))
+        self.bias = nn.Parameter(torch.zeros(n_units)) if bias else None
+
+    def mask(self, rows, cols):
+        """
+        rows - FloatTensor (U, h)
+        cols - FloatTensor (U, w)
+
+        returns the gaussian masks evaluated on the argued coordinates (U, h, w)
+        """
+        std = self.log_std.exp()
+        mask_y = torch.exp(-0.5 * ((rows - self.mu[:, 0:1]) / std[:, 0:1])**2)
+        mask_x = torch.exp(-0.5 * ((cols - self.mu[:, 1:2]) / std[:, 1:2])**2)
+        return mask_y[:, :, None] * mask_x[:, None, :]
+
+    def window_coords(self):
+        """
+        Returns the row and column coordinates of the window around each cell's
+        center, each a LongTensor (U, window)
+        """
+        steps = torch.arange(self.window, device=self.mu.device)
+        starts = (self.mu.detach().round().long() - self.window // 2)
+        row_starts = starts[:, 0].clamp(0, self.shape[0]-self.window)
+        col_starts = starts[:, 1].clamp(0, self.shape[1]-self.window)
+        return row_starts[:, None] + steps, col_starts[:, None] + steps
+
+    def weight(self):
+        """
+        Returns the dense equivalent of the readout weights (n_units, C*H*W)
+        """
+        rows = torch.arange(self.shape[0], device=self.mu.device).float().expand(self.n_units, -1)
+        cols = torch.arange(self.shape[1], device=self.mu.device).float().expand(self.n_units, -1)
+        mask = self.mask(rows, cols)
+        if self.window is not None:
+            win_rows, win_cols = self.window_coords()
+            in_rows = (rows[:, :, None] == win_rows[:, None].float()).any(-1)
+            in_cols = (cols[:, :, None] == win_cols[:, None].float()).any(-1)
+            mask = mask * (in_rows[:, :, None] & in_cols[:, None, :]).float()
+        return (self.chan_weight[:, :, None, None] * mask[:, None]).view(self.n_units, -1)
+
+    def sparse_forward(self, x):
+        """
+        Only gathers the window around each cell's center so that the cost scales
+        with the window size instead of the full field.
+        """
+        x = x.view(-1, self.chan, *self.shape)
+        rows, cols = self.window_coords() # (U, w)
+        patches = x[:, :, rows[:, :, None], cols[:, None, :]] # (B, C, U, w, w)
+        mask = self.mask(rows.float(), cols.float())
+        out = torch.einsum('bcuhw,uhw,uc->bu', patches, mask, self.chan_weight)
+        if self.bias is not None:
+            out = out + self.bias
+        return out
+
+    def forward(self, x):
+        """
+        x - FloatTensor (B, C*H*W) or (B, C, H, W)
+        """
+        if self.window is not None and not self.training:
+            return self.sparse_forward(x)
+        return F.linear(x.reshape(x.shape[0], -1), self.weight(), self.bias)
+
+    def extra_repr(self):
+        return 'chan={}, shape={}, n_units={}, window={}'.format(self.chan, self.shape, self.n_units, self.window)
+
+def ganglion_readout(chan, shape, n_units, ksizes, bias=False, readout='dense', centers=None, window=None):
+    """
+    Returns the ganglion readout of the second layer activations.
+
+    chan - int
+        number of channels of the activations
+    shape - list-like (H, W)
+        spatial shape of the activations
+    n_units - int
+    ksizes - list-like
+        kernel sizes of the layers. The first two map the centers to layer coordinates
+    readout - str
+        'dense' for a Linear layer or 'factorized' for a FactorizedReadout
+    centers, window - see FactorizedReadout
+    """
+    if readout == 'factorized':
+        offset = sum((k-1)//2 for k in ksizes[:2])
+        return FactorizedReadout(chan, shape, n_units, bias=bias, centers=centers, offset=offset, window=window)
+    if readout != 'dense':
+        raise ValueError("readout must be 'dense' or 'factorized', got {}".format(readout))
+    return nn.Linear(chan * shape[0] * shape[1], n_units, bias=bias)
+
 class Weighted_Poisson_MSE(_Loss):
     
     def __init__(self, a=1., b=1.):
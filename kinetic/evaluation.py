@@ -3,19 +3,21 @@ import numpy as np
 from scipy.stats import sem
 from scipy.stats import pearsonr
 from kinetic.utils import *
+from kinetic.compiled import CompiledModel
 
-def pearsonr_eval(model, data, n_units, device, I20=None, start_idx=0, hs_mode='single', with_responses=False):
+def pearsonr_eval(model, data, n_units, device, I20=None, start_idx=0, hs_mode='single', with_responses=False, compiled=False):
     train_status = model.training
     model = model.to(device)
     model.eval()
     hs = get_hs(model, 1, device, I20, hs_mode)
+    step = CompiledModel(model, hs_mode) if compiled else model
     with torch.no_grad():
         pearsons = []
         val_pred = []
         val_targ = []
         for idx, (x,y) in enumerate(data):
             x = x.to(device)
-            out, hs = model(x, hs)
+            out, hs = step(x, hs)
             if idx >= start_idx:
                 val_pred.append(out.detach().cpu().numpy().squeeze(0))
                 val_targ.append(y.detach().numpy().squeeze(0))
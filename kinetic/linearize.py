@@ -0,0 +1,275 @@
+"""
+Small-signal linearization of the kinetic models around a steady state.
+
+The kinetics populations held fixed by a constant stimulus are found in closed
+form. The first-order kernel of each unit is then obtained by propagating
+cotangents backwards through the Jacobians of a single model step at that
+steady state, which gives the exact impulse response of the linearized model
+without simulating noise.
+"""
+import numpy as np
+import torch
+from torch.func import vjp, vmap
+from kinetic.custom_modules import RingBuffer, kinetics_steady_state
+from kinetic.compiled import flatten_hs, unflatten_hs
+from kinetic.utils import get_hs
+from torchdeepretina.stimuli import rolling_window
+from torchdeepretina.utils import batch_revcorr, requires_grad
+import torchdeepretina.retinal_phenomena as rp
+
+# The kinetics modules whose populations make up each flattened hidden state
+KINETICS = {'single': ('kinetics',), 'multiple': ('kinetics',), 'double': ('kinetics', 'kinetics_inh')}
+
+def ordered_step(model, hs_mode='single'):
+    """
+    Returns a function running one step of the model on flattened hidden
+    states, (x, *states) -> (out, *states). Ring buffers are passed in and
+    returned in chronological order so that the step is the same function
+    at every time point.
+    """
+    def step(x, *states):
+        hs = unflatten_hs(states, -1, hs_mode)
+        out, hs = model(x, hs)
+        if hs_mode == 'multiple':
+            hs = [hs[0], RingBuffer(hs[1].ordered())]
+        states, _ = flatten_hs(hs, hs_mode)
+        return (out,) + tuple(states)
+    return step
+
+def input_shape(model):
+    """
+    The shape of a single stimulus window. LNK models take a 1 dimensional window
+    of their filter length.
+    """
+    if hasattr(model, 'img_shape'):
+        return tuple(model.img_shape)
+    return (model.filter_len,)
+
+def expand_states(states, batch_size):
+    return tuple(s.expand(batch_size, *s.shape[1:]).contiguous() for s in states)
+
+def steady_state(model, x, hs_mode='single'):
+    """
+    Finds the hidden state held fixed by a stimulus. The populations of each
+    kinetics module are set to the closed-form steady state of its input rate,
+    one module per pass so that chained kinetics (i.e. the inhibitory pathway
+    of KineticsModelSen) settle in order. Ring buffers are then filled by
+    stepping the model.
+
+    If x holds more than one stimulus window, the rates and states are averaged
+    over the windows.
+
+    model - torch Module
+        one of the models in kinetic/models.py
+    x - FloatTensor (B, D, ...)
+        stimulus windows
+    hs_mode - str
+        'single', 'multiple' or 'double'
+
+    returns:
+        states - tuple of FloatTensors with batch size 1
+            the flattened hidden state (see kinetic.compiled.flatten_hs) with
+            ring buffers in chronological order
+        residual - float
+            largest change of the states over one more step
+    """
+    I20 = (None, None) if hs_mode == 'double' else None
+    hs = get_hs(model, 1, x.device, I20=I20, mode=hs_mode)
+    states, _ = flatten_hs(hs, hs_mode)
+    step = ordered_step(model, hs_mode)
+    modules = [getattr(model, name) for name in KINETICS[hs_mode]]
+
+    rates = dict()
+    hooks = []
+    for i, module in enumerate(modules):
+        hook = lambda mod, inp, out, i=i: rates.__setitem__(i, inp[0].mean(0, keepdim=True))
+        hooks.append(module.register_forward_hook(hook))
+    # The fused forwards do not call the kinetics modules
+    fused = getattr(model, 'fused', None)
+    if fused:
+        model.fused = False
+    try:
+        with torch.no_grad():
+            states = list(states)
+            for _ in modules:
+                step(x, *expand_states(states, len(x)))
+                for i, module in enumerate(modules):
+                    states[i] = kinetics_steady_state(rates[i], **module.rates())
+            n_steps = states[1].shape[1] if hs_mode == 'multiple' else 1
+            for _ in range(n_steps + 1):
+                prev = states
+                states = [s.mean(0, keepdim=True) for s in step(x, *expand_states(states, len(x)))[1:]]
+            residual = max((s - p).abs().max().item() for s, p in zip(states, prev))
+    finally:
+        for hook in hooks:
+            hook.remove()
+        if fused:
+            model.fused = fused
+    return tuple(states), residual
+
+def linearize(model, operating_point=(0., 0.), hs_mode='single', n_lags=100, n_samples=32, n_fft=None,
+                                                                                seed=None, device=None):
+    """
+    Computes the first-order kernel of each output unit of a kinetic model
+    around a steady state.
+
+    At zero contrast the model is linearized around the steady state of a
+    constant stimulus at the mean luminance. At nonzero contrast the kinetics
+    are held at the steady state of the mean rate over n_samples white noise
+    windows, and the step Jacobians are averaged over those windows, which
+    accounts for the average slopes of the static nonlinearities.
+
+    model - torch Module
+        one of the models in kinetic/models.py
+    operating_point - tuple (mean, contrast)
+        the mean luminance and the standard deviation of the stimulus
+    hs_mode - str
+        'single', 'multiple' or 'double'
+    n_lags - int
+        number of frames covered by the kernels. Should be longer than the
+        memory of the kinetics
+    n_samples - int
+        number of noise windows averaged over at nonzero contrast
+    n_fft - int or None
+        length of the frequency responses. Defaults to the kernel length
+    seed - int or None
+        seed of the noise windows
+    device - torch device or None
+        defaults to the device of the model
+
+    returns:
+        dict
+            kernels - ndarray (U, L, ...)
+                the change in each unit's response to a unit change of each frame.
+                oldest frame first, as the STAs of batch_revcorr
+            temporal - ndarray (U, L)
+                the kernels summed over space, i.e. the full-field kernels
+            spatial - ndarray (U, ...)
+                the kernels at the lag of largest full-field magnitude
+            freqs - ndarray (F,)
+                frequencies in Hz, using the dt of the kinetics
+            frequency_response - complex ndarray (U, F)
+                full-field transfer functions of the linearized model
+            output - ndarray (U,)
+                the responses at the steady state
+            states - tuple of FloatTensors
+                the steady state, see steady_state
+            residual - float
+                see steady_state
+    """
+    if device is None:
+        device = next(model.parameters()).device
+    mean, contrast = operating_point
+    img_shape = input_shape(model)
+    x = torch.full((1, *img_shape), float(mean))
+    if contrast > 0:
+        generator = None if seed is None else torch.Generator().manual_seed(seed)
+        x = x + contrast * torch.randn(n_samples, *img_shape, generator=generator)
+    x = x.to(device)
+    n_batch = len(x)
+
+    training = model.training
+    grad_states = [p.requires_grad for p in model.parameters()]
+    model.eval()
+    requires_grad(model, False)
+    try:
+        states, residual = steady_state(model, x, hs_mode)
+        step = ordered_step(model, hs_mode)
+        outs, vjp_fn = vjp(step, x, *expand_states(states, n_batch))
+        n_units = outs[0].shape[1]
+        # Each window contributes 1/n_batch of the averaged Jacobians
+        out_cot = torch.eye(n_units, device=device)[:,None].expand(-1, n_batch, -1) / n_batch
+        state_cots = [torch.zeros(n_units, *s.shape, device=device) for s in outs[1:]]
+        windows = []
+        for _ in range(n_lags):
+            grads = vmap(vjp_fn)((out_cot, *state_cots))
+            windows.append(grads[0].sum(1).cpu())
+            out_cot = torch.zeros_like(out_cot)
+            state_cots = [g.sum(1, keepdim=True).expand_as(g) / n_batch for g in grads[1:]]
+        output = outs[0].mean(0).detach().cpu().numpy()
+    finally:
+        for p, state in zip(model.parameters(), grad_states):
+            p.requires_grad = state
+        model.train(training)
+
+    # windows[k] is the gradient with respect to the window k steps back. Its
+    # frame d is D-1-d frames older than the last frame of that window. Frames
+    # older than n_lags would miss the windows beyond n_lags and are dropped
+    depth = img_shape[0]
+    kernels = torch.zeros(n_units, n_lags + depth - 1, *img_shape[1:])
+    for k, window in enumerate(windows):
+        kernels[:, n_lags-1-k:n_lags-1-k+depth] += window
+    kernels = kernels[:, depth-1:].numpy()
+
+    temporal = kernels.reshape(n_units, kernels.shape[1], -1).sum(-1)
+    peaks = np.abs(temporal).argmax(1)
+    spatial = kernels[np.arange(n_units), peaks]
+    if n_fft is None:
+        n_fft = temporal.shape[1]
+    dt = model.kinetics.dt
+    freqs = np.fft.rfftfreq(n_fft, dt)
+    frequency_response = np.fft.rfft(temporal[:, ::-1], n=n_fft, axis=1)
+    return {'kernels': kernels, 'temporal': temporal, 'spatial': spatial, 'freqs': freqs,
+            'frequency_response': frequency_response, 'output': output, 'states': states,
+            'residual': residual}
+
+def check_linearization(model, linearization, operating_point=(0., 0.), hs_mode='single', contrast=None,
+                                                    n_frames=10000, seed=None, device=None):
+    """
+    Compares linearized kernels with STAs of the model simulated from the same
+    steady state. For white noise of small contrast c, the reverse correlation
+    of the response with the stimulus divided by c**2 approaches the
+    first-order kernel.
+
+    model - torch Module
+    linearization - dict
+        the output of linearize
+    operating_point - tuple (mean, contrast)
+        the operating point argued to linearize
+    hs_mode - str
+        'single', 'multiple' or 'double'
+    contrast - float or None
+        contrast of the simulated noise. Defaults to the contrast of the
+        operating point, or 0.1 if it is zero
+    n_frames - int
+        number of noise frames simulated
+    seed - int or None
+
+    returns:
+        dict
+            sta - ndarray (U, L, ...)
+                the simulated STAs, scaled to be comparable to the kernels
+            correlation - ndarray (U,)
+                pearson correlation of each kernel with its STA
+            gain - ndarray (U,)
+                least squares scale from each kernel to its STA
+    """
+    if device is None:
+        device = next(model.parameters()).device
+    mean, op_contrast = operating_point
+    if contrast is None:
+        contrast = op_contrast if op_contrast > 0 else 0.1
+    kernels = linearization['kernels']
+    n_units, length = kernels.shape[:2]
+    img_shape = input_shape(model)
+    depth = img_shape[0]
+
+    rng = np.random.RandomState(seed)
+    frames = mean + contrast * rng.randn(n_frames, *img_shape[1:]).astype(np.float32)
+    X = rolling_window(frames, depth)
+    hs = unflatten_hs(linearization['states'], -1, hs_mode)
+    training = model.training
+    model.eval()
+    try:
+        resp = rp.simulate(model, [X], hs, device=device)[0]
+    finally:
+        model.train(training)
+
+    rcs, _ = batch_revcorr(frames[depth-1:depth-1+len(resp)], resp - resp.mean(0), length)
+    sta = rcs / ((len(resp) - length + 1) * contrast**2)
+
+    flat_k = kernels.reshape(n_units, -1)
+    flat_s = sta.reshape(n_units, -1)
+    correlation = np.array([np.corrcoef(k, s)[0,1] for k, s in zip(flat_k, flat_s)])
+    gain = (flat_k * flat_s).sum(1) / (flat_k**2).sum(1)
+    return {'sta': sta, 'correlation': correlation, 'gain': gain}
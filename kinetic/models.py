@@ -7,7 +7,8 @@ from kinetic.custom_modules import *
 class KineticsChannelModelFilterAmacrine(nn.Module):
     def __init__(self, bnorm=True, drop_p=0, scale_kinet=False, recur_seq_len=5, n_units=5, 
                  noise=0., bias=True, linear_bias=False, chans=[8,8], softplus=True, 
-                 inference_exp=False, img_shape=(40,50,50), ksizes=(15,11), centers=None):
+                 inference_exp=False, img_shape=(40,50,50), ksizes=(15,11), centers=None, 
+                 readout='dense', readout_window=None):
         super().__init__()
         
         self.n_units = n_units
@@ -20,6 +21,7 @@ class KineticsChannelModelFilterAmacrine(nn.Module):
         self.linear_bias = linear_bias 
         self.noise = noise
         self.centers = centers
+        self.readout = readout
         
         self.drop_p = drop_p
         self.scale_kinet = scale_kinet
@@ -59,28 +61,56 @@ class KineticsChannelModelFilterAmacrine(nn.Module):
         modules = []
         modules.append(Reshape((-1, self.seq_len, self.chans[1] * shape[0] * shape[1])))
         modules.append(Temperal_Filter(self.seq_len, 1))
-        modules.append(nn.Linear(self.chans[1]*shape[0]*shape[1], 
-                                 self.n_units, bias=self.linear_bias))
+        modules.append(ganglion_readout(self.chans[1], shape, self.n_units, self.ksizes, bias=self.linear_bias,
+                                        readout=self.readout, centers=self.centers, window=readout_window))
         modules.append(nn.Softplus())
         self.ganglion = nn.Sequential(*modules)
 
     def forward(self, x, hs):
         """
         x - FloatTensor (B, C, H, W)
-        hs - list [(B,S,C,N),(D,B,C,N)]
+        hs - list [(B,S,C,N),RingBuffer (B,D,C,N)]
             First list element should be a torch FloatTensor of state population values.
-            Second element should be deque of activated population values over past D time steps
+            Second element should be a RingBuffer of activated population values over past D time steps
         """
         fx = self.bipolar(x)
         fx = self.amacrine(fx)
         fx, h0 = self.kinetics(fx, hs[0]) 
         hs[1].append(fx)
         h1 = hs[1]
-        fx = torch.stack(list(h1), dim=1) #(B,D,N)
         if self.scale_kinet:
-            fx = self.kinet_scale(fx)
-        fx = self.ganglion(fx)
+            fx = self.kinet_scale(h1.ordered()) #(B,D,C,N)
+            fx = self.ganglion(fx)
+        else:
+            # The temporal filter is rolled instead of the history
+            self.ganglion[1].shift = h1.shift
+            try:
+                fx = self.ganglion(h1.data)
+            finally:
+                self.ganglion[1].shift = 0
         return fx, [h0, h1]
+
+    def fast_forward(self, x, hs, n_steps):
+        """
+        Runs n_steps steps with the same stimulus window. The bipolar and amacrine
+        layers are computed once, then Kinetics.run takes the n_steps Euler steps
+        of the kinetics on their output.
+
+        x - FloatTensor (B, C, H, W)
+        hs - list [(B,S,C,N),RingBuffer (B,D,C,N)]
+        n_steps - int
+
+        returns the outputs (B, n_steps, n_units) and the final hidden state
+        """
+        fx = self.amacrine(self.bipolar(x))
+        pops = self.kinetics.run(fx, hs[0], n_steps)
+        seq_len = hs[1].maxlen
+        history = torch.cat((hs[1].ordered(), pops[:, :, 1]), dim=1) #(B,D+n_steps,C,N)
+        windows = history.unfold(1, seq_len, 1)[:, 1:].movedim(-1, 2).flatten(0, 1) #(B*n_steps,D,C,N)
+        if self.scale_kinet:
+            windows = self.kinet_scale(windows)
+        fx = self.ganglion(windows).reshape(len(x), n_steps, -1)
+        return fx, [pops[:, -1], RingBuffer(history[:, -seq_len:])]
     
 class LNK(nn.Module):
     def __init__(self, name, dt=0.01, img_shape=(100,), ka_offset=False, ksr_gain=False, k_inits={}, **kwargs):
@@ -106,16 +136,33 @@ class LNK(nn.Module):
         out = self.ln_filter(x) + self.bias
         out = self.nonlinear(out)[:, None]
         out, hs_new = self.kinetics(out, hs)
+        return self.post_kinetics(hs, hs_new), hs_new
+
+    def post_kinetics(self, hs, hs_new):
         deriv = (hs_new[:, 1] - hs[:, 1]) / self.dt
-        out = torch.cat((out, deriv), dim=1)
+        out = torch.cat((hs_new[:, 1], deriv), dim=1)
         out = self.scale_shift(out)
-        out = self.spiking(out)
-        return out, hs_new
+        return self.spiking(out)
+
+    def fast_forward(self, x, hs, n_steps):
+        """
+        Runs n_steps steps with the same stimulus window. The filter and
+        nonlinearity are computed once and Kinetics.run steps the kinetics.
+
+        returns the outputs (B, n_steps, 1) and the final hidden state
+        """
+        out = self.ln_filter(x) + self.bias
+        out = self.nonlinear(out)[:, None]
+        pops = self.kinetics.run(out, hs, n_steps)
+        prev = torch.cat((hs[:, None], pops[:, :-1]), dim=1)
+        out = self.post_kinetics(prev.flatten(0, 1), pops.flatten(0, 1))
+        return out.reshape(len(x), n_steps, -1), pops[:, -1]
     
 class KineticsChannelModelDeriv(nn.Module):
     def __init__(self, bnorm=True, drop_p=0, recur_seq_len=5, n_units=5, 
                  noise=0., bias=True, linear_bias=False, chans=[8,8], softplus=True, 
-                 inference_exp=False, img_shape=(40,50,50), ksizes=(15,11), dt=0.01, centers=None):
+                 inference_exp=False, img_shape=(40,50,50), ksizes=(15,11), dt=0.01, centers=None, 
+                 readout='dense', readout_window=None):
         super().__init__()
         
         self.kinetic = True
@@ -130,6 +177,7 @@ class KineticsChannelModelDeriv(nn.Module):
         self.linear_bias = linear_bias 
         self.noise = noise 
         self.centers = centers
+        self.readout = readout
         
         self.drop_p = drop_p
         self.seq_len = recur_seq_len
@@ -173,8 +221,8 @@ class KineticsChannelModelDeriv(nn.Module):
         self.amacrine = nn.Sequential(*modules)
 
         modules = []
-        modules.append(nn.Linear(self.chans[1]*shape[0]*shape[1], 
-                                 self.n_units, bias=self.linear_bias))
+        modules.append(ganglion_readout(self.chans[1], shape, self.n_units, self.ksizes, bias=self.linear_bias,
+                                        readout=self.readout, centers=self.centers, window=readout_window))
         modules.append(nn.Softplus())
         self.ganglion = nn.Sequential(*modules)
         
@@ -187,17 +235,33 @@ class KineticsChannelModelDeriv(nn.Module):
         """
         fx = self.bipolar(x)
         fx, hs_new = self.kinetics(fx, hs)
+        return self.post_kinetics(hs, hs_new), hs_new
+
+    def post_kinetics(self, hs, hs_new):
         deriv = (hs_new[:, 1] - hs[:, 1]) / self.dt
-        fx = torch.stack((fx, deriv), dim=-1)
+        fx = torch.stack((hs_new[:, 1], deriv), dim=-1)
         fx = (self.w * fx).sum(-1) + self.b
         fx = self.spiking_block(fx)
         fx = self.amacrine(fx)
-        fx = self.ganglion(fx)
-        return fx, hs_new
+        return self.ganglion(fx)
+
+    def fast_forward(self, x, hs, n_steps):
+        """
+        Runs n_steps steps with the same stimulus window. The bipolar layer is
+        computed once and Kinetics.run steps the kinetics; the layers after the
+        kinetics then run on all steps as a single batch.
+
+        returns the outputs (B, n_steps, n_units) and the final hidden state
+        """
+        pops = self.kinetics.run(self.bipolar(x), hs, n_steps)
+        prev = torch.cat((hs[:, None], pops[:, :-1]), dim=1)
+        fx = self.post_kinetics(prev.flatten(0, 1), pops.flatten(0, 1))
+        return fx.reshape(len(x), n_steps, -1), pops[:, -1]
     
 class KineticsModel(nn.Module):
     def __init__(self, name, n_units=5, bias=True, linear_bias=False, chans=[8, 8], img_shape=(40, 50, 50), ksizes=(15, 11),
-                 k_chan=True, ka_offset=False, ksr_gain=False, k_inits={}, dt=0.01, scale_shift_chan=True, **kwargs):
+                 k_chan=True, ka_offset=False, ksr_gain=False, k_inits={}, dt=0.01, scale_shift_chan=True, 
+                 readout='dense', readout_window=None, centers=None, **kwargs):
         super().__init__()
         
         self.name = name
@@ -213,6 +277,8 @@ class KineticsModel(nn.Module):
         self.ka_offset = ka_offset
         self.ksr_gain = ksr_gain
         self.scale_shift_chan = scale_shift_chan
+        self.readout = readout
+        self.centers = centers
 
         modules = []
         modules.append(LinearStackedConv2d(self.img_shape[0], self.chans[0], kernel_size=self.ksizes[0], bias=bias))
@@ -249,7 +315,8 @@ class KineticsModel(nn.Module):
         self.amacrine = nn.Sequential(*modules)
 
         modules = []
-        modules.append(nn.Linear(self.chans[1] * shape[0] * shape[1], self.n_units, bias=linear_bias))
+        modules.append(ganglion_readout(self.chans[1], shape, self.n_units, self.ksizes, bias=linear_bias,
+                                        readout=self.readout, centers=self.centers, window=readout_window))
         modules.append(nn.Softplus())
         self.ganglion = nn.Sequential(*modules)
         
@@ -260,11 +327,24 @@ class KineticsModel(nn.Module):
         """
         fx = self.bipolar(x)
         fx, hs = self.kinetics(fx, hs)
+        return self.post_kinetics(fx), hs
+
+    def post_kinetics(self, fx):
         fx = self.kinetics_w * fx + self.kinetics_b
         fx = self.spiking_block(fx)
         fx = self.amacrine(fx)
-        fx = self.ganglion(fx)
-        return fx, hs
+        return self.ganglion(fx)
+
+    def fast_forward(self, x, hs, n_steps):
+        """
+        Runs n_steps steps with the same stimulus window. Only the kinetics are
+        stepped, with Kinetics.run, on the bipolar output computed once.
+
+        returns the outputs (B, n_steps, n_units) and the final hidden state
+        """
+        pops = self.kinetics.run(self.bipolar(x), hs, n_steps)
+        fx = self.post_kinetics(pops[:, :, 1].flatten(0, 1))
+        return fx.reshape(len(x), n_steps, -1), pops[:, -1]
     
 class KineticsOnePixel(nn.Module):
     def __init__(self, name, n_units=5, bias=True, linear_bias=False, chans=[8, 8], img_shape=(40, ),
@@ -319,21 +399,39 @@ class KineticsOnePixel(nn.Module):
         
         """
         
+        fx, hs = self.kinetics(self.pre_kinetics(x), hs)
+        return self.post_kinetics(fx), hs
+
+    def pre_kinetics(self, x):
         fx = (self.bipolar_weight * x[:,None]).sum(dim=-1) + self.bipolar_bias
-        fx = F.sigmoid(fx)[:,:,None] #(B,C,1)
-        fx, hs = self.kinetics(fx, hs)
+        return F.sigmoid(fx)[:,:,None] #(B,C,1)
+
+    def post_kinetics(self, fx):
         fx = self.kinetics_w * fx + self.kinetics_b
         fx = self.spiking_block(fx).squeeze(-1)
         fx = (self.amacrine_weight * fx[:,None]).sum(dim=-1) + self.amacrine_bias
         fx = F.relu(fx)
-        fx = self.ganglion(fx)
-        return fx, hs
+        return self.ganglion(fx)
+
+    def fast_forward(self, x, hs, n_steps):
+        """
+        Runs n_steps steps with the same stimulus window. The bipolar weighting
+        is computed once and only the kinetics are stepped, by Kinetics.run.
+
+        returns the outputs (B, n_steps, n_units) and the final hidden state
+        """
+        pops = self.kinetics.run(self.pre_kinetics(x), hs, n_steps)
+        fx = self.post_kinetics(pops[:, :, 1].flatten(0, 1))
+        return fx.reshape(len(x), n_steps, -1), pops[:, -1]
     
 class KineticsModel1D(nn.Module):
     def __init__(self, name, n_units=5, bias=True, linear_bias=False, chans=[8, 8], img_shape=(40, 50, 50), ksizes=(15, 11),
                  k_chan=True, ka_offset=False, ksr_gain=False, k_inits={}, dt=0.01, scale_shift_chan=True, **kwargs):
         super().__init__()
         
+        # FactorizedReadout masks are 2 dimensional
+        if kwargs.get('readout', 'dense') != 'dense':
+            raise ValueError('KineticsModel1D only has a dense readout')
         self.name = name
         self.n_units = n_units
         self.chans = chans 
@@ -394,15 +492,62 @@ class KineticsModel1D(nn.Module):
         """
         fx = self.bipolar(x)
         fx, hs = self.kinetics(fx, hs)
+        return self.post_kinetics(fx), hs
+
+    def post_kinetics(self, fx):
         fx = self.kinetics_w * fx + self.kinetics_b
         fx = self.spiking_block(fx)
         fx = self.amacrine(fx)
-        fx = self.ganglion(fx)
-        return fx, hs
+        return self.ganglion(fx)
+
+    def fast_forward(self, x, hs, n_steps):
+        """
+        Runs n_steps steps with the same stimulus window. Only the kinetics are
+        stepped, with Kinetics.run, on the bipolar output computed once.
+
+        returns the outputs (B, n_steps, n_units) and the final hidden state
+        """
+        pops = self.kinetics.run(self.bipolar(x), hs, n_steps)
+        fx = self.post_kinetics(pops[:, :, 1].flatten(0, 1))
+        return fx.reshape(len(x), n_steps, -1), pops[:, -1]
     
+def fused_sen_forward(model, x, hs):
+    """
+    Forward of KineticsModelSen and KineticsModelSenConv that updates the excitatory
+    and inhibitory kinetics in a single step over the stacked (C+1) channels. The
+    excitatory input depends on the new inhibitory activation, so only the active
+    state of the inhibitory kinetics is computed ahead of the stacked step. Gives
+    the same outputs as the unfused forward. Forward hooks on kinetics and
+    kinetics_inh are not called.
+
+    model - KineticsModelSen or KineticsModelSenConv
+    x - FloatTensor (B, C, H, W)
+    hs - tuple ((B,S,C,N), (B,S,1,N))
+    """
+    chan = model.chans[0]
+    fx = model.bipolar(x)
+    rate_inh = model.bipolar_inh(x)
+    rates_inh = model.kinetics_inh.rates()
+    inh = kinetics_activation(rate_inh, hs[1], model.kinetics_inh.dt, **rates_inh)
+    inh = model.kinetics_w_inh * inh + model.kinetics_b_inh
+    inh = model.spiking_block1(inh)
+    fx = fx - inh
+    fx = model.bipolar_nl(fx)
+    rates = model.kinetics.rates(chan=chan)
+    rates = {k: torch.cat((v, rates_inh[k]), dim=0) for k, v in rates.items()}
+    rate = torch.cat((fx, rate_inh), dim=1)
+    pop = torch.cat((hs[0], hs[1]), dim=2)
+    fx, pop = kinetics_step(rate, pop, model.kinetics.dt, **rates)
+    fx = model.kinetics_w * fx[:, :chan] + model.kinetics_b
+    fx = model.spiking_block2(fx)
+    fx = model.amacrine(fx)
+    fx = model.ganglion(fx)
+    return fx, (pop[:, :, :chan], pop[:, :, chan:])
+
 class KineticsModelSen(nn.Module):
     def __init__(self, name, n_units=5, bias=True, linear_bias=False, chans=[8, 8], img_shape=(40, 50, 50), ksizes=(15, 11),
-                 k_chan=True, ka_offset=False, ksr_gain=False, k_inits={}, dt=0.01, scale_shift_chan=True, **kwargs):
+                 k_chan=True, ka_offset=False, ksr_gain=False, k_inits={}, dt=0.01, scale_shift_chan=True, 
+                 readout='dense', readout_window=None, centers=None, fused=False, **kwargs):
         super().__init__()
         
         self.name = name
@@ -418,6 +563,9 @@ class KineticsModelSen(nn.Module):
         self.ka_offset = ka_offset
         self.ksr_gain = ksr_gain
         self.scale_shift_chan = scale_shift_chan
+        self.readout = readout
+        self.centers = centers
+        self.fused = fused
 
         modules = []
         modules.append(LinearStackedConv2d(self.img_shape[0], self.chans[0], kernel_size=self.ksizes[0], bias=bias))
@@ -461,7 +609,8 @@ class KineticsModelSen(nn.Module):
         self.amacrine = nn.Sequential(*modules)
 
         modules = []
-        modules.append(nn.Linear(self.chans[1] * shape[0] * shape[1], self.n_units, bias=linear_bias))
+        modules.append(ganglion_readout(self.chans[1], shape, self.n_units, self.ksizes, bias=linear_bias,
+                                        readout=self.readout, centers=self.centers, window=readout_window))
         modules.append(nn.Softplus())
         self.ganglion = nn.Sequential(*modules)
         
@@ -470,6 +619,8 @@ class KineticsModelSen(nn.Module):
         x - FloatTensor (B, C, H, W)
         hs - (B,S,C,N) or (B,S,1,N)
         """
+        if self.fused:
+            return self.fused_forward(x, hs)
         fx = self.bipolar(x)
         inh = self.bipolar_inh(x)
         inh, hs2 = self.kinetics_inh(inh, hs[1])
@@ -483,12 +634,21 @@ class KineticsModelSen(nn.Module):
         fx = self.amacrine(fx)
         fx = self.ganglion(fx)
         return fx, (hs1, hs2)
+
+    def fused_forward(self, x, hs):
+        """
+        Steps both kinetics modules as one stacked update. See fused_sen_forward.
+        """
+        return fused_sen_forward(self, x, hs)
     
 class KineticsModelSenConv(nn.Module):
     def __init__(self, name, n_units=5, bias=True, linear_bias=False, chans=[8, 8], img_shape=(40, 50, 50), ksizes=(15, 11),
-                 k_chan=True, ka_offset=False, ksr_gain=False, k_inits={}, dt=0.01, scale_shift_chan=True, **kwargs):
+                 k_chan=True, ka_offset=False, ksr_gain=False, k_inits={}, dt=0.01, scale_shift_chan=True, fused=False, **kwargs):
         super().__init__()
         
+        # The ganglion layer is a convolution with no per cell readout to factorize
+        if kwargs.get('readout', 'dense') != 'dense':
+            raise ValueError('KineticsModelSenConv only has a convolutional readout')
         self.name = name
         self.n_units = n_units
         self.chans = chans 
@@ -502,6 +662,7 @@ class KineticsModelSenConv(nn.Module):
         self.ka_offset = ka_offset
         self.ksr_gain = ksr_gain
         self.scale_shift_chan = scale_shift_chan
+        self.fused = fused
 
         modules = []
         modules.append(LinearStackedConv2d(self.img_shape[0], self.chans[0], kernel_size=self.ksizes[0], bias=bias))
@@ -557,6 +718,8 @@ class KineticsModelSenConv(nn.Module):
         x - FloatTensor (B, C, H, W)
         hs - (B,S,C,N) or (B,S,1,N)
         """
+        if self.fused:
+            return self.fused_forward(x, hs)
         fx = self.bipolar(x)
         inh = self.bipolar_inh(x)
         inh, hs2 = self.kinetics_inh(inh, hs[1])
@@ -569,4 +732,10 @@ class KineticsModelSenConv(nn.Module):
         fx = self.spiking_block2(fx)
         fx = self.amacrine(fx)
         fx = self.ganglion(fx)
-        return fx, (hs1, hs2)
\ No newline at end of file
+        return fx, (hs1, hs2)
+
+    def fused_forward(self, x, hs):
+        """
+        Steps both kinetics modules as one stacked update. See fused_sen_forward.
+        """
+        return fused_sen_forward(self, x, hs)
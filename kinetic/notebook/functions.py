@@ -33,54 +33,25 @@ def contrast_adaptation(model, device, insp_keys, scale=4.46, fpf=3, c0=0.05, c1
     envelope += c0
     
     stimuli = []
-    responses = []
-    
-    layer_outs_list = {key:[] for key in insp_keys}
-    layer_outs_list['outputs'] = []
-    with torch.no_grad():
-        for trial in range(nrepeats):
-            if load_stimuli == None:
-                x = random_from_envelope(envelope, repeat=fpf)
-            else:
-                x = load_stimuli[trial] - 1
-                x = np.expand_dims(x, axis=(-1,-2))
-            stimuli.append(x.squeeze())
-            x = scale * x
-            if stim_type == 'full':
-                x = torch.from_numpy(stim.concat(x, nh=filt_depth)).to(device)
-            elif stim_type == 'one_pixel':
-                x = torch.from_numpy(stim.rolling_window(x, filt_depth, time_axis=0)).to(device)
-            else:
-                raise Exception('Invalid stimulus type')
-                
-            hs = get_hs(model, 1, device, I20, hs_mode)
-            layer_outs = inspect_rnn(model, x, hs, insp_keys)
-            response = np.pad(layer_outs['outputs'], ((filt_depth, 0), (0,0)), 'constant', constant_values=(0,0))
-            responses.append(response)
-            
-            for key in layer_outs_list.keys():
-                if key == 'kinetics':
-                    kinetics_history = [h[1].detach().cpu().numpy().mean(-1) for h in layer_outs['kinetics']]
-                    kinetics_history = np.concatenate(kinetics_history, axis=0)
-                    layer_outs_list[key].append(kinetics_history)
-                else:
-                    layer_outs_list[key].append(layer_outs[key])
-    for key in layer_outs_list.keys():
-        if isinstance(layer_outs_list[key][0], np.ndarray):
-            layer_outs[key] = np.array(layer_outs_list[key]).mean(0)
+    for trial in range(nrepeats):
+        if load_stimuli == None:
+            x = random_from_envelope(envelope, repeat=fpf)
         else:
-            layer_outs[key] = layer_outs_list[key]
+            x = load_stimuli[trial] - 1
+            x = np.expand_dims(x, axis=(-1,-2))
+        stimuli.append(x)
+    responses, layer_outs = simulate_trials(model, device, stimuli, scale=scale, stim_type=stim_type,
+                                            filt_depth=filt_depth, I20=I20, hs_mode=hs_mode, insp_keys=insp_keys)
     
-    stimuli = [(stim+1) for stim in stimuli]
+    stimuli = [(stim.squeeze()+1) for stim in stimuli]
     if cells == 'all':
         cells = range(model.n_units)
-    for cell in cells:
-        ln_he = LN_model(stimuli, responses, c1, cell, duration, duration + 500, sta_type='revcor')
-        ln_hl = LN_model(stimuli, responses, c1, cell, 2 * duration - 600, 2 * duration, sta_type='revcor')
-        ln_le = LN_model(stimuli, responses, c0, cell, 2 * duration, 2 * duration + 500, sta_type='revcor')
-        ln_ll = LN_model(stimuli, responses, c0, cell, 3 * duration - 600, 3 * duration, sta_type='revcor')
-        
-        LN_plot(ln_he, ln_hl, ln_le, ln_ll, save='LN_'+str(cell))
+    segments = {'he': (duration, duration + 500), 'hl': (2 * duration - 600, 2 * duration),
+                'le': (2 * duration, 2 * duration + 500), 'll': (3 * duration - 600, 3 * duration)}
+    lns = LN_segments(stimuli, responses, segments, cells=cells, sta_type='revcor')
+    for i, cell in enumerate(cells):
+        LN_plot(*[(lns[seg]['sta'][i], lns[seg]['x'][i], lns[seg]['nonlinearity'][i]) for seg in segments],
+                save='LN_'+str(cell))
         
     responses_plot(stimuli, responses, layer_outs, channel, save='response')
 
@@ -190,42 +161,24 @@ def contrast_adaptation_statistics(model, device, hs_mode='single', stim_type='f
         envelope = envelope.squeeze()
 
     stimuli = []
-    responses = []
-    with torch.no_grad():
-        for trial in range(nrepeats):
-            if load_stimuli == None:
-                x = random_from_envelope(envelope, repeat=fpf)
-            else:
-                x = load_stimuli[trial] - 1
-                x = np.expand_dims(x, axis=(-1,-2))
-            stimuli.append(x.squeeze())
-            x = scale * x
-            if stim_type == 'full':
-                x = torch.from_numpy(stim.concat(x, nh=filt_depth)).to(device)
-            elif stim_type == 'one_pixel':
-                x = torch.from_numpy(stim.rolling_window(x, filt_depth, time_axis=0)).to(device)
-            else:
-                raise Exception('Invalid stimulus type')
-
-            hs = get_hs(model, 1, device, I20, hs_mode)
-            layer_outs = inspect_rnn(model, x, hs)
-            response = np.pad(layer_outs['outputs'], ((filt_depth, 0), (0,0)), 'constant', constant_values=(0,0))
-            responses.append(response)
-    
-    stimuli = [(stim+1) for stim in stimuli]
+    for trial in range(nrepeats):
+        if load_stimuli == None:
+            x = random_from_envelope(envelope, repeat=fpf)
+        else:
+            x = load_stimuli[trial] - 1
+            x = np.expand_dims(x, axis=(-1,-2))
+        stimuli.append(x)
+    responses, _ = simulate_trials(model, device, stimuli, scale=scale, stim_type=stim_type,
+                                   filt_depth=filt_depth, I20=I20, hs_mode=hs_mode)
+    
+    stimuli = [(stim.squeeze()+1) for stim in stimuli]
     if cells == 'all':
         cells = range(model.n_units)
-    gains = {'he':[], 'hl':[]}
-    freqs = []
-    offsets = {'he':[], 'hl':[]}
-    for cell in cells:
-        gain_he, _, offset_he = LN_statistics(stimuli, responses, c1, cell, nsamples//2, nsamples//2 + 500)
-        gain_hl, mean_freq, offset_hl = LN_statistics(stimuli, responses, c1, cell, nsamples - 600, nsamples)
-        gains['he'].append(gain_he)
-        gains['hl'].append(gain_hl)
-        freqs.append(mean_freq)
-        offsets['he'].append(offset_he)
-        offsets['hl'].append(offset_hl)
+    segments = {'he': (nsamples//2, nsamples//2 + 500), 'hl': (nsamples - 600, nsamples)}
+    lns = LN_segments(stimuli, responses, segments, cells=cells)
+    gains = {seg: [None if np.isnan(g) else g for g in lns[seg]['gain']] for seg in segments}
+    freqs = list(lns['hl']['mean_freq'])
+    offsets = {seg: list(lns[seg]['offset']) for seg in segments}
         
     return gains, freqs, offsets
 
@@ -280,70 +233,116 @@ def LN_statistics_plot(data, contrasts_l, contrasts_nl, save=None, dpi=300):
     
     return
 
-def LN_model(stimuli, responses, contrast, cell, start_idx, end_idx, filter_len=100, sta_type='revcor', offset=10):
-    sta = 0
-    stimulus = []
-    resp = []
-    for trial in range(len(stimuli)):
-        stim_trial = stimuli[trial][start_idx:end_idx]
-        resp_trial = responses[trial][start_idx:end_idx, cell]
-        stimulus.append(stim_trial)
-        resp.append(resp_trial)
+def simulate_trials(model, device, trials, scale=4.46, stim_type='full', filt_depth=40, I20=None,
+                    hs_mode='single', insp_keys=[]):
+    """
+    Runs the trials of a contrast adaptation experiment as parallel lanes of a
+    single recurrent simulation.
+
+    trials - list of ndarrays (T, ...)
+        the unscaled stimulus of each trial
+    insp_keys - list of str
+        layers whose activity is recorded. The state of the 'kinetics' layer
+        is recorded averaged over its last dimension
+
+    returns:
+        responses - list of ndarrays (T, n_units)
+            the response of each trial, zero padded by filt_depth at the start
+        layer_outs - dict of ndarrays (T-filt_depth, ...)
+            the activity of the inspected layers and the outputs averaged over trials
+    """
+    xs = []
+    for x in trials:
+        x = scale * x
+        if stim_type == 'full':
+            xs.append(stim.concat(x, nh=filt_depth))
+        elif stim_type == 'one_pixel':
+            xs.append(stim.rolling_window(x, filt_depth, time_axis=0))
+        else:
+            raise Exception('Invalid stimulus type')
+    X = torch.from_numpy(np.stack(xs, axis=1)).to(device) # (T, trials, ...)
+    n_trials = len(trials)
+
+    hs = get_hs(model, n_trials, device, I20, hs_mode)
+    recorder = ActivationRecorder(model, [k for k in insp_keys if k != 'kinetics'], len(X)*n_trials)
+    if 'kinetics' in insp_keys:
+        module = dict(model.named_modules())['kinetics']
+        hook = lambda module, inp, out: recorder.record('kinetics', out[1].mean(-1))
+        recorder.handles.append(module.register_forward_hook(hook))
+    with recorder, torch.no_grad():
+        for x in X:
+            out, hs = model(x, hs)
+            recorder.record('outputs', out)
+    layer_outs = recorder.close()
+    layer_outs = {k: v.reshape(len(X), n_trials, *v.shape[1:]) for k,v in layer_outs.items()}
+    responses = [np.pad(layer_outs['outputs'][:,trial], ((filt_depth, 0), (0,0)), 'constant', constant_values=(0,0))
+                                                                            for trial in range(n_trials)]
+    layer_outs = {k: v.mean(1) for k,v in layer_outs.items()}
+    return responses, layer_outs
+
+def LN_segments(stimuli, responses, segments, cells=None, filter_len=100, sta_type='revcor', offset=10):
+    """
+    Fits the LN models of many cells in several segments of a set of trials.
+    The filters of all cells and trials of a segment are estimated in a
+    single reverse correlation product and the sigmoid nonlinearities of all
+    cells are fit together (see batch_sigmoid_fit).
+
+    stimuli - list of ndarrays (T,)
+    responses - list of ndarrays (T, n_units)
+    segments - dict {name: (start_idx, end_idx)}
+    cells - sequence of ints or None
+        if None, uses all cells
+
+    returns dict {name: dict of ndarrays} with keys
+        'sta' - (K, filter_len) normalized filters
+        'x', 'nonlinearity' - (K, 50) the fitted nonlinearities
+        'gain' - (K,) nan for cells that never exceed the slope threshold
+        'mean_freq' - (K,) mean frequency of the filters
+        'offset' - (K,) mean of the nonlinearities
+    """
+    stimuli = np.stack(stimuli)
+    responses = np.stack(responses)
+    if cells is not None:
+        responses = responses[..., list(cells)]
+    n_cells = responses.shape[-1]
+    results = dict()
+    for name, (start_idx, end_idx) in segments.items():
+        stim_seg = stimuli[:, start_idx:end_idx]
+        resp_seg = responses[:, start_idx:end_idx]
         if sta_type == 'revcor':
-            sta_trial, _ = pyret.filtertools.revcorr(stim_trial, resp_trial, 0, filter_len)
-            sta_trial = np.flip(sta_trial, axis=0)
+            # Equivalent to summing pyret.filtertools.revcorr over trials for each cell
+            windows = np.lib.stride_tricks.sliding_window_view(stim_seg, filter_len, axis=1)
+            sta = np.einsum('rtj,rtk->kj', windows, resp_seg[:, filter_len-1:])
+            sta = np.flip(sta, axis=1)
         elif sta_type == 'fourier':
-            sta_trial = fourier_sta(stim_trial, resp_trial, filter_len, offset)
-        sta += sta_trial
-    sta -= sta.mean()
-    stimulus = np.concatenate(stimulus)
-    resp = np.concatenate(resp)
-    normed_sta = normalize_filter2(sta, stimulus)
-    
-    filtered_stim = pyret.filtertools.linear_response(normed_sta, stimulus)
-    #nonlinearity = Binterp(10)
-    nonlinearity = Sigmoid(peak=100.)
-    nonlinearity.fit(filtered_stim[filter_len:], resp[filter_len:], maxfev=50000)
+            sta = sum(fourier_sta(s, r, filter_len, offset) for s,r in zip(stim_seg, resp_seg))
+        sta = sta - sta.mean(1, keepdims=True)
+        stimulus = stim_seg.reshape(-1)
+        resp = resp_seg.reshape(-1, n_cells).T
+        normed_sta = batch_normalize_filter2(sta, stimulus)
+
+        filtered_stim = batch_linear_response(normed_sta, stimulus)
+        params = batch_sigmoid_fit(filtered_stim[:, filter_len:], resp[:, filter_len:], init_params=(0., 100., 1., 0.))
+        x = np.linspace(filtered_stim.min(1), filtered_stim.max(1), 50, axis=1)
+        nonlinear_prediction = sigmoid(x, *params.T[..., None])
+        gain = batch_slope_statistic(filtered_stim[:, filter_len:], resp[:, filter_len:])
+
+        normed_sta = normed_sta / 0.01
+        amps = abs(np.fft.rfft(normed_sta, axis=1))
+        fs = np.fft.rfftfreq(filter_len, 0.01)
+        mean_freq = (fs * amps).sum(1) / amps.sum(1)
+        results[name] = {'sta': normed_sta, 'x': x, 'nonlinearity': nonlinear_prediction, 'gain': gain,
+                         'mean_freq': mean_freq, 'offset': nonlinear_prediction.mean(1)}
+    return results
 
-    x = np.linspace(np.min(filtered_stim), np.max(filtered_stim), 50)
-    nonlinear_prediction = nonlinearity.predict(x)
-    
-    normed_sta = normed_sta / 0.01
-    
-    return normed_sta, x, nonlinear_prediction
+def LN_model(stimuli, responses, contrast, cell, start_idx, end_idx, filter_len=100, sta_type='revcor', offset=10):
+    ln = LN_segments(stimuli, responses, {'seg': (start_idx, end_idx)}, [cell], filter_len, sta_type, offset)['seg']
+    return ln['sta'][0], ln['x'][0], ln['nonlinearity'][0]
 
 def LN_statistics(stimuli, responses, contrast, cell, start_idx, end_idx, filter_len=100):
-    sta = 0
-    stimulus = []
-    resp = []
-    for trial in range(len(stimuli)):
-        stim_trial = stimuli[trial][start_idx:end_idx]
-        resp_trial = responses[trial][start_idx:end_idx, cell]
-        stimulus.append(stim_trial)
-        resp.append(resp_trial)
-        sta_trial, _ = pyret.filtertools.revcorr(stim_trial, resp_trial, 0, filter_len)
-        sta_trial = np.flip(sta_trial, axis=0)
-        sta += sta_trial
-    sta -= sta.mean()
-    stimulus = np.concatenate(stimulus)
-    resp = np.concatenate(resp)
-    normed_sta = normalize_filter2(sta, stimulus)
-    
-    filtered_stim = pyret.filtertools.linear_response(normed_sta, stimulus)
-    normed_sta = normed_sta / 0.01
-    gain = slope_statistic(filtered_stim[filter_len:], resp[filter_len:])
-    
-    nonlinearity = Sigmoid(peak=100.)
-    nonlinearity.fit(filtered_stim[filter_len:], resp[filter_len:], maxfev=50000)
-    x = np.linspace(np.min(filtered_stim), np.max(filtered_stim), 50)
-    nonlinear_prediction = nonlinearity.predict(x)
-    offset = nonlinear_prediction.mean()
-    
-    amps = abs(np.fft.rfft(normed_sta))
-    fs = np.fft.rfftfreq(len(normed_sta), 0.01)
-    mean_freq = sum([fs * amps for fs,amps in zip(fs, amps)])/sum(amps)
-    
-    return gain, mean_freq, offset
+    ln = LN_segments(stimuli, responses, {'seg': (start_idx, end_idx)}, [cell], filter_len)['seg']
+    gain = None if np.isnan(ln['gain'][0]) else ln['gain'][0]
+    return gain, ln['mean_freq'][0], ln['offset'][0]
 
 def LN_model_fourier(stimuli, responses, contrast, cell, start_idx, end_idx, filter_len=100, offset=10):
     stimulus = []
@@ -382,84 +381,125 @@ def LN_model_fourier(stimuli, responses, contrast, cell, start_idx, end_idx, fil
     
     return normed_sta, x, nonlinear_prediction
 
-def stimulus_importance_rnn(model, X, gc_idx=None, alpha_steps=5, 
-                            seq_len=8, device=torch.device('cuda:1')):
-    
-    requires_grad(model, False) # Model gradient unnecessary for integrated gradient
-    prev_grad_state = torch.is_grad_enabled() # Save current grad calculation state
-    torch.set_grad_enabled(True) # Enable grad calculations
-    
+def stimulus_importance_rnn(model, X, gc_idx=None, alpha_steps=5, seq_len=8, batch_size=64,
+                            hs_mode='single', device=torch.device('cuda:1')):
+    """
+    Integrated gradients of the summed ganglion activity over windows of seq_len
+    stimulus samples, starting from the hidden state of the model at each window.
+    Windows and alpha steps are run together as lanes of a single recurrent pass.
+
+    model - torch Module
+    X - ndarray or FloatTensor (T,D,H,W)
+    gc_idx - int or list of ints or None
+        if None, uses all cells
+    alpha_steps - int
+        integration steps
+    seq_len - int
+        length of the windows
+    batch_size - int
+        number of windows run together. Each window uses alpha_steps lanes
+    hs_mode - str
+        hidden state mode of the model. See kinetic.utils.get_hs
+
+    returns:
+        intg_grad - ndarray (seq_len*D,)
+            root mean squared integrated gradient of each frame of the windows
+    """
     if gc_idx is None:
         gc_idx = list(range(model.n_units))
-    intg_grad = torch.zeros(seq_len, *model.image_shape)
-    curr_hs = get_hs(model, 1, device)
     model = model.to(device)
+    X = torch.as_tensor(X).float()
+    n_windows = len(X) - seq_len
+    alphas = torch.linspace(0,1,alpha_steps).to(device)
+    intg_grad = torch.zeros(seq_len, *X.shape[1:])
+
+    grad_states = [p.requires_grad for p in model.parameters()]
+    requires_grad(model, False) # Model gradient unnecessary for integrated gradient
+    prev_grad_state = torch.is_grad_enabled() # Save current grad calculation state
+    torch.set_grad_enabled(True) # Enable grad calculations
+    training = model.training
     model.eval()
-    X = torch.FloatTensor(X)
-    X.requires_grad = True
-    idxs = torch.arange(len(X)).long()
-    for start_idx in range(0, len(X) - seq_len):
-        linspace = torch.linspace(0,1,alpha_steps)
-        idx = idxs[start_idx: start_idx + seq_len]
-        with torch.no_grad():
-            out, next_hs = model(X[start_idx][None,:,:,:].to(device), curr_hs)
-        curr_intg_grad = torch.zeros(seq_len, *model.image_shape)
-        for alpha in linspace:
-            x = X[idx].to(device) * alpha
-            outs = inspect_rnn(model, curr_hs, x)[:,gc_idx]
-            grad = torch.autograd.grad(outs.sum(), x)[0]
-            grad = grad.detach().cpu().reshape(*intg_grad.shape)
-            act = X[idx].detach().cpu()
-            curr_intg_grad += grad*act
-        intg_grad += torch.mul(curr_intg_grad, curr_intg_grad) / (len(X) - seq_len)
-        curr_hs = next_hs
-            
-    requires_grad(model, True)
-    torch.set_grad_enabled(prev_grad_state)
-    
-    intg_grad = intg_grad.view(seq_len * model.image_shape[0], *model.image_shape[1:])
+    try:
+        hs = get_hs(model, 1, device, mode=hs_mode)
+        for start in range(0, n_windows, batch_size):
+            starts = range(start, min(start+batch_size, n_windows))
+            states = []
+            with torch.no_grad():
+                for i in starts:
+                    states.append(clone_hs(hs))
+                    _, hs = model(X[i:i+1].to(device), hs)
+            # Lanes are ordered alpha major
+            lane_hs = cat_hs([states[j] for _ in alphas for j in range(len(starts))])
+            windows = torch.stack([X[i:i+seq_len] for i in starts], dim=1).to(device)
+            xs = torch.stack([alpha_path(w, alphas) for w in windows]).requires_grad_(True)
+            outs = 0
+            for x in xs:
+                out, lane_hs = model(x, lane_hs)
+                outs = outs + out[:,gc_idx].sum()
+            grad = torch.autograd.grad(outs, xs)[0]
+            grad = grad.reshape(seq_len, len(alphas), *windows.shape[1:]).sum(1)
+            curr_intg_grad = (grad*windows).detach().cpu()
+            intg_grad += (curr_intg_grad**2).sum(1) / n_windows
+    finally:
+        for p, state in zip(model.parameters(), grad_states):
+            p.requires_grad = state
+        torch.set_grad_enabled(prev_grad_state)
+        model.train(training)
+    
+    intg_grad = intg_grad.view(seq_len * X.shape[1], *X.shape[2:])
     intg_grad = torch.mean(intg_grad, dim=(1,2))
     intg_grad = torch.sqrt(intg_grad)
     intg_grad = intg_grad.data.cpu().numpy()
     return intg_grad
 
 def rev_sta(stim, resp, filter_len = 100):
-
-    sta, _ = pyret.filtertools.revcorr(stim, resp, 0, filter_len)
-    sta = sta / resp.sum() * 100
-    sta = np.flip(sta, axis=0)
-    sta -= sta.mean()
-    normed_sta, _, _ = normalize_filter(sta, stim, stim.std())
-    
-    return normed_sta
+    """
+    stim - ndarray (T, ...)
+    resp - ndarray (T,) or (T, K)
+        the filters of all K units are reverse correlated in a single pass
+    """
+    squeeze = resp.ndim == 1
+    stas, _ = batch_revcorr(stim, resp, 0, filter_len)
+    if squeeze:
+        stas, resp = stas[None], resp[:,None]
+    stas = stas / resp.sum(0).reshape(-1, *[1]*(stas.ndim-1)) * 100
+    stas = np.flip(stas, axis=1)
+    stas = stas - stas.mean(axis=tuple(range(1, stas.ndim)), keepdims=True)
+    normed_stas = np.stack([normalize_filter(sta, stim, stim.std())[0] for sta in stas])
+    if squeeze:
+        return normed_stas[0]
+    return normed_stas
 
 def fourier_sta(x, y, filter_len=100, offset=10):
-    
+    """
+    x - ndarray (T,)
+    y - ndarray (T,) or (T, K)
+        the filters of all K units are estimated together
+    """
     N = x.shape[0]
     
-    num_pers = np.int(np.floor((N - filter_len)/offset))
+    num_pers = int(np.floor((N - filter_len)/offset))
 
-    cross_xy = np.zeros(filter_len)
-    denom = np.zeros(filter_len)
+    # All periods are transformed at once
+    idxs = offset*np.arange(num_pers)[:,None] + np.arange(filter_len)
+    fft_x = np.fft.fft(x[idxs], axis=1)
+    fft_y = np.fft.fft(y[idxs], axis=1)
+    if y.ndim == 1:
+        fft_y = fft_y[..., None]
+    auto_x = np.abs(fft_x)**2
+    auto_y = np.abs(fft_y)**2
 
-    for i in range(num_pers):
-        x_per = x[i*offset:i*offset + filter_len]
-        y_per = y[i*offset:i*offset + filter_len]
-
-        auto_x = np.abs(np.fft.fft(x_per))**2
-        auto_y = np.abs(np.fft.fft(y_per))**2
-
-        cross_xy = cross_xy + np.conjugate(np.fft.fft(x_per)) * np.fft.fft(y_per)
-        denom = denom + auto_x + np.mean(auto_y)*10
-        #denom = denom + auto_x
+    cross_xy = (np.conjugate(fft_x)[..., None] * fft_y).sum(0)
+    denom = auto_x.sum(0)[:, None] + auto_y.mean(1).sum(0)*10
 
     fft_f = cross_xy / denom
-    f = np.real(np.fft.ifft(fft_f))
+    fs = np.real(np.fft.ifft(fft_f, axis=0)).T
     
-    f -= f.mean()
-    normed_f, _, _ = normalize_filter(f, x, x.std())
-
-    return normed_f
+    fs -= fs.mean(1, keepdims=True)
+    normed_fs = np.stack([normalize_filter(f, x, x.std())[0] for f in fs])
+    if y.ndim == 1:
+        return normed_fs[0]
+    return normed_fs
 
 def performance(model, device, cfg):
     
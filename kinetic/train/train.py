@@ -1,5 +1,7 @@
 import os
+import json
 import argparse
+import itertools
 import torch
 import torch.nn as nn
 from torch.utils.data.dataloader import DataLoader
@@ -11,6 +13,7 @@ from kinetic.evaluation import pearsonr_eval
 from kinetic.utils import *
 import kinetic.models as models
 from kinetic.config import get_custom_cfg
+from torchdeepretina.training import SuccessiveHalving
 
 parser = argparse.ArgumentParser()
 parser.add_argument('--gpu', type=int, required=True)
@@ -27,8 +30,14 @@ def train(cfg):
     
     device = torch.device('cuda:'+str(opt.gpu))
     
+    data_kwargs = dict(cfg.Data)
+    train_dataset = MyDataset(stim_sec='train', **data_kwargs)
+    
     model_func = getattr(models, cfg.Model.name)
     model_kwargs = dict(cfg.Model)
+    # The factorized readout starts its masks at the receptive field centers of the data
+    if model_kwargs['centers'] is None:
+        model_kwargs['centers'] = train_dataset.centers
     model = model_func(**model_kwargs).to(device)
     start_epoch = 0
     
@@ -40,17 +49,17 @@ def train(cfg):
     optimizer = torch.optim.Adam(model.parameters(), lr=cfg.Optimize.lr, 
                                  weight_decay=cfg.Optimize.l2)
     
+    scheduler_kwargs = dict(cfg.Scheduler)
+    scheduler = ReduceLROnPlateau(optimizer, **scheduler_kwargs)
+    
     if cfg.Model.checkpoint != '':
         checkpoint = torch.load(cfg.Model.checkpoint, map_location=device)
         model.load_state_dict(checkpoint['model_state_dict'])
         start_epoch = checkpoint['epoch'] + 1
         optimizer.load_state_dict(checkpoint['optimizer_state_dict'])
-        
-    scheduler_kwargs = dict(cfg.Scheduler)
-    scheduler = ReduceLROnPlateau(optimizer, **scheduler_kwargs)
+        if 'scheduler_state_dict' in checkpoint:
+            scheduler.load_state_dict(checkpoint['scheduler_state_dict'])
     
-    data_kwargs = dict(cfg.Data)
-    train_dataset = MyDataset(stim_sec='train', **data_kwargs)
     batch_sampler = BatchRnnSampler(length=len(train_dataset), batch_size=cfg.Data.batch_size,
                                     seq_len=cfg.Data.trunc_int)
     train_data = DataLoader(dataset=train_dataset, batch_sampler=batch_sampler)
@@ -86,7 +95,8 @@ def train(cfg):
         
         update_eval_history(cfg, epoch, pearson, epoch_loss)
         
-        if epoch%cfg.save_intvl == 0:
+        # The last epoch is always saved so that the training can be resumed
+        if epoch%cfg.save_intvl == 0 or epoch == start_epoch + cfg.epoch - 1:
 
             save_path = os.path.join(cfg.save_path, cfg.exp_id, 
                                      'epoch_{:03d}_loss_{:.2f}_pearson_{:.4f}'
@@ -95,9 +105,44 @@ def train(cfg):
             torch.save({'epoch': epoch,
                         'model_state_dict': model.state_dict(),
                         'optimizer_state_dict': optimizer.state_dict(),
+                        'scheduler_state_dict': scheduler.state_dict(),
                         'loss': epoch_loss}, save_path)
+    return pearson, save_path
+
+def asha_search(cfg):
+    """
+    Searches the grid of cfg.Search.keys and cfg.Search.values with
+    asynchronous successive halving up to cfg.epoch epochs, ranking the
+    configurations by their validation pearson correlation. Promoted
+    configurations resume from the last checkpoint of their previous rung.
+    """
+    configs = []
+    for values in itertools.product(*cfg.Search.values):
+        config = cfg.clone()
+        config.merge_from_list([x for key_val in zip(cfg.Search.keys, values) for x in key_val])
+        config.exp_id = cfg.exp_id + '_' + str(len(configs))
+        configs.append(config)
+    scheduler = SuccessiveHalving(len(configs), cfg.epoch, min_epochs=cfg.Search.min_epochs, eta=cfg.Search.eta)
+    print('successive halving budgets:', scheduler.budgets)
+    checkpoints = {}
+    history = []
+    while not scheduler.finished():
+        idx, rung = scheduler.next_job()
+        config = configs[idx].clone()
+        config.epoch = scheduler.budgets[rung] - (scheduler.budgets[rung-1] if rung > 0 else 0)
+        if rung > 0:
+            config.Model.checkpoint = checkpoints[idx]
+        pearson, checkpoints[idx] = train(config)
+        scheduler.report(idx, rung, float(pearson))
+        history.append({'exp_id': config.exp_id, 'rung': rung, 'epochs': scheduler.budgets[rung],
+                        'pearson': float(pearson), 'checkpoint': checkpoints[idx]})
+        with open(os.path.join(cfg.save_path, cfg.exp_id + '_asha.json'), 'w') as f:
+            json.dump(history, f)
     
 if __name__ == "__main__":
     cfg = get_custom_cfg(opt.hyper)
     print(cfg)
-    train(cfg)
\ No newline at end of file
+    if cfg.Search.asha:
+        asha_search(cfg)
+    else:
+        train(cfg)
\ No newline at end of file
@@ -5,15 +5,14 @@ import torch
 import torch.nn as nn
 import matplotlib.pyplot as plt
 from scipy import signal
-from collections import deque
 import pyret.filtertools as ft
 from pyret.stimulustools import slicestim
 from pyret.utils import flat2d
 from pyret.nonlinearities import Binterp, Sigmoid
 from kinetic.models import *
-from torchdeepretina.intracellular import load_interneuron_data, max_correlation
+from torchdeepretina.intracellular import load_interneuron_data, max_correlation, CorrelationAccumulator, streaming_correlations
 import torchdeepretina.stimuli as tdrstim
-from kinetic.custom_modules import Weighted_Poisson_MSE
+from kinetic.custom_modules import Weighted_Poisson_MSE, RingBuffer
 
 def get_hs(model, batch_size, device, I20=None, mode='single'):
     if mode == 'single':
@@ -27,9 +26,7 @@ def get_hs(model, batch_size, device, I20=None, mode='single'):
         hs[0][:,0] = 1
         if isinstance(I20, np.ndarray):
             hs[0][:,3] = torch.from_numpy(I20)[:,None].to(device)
-        hs.append(deque([],maxlen=model.seq_len))
-        for i in range(model.seq_len):
-            hs[1].append(torch.zeros(batch_size, *model.h_shapes[1]).to(device))
+        hs.append(RingBuffer(torch.zeros(batch_size, model.seq_len, *model.h_shapes[1]).to(device)))
     elif mode == 'double':
         hs1 = torch.zeros(batch_size, *model.h_shapes).to(device)
         hs1[:,0] = 1
@@ -53,7 +50,7 @@ def detach_hs(hs, mode='single', seq_len=None):
     elif mode == 'multiple':
         hs_new = []
         hs_new.append(hs[0].detach())
-        hs_new.append(deque([h.detach() for h in hs[1]], seq_len))
+        hs_new.append(hs[1].detach())
     elif mode == 'double':
         hs_new = (hs[0].detach(), hs[1].detach())
     return hs_new
@@ -243,7 +240,7 @@ def temporal_frequency_normalized_loss(y_pred, y_targ, loss_fn, device, cut_off=
     
     return loss
     
-def interneuron_correlation_bipolar(model, root_path, files, stim_keys, length, device):
+def interneuron_correlation_bipolar(model, root_path, files, stim_keys, length, device, batch_size=500):
     
     stim_dict, mem_pot_dict, _ = load_interneuron_data(root_path, files, 40, stim_keys)
     intr_cors = {
@@ -256,17 +253,18 @@ def interneuron_correlation_bipolar(model, root_path, files, stim_keys, length,
         for stim_type in stim_dict[cell_file].keys():
             print(cell_file, stim_type)
             stim = tdrstim.spatial_pad(stim_dict[cell_file][stim_type], model.img_shape[1])
-            stim = tdrstim.rolling_window(stim, model.img_shape[0])[:length].astype(np.float32)
-
-            with torch.no_grad():
-                stim_tensor = torch.from_numpy(stim).to(device)
-                resp = model.bipolar[0](stim_tensor)
-                resp = resp.detach().cpu().numpy()
+            stim = tdrstim.rolling_window(stim, model.img_shape[0])[:length]
             pots = mem_pot_dict[cell_file][stim_type][:, :length]
+            acc = CorrelationAccumulator(pots, chunk_size=batch_size)
+            with torch.no_grad():
+                for i in range(0, len(stim), batch_size):
+                    stim_tensor = torch.from_numpy(stim[i:i+batch_size].astype(np.float32)).to(device)
+                    acc.update(model.bipolar[0](stim_tensor))
+            cors = acc.correlations()
             rnge = range(len(pots))
 
             for cell_idx in rnge:
-                r = max_correlation(pots[cell_idx], resp)
+                r = np.max(cors[cell_idx])
                 intr_cors['stim_type'].append(stim_type)
                 cell_type = cell_file.split("/")[-1].split("_")[0][:-1]
                 intr_cors['cell_type'].append(cell_type) # amacrine or bipolar
@@ -286,20 +284,17 @@ def interneuron_correlation_occupancy(model, root_path, files, stim_keys, length
         for stim_type in stim_dict[cell_file].keys():
             print(cell_file, stim_type)
             stim = tdrstim.spatial_pad(stim_dict[cell_file][stim_type], model.img_shape[1])
-            stim = tdrstim.rolling_window(stim, model.img_shape[0])[:length].astype(np.float32)
-
-            with torch.no_grad():
-                stim_tensor = torch.from_numpy(stim).to(device)
-                hs = get_hs(model, 1, device, I20, 'multiple')
-                layer_outs = inspect_rnn(model, stim_tensor, hs, ['kinetics'])
-                kinetics_history = [h[1].detach().cpu().numpy().mean(-1) for h in layer_outs['kinetics']]
-                kinetics_history = np.concatenate(kinetics_history, axis=0)
-                resp = kinetics_history[:, 1]
+            stim = stim[:length+model.img_shape[0]]
             pots = mem_pot_dict[cell_file][stim_type][:, :length]
+            hs = get_hs(model, 1, device, I20, 'multiple')
+            # Mean occupancy of the active state for each channel
+            transforms = {'kinetics': lambda out: out[1].mean(-1)[:, 1]}
+            cors = streaming_correlations(model, stim, pots, ['kinetics'], hs=hs, 
+                                            transforms=transforms, device=device)['kinetics']
             rnge = range(len(pots))
 
             for cell_idx in rnge:
-                r = max_correlation(pots[cell_idx], resp)
+                r = np.max(cors[cell_idx])
                 intr_cors['stim_type'].append(stim_type)
                 cell_type = cell_file.split("/")[-1].split("_")[0][:-1]
                 intr_cors['cell_type'].append(cell_type) # amacrine or bipolar
@@ -435,4 +430,124 @@ def slope_statistic(filtered_input, output, thresh=1):
     pos_x = [x for idx, x in enumerate(filtered_input) if output[idx] > thresh]
     pos_y = [x for x in output if x > thresh]
     p = polyfit(pos_x, pos_y, 1)
-    return p[1]
\ No newline at end of file
+    return p[1]
+
+
+def batch_linear_response(filts, stim):
+    '''
+    The responses of many one dimensional filters to the same stimulus. Gives
+    the same result as ft.linear_response applied to each filter.
+
+    filts - ndarray (K, h)
+    stim - ndarray (T,)
+
+    returns ndarray (K, T)
+    '''
+    h = filts.shape[1]
+    padded = np.concatenate((np.zeros(h-1), stim))
+    # slices[t, x] is stim[t-x]
+    slices = np.lib.stride_tricks.sliding_window_view(padded, h)[:, ::-1]
+    return filts @ slices.T
+
+def batch_normalize_filter2(stas, stimulus):
+    '''Same as normalize_filter2 for each of the filters stas (K, h).'''
+    theta = stimulus.std() / batch_linear_response(stas, stimulus).std(1)
+    return theta[:,None] * stas
+
+def batch_slope_statistic(filtered_input, output, thresh=1):
+    '''
+    Same as slope_statistic for each row of filtered_input and output (K, N),
+    computed with masked least squares. Rows whose output never exceeds thresh
+    are nan.
+    '''
+    mask = output > thresh
+    n = mask.sum(1)
+    x = np.where(mask, filtered_input, 0)
+    y = np.where(mask, output, 0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        cov = (x*y).sum(1) - x.sum(1)*y.sum(1)/n
+        var = (x**2).sum(1) - x.sum(1)**2/n
+        slopes = cov/var
+    slopes[n == 0] = np.nan
+    return slopes
+
+def sigmoid(x, baseline, peak, slope, threshold):
+    '''The nonlinearity of pyret.nonlinearities.Sigmoid.'''
+    return baseline + peak / (1 + np.exp(np.clip(-slope * (x - threshold), -500, 500)))
+
+def batch_sigmoid_fit(x, y, init_params=(0., 1., 1., 0.), max_iters=1000, xtol=1e-8, gtol=1e-10):
+    '''
+    Least squares fits of a sigmoid to each row of x and y (K, N) with a
+    batched Levenberg-Marquardt iteration. Serves the same purpose as
+    Sigmoid().fit for each row, without a separate optimizer call per row.
+
+    As in MINPACK, the damping starts large and scales with the largest
+    column norms of the jacobian seen so far, which keeps the first steps
+    from jumping into the flat, saturated regions of the sigmoid. The
+    damping follows the gain ratio of each step (Nielsen's update). A row
+    stops when an accepted step is smaller than xtol relative to the
+    parameters, when the residuals are orthogonal to the jacobian within
+    gtol, or when no step reduces its cost.
+
+    init_params - tuple
+        initial (baseline, peak, slope, threshold) of every row
+    max_iters - int
+        largest number of iterations
+    xtol - float
+        relative step size at which a row is converged
+    gtol - float
+        largest cosine between the residuals and a jacobian column at which
+        a row is converged
+
+    returns ndarray (K, 4)
+        the fitted (baseline, peak, slope, threshold) of each row
+    '''
+    params = np.tile(np.asarray(init_params, dtype=np.float64), (len(x), 1))
+    def residuals(p, rows):
+        return y[rows] - sigmoid(x[rows], *[p[:,i:i+1] for i in range(4)])
+    res = residuals(params, slice(None))
+    cost = (res**2).sum(1)
+    damping = np.full(len(x), 100.)
+    growth = np.full(len(x), 2.)
+    scale = np.zeros((len(x), 4))
+    active = np.ones(len(x), dtype=bool)
+    for _ in range(max_iters):
+        # Only the rows that have not stopped are updated
+        idx = np.flatnonzero(active)
+        b, a, g, t = [params[idx,i:i+1] for i in range(4)]
+        s = sigmoid(x[idx], 0, 1, g, t)
+        ds = a*s*(1-s)
+        jac = np.stack([np.ones_like(s), s, ds*(x[idx]-t), -ds*g], axis=-1) # (K, N, 4)
+        jtj = np.einsum('kni,knj->kij', jac, jac)
+        jtr = np.einsum('kni,kn->ki', jac, res[idx])
+        diag = np.maximum(np.diagonal(jtj, axis1=1, axis2=2), 1e-12)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            cosine = np.nan_to_num(np.abs(jtr) / np.sqrt(diag*cost[idx,None]))
+        converged = cosine.max(1) <= gtol
+        active[idx[converged]] = False
+        idx, jtj, jtr, diag = idx[~converged], jtj[~converged], jtr[~converged], diag[~converged]
+        if len(idx) == 0:
+            break
+        scale[idx] = np.maximum(scale[idx], diag)
+        lhs = jtj + damping[idx,None,None]*(scale[idx,:,None]*np.eye(4))
+        step = np.linalg.solve(lhs, jtr[...,None])[...,0]
+
+        new_params = params[idx] + step
+        new_res = residuals(new_params, idx)
+        new_cost = (new_res**2).sum(1)
+        better = new_cost < cost[idx]
+        # Ratio of the actual to the predicted cost reduction
+        predicted = (step*(damping[idx,None]*scale[idx]*step + jtr)).sum(1)
+        gain = (cost[idx] - new_cost) / np.maximum(predicted, 1e-300)
+        small_step = np.linalg.norm(step, axis=1) <= xtol*(np.linalg.norm(params[idx], axis=1) + xtol)
+        params[idx[better]] = new_params[better]
+        res[idx[better]] = new_res[better]
+        cost[idx[better]] = new_cost[better]
+        shrink = np.maximum(1/3, 1-(2*np.minimum(gain, 1)-1)**3)
+        damping[idx] = np.where(better, damping[idx]*shrink, damping[idx]*growth[idx])
+        # Capped so that the damping reaches the stopping value without overflowing
+        growth[idx] = np.where(better, 2., np.minimum(growth[idx]*2, 1e4))
+        active[idx] = ~(better & small_step) & (damping[idx] < 1e16)
+        if not active.any():
+            break
+    return params
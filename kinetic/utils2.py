@@ -1,7 +1,6 @@
 import numpy as np
 import scipy
 import copy
-from collections import deque
 import torch
 import torch.nn as nn
 import subprocess
@@ -11,7 +10,10 @@ import torchdeepretina.stimuli as tdrstim
 from torchdeepretina.physiology import Physio
 from tqdm import tqdm
 import pyret.filtertools as ft
-from kinetic.utils import get_hs
+from kinetic.utils import get_hs, detach_hs
+from torchdeepretina.utils import batch_revcorr, unit_output, stim_jacobian
+from torchdeepretina.utils import integrated_gradient, stimulus_importance, inspect_rnn, ActivationRecorder
+from torchdeepretina.utils import batch_compute_model_response, requires_grad
 
 def rolling_window(array, window, time_axis=0):
     """
@@ -87,129 +89,6 @@ def get_hook(layer_dict, key, to_numpy=True, to_cpu=False):
             layer_dict[key] = out
     return hook
 
-def integrated_gradient(model, X, layer='sequential.2', gc_idx=None, alpha_steps=5,
-                                                    batch_size=500, y=None, lossfxn=None,
-                                                    to_numpy=False, verbose=False):
-    """
-    Returns the integrated gradient for a particular stimulus at the arged layer.
-    Inputs:
-        model: PyTorch Deep Retina models
-        X: Input stimuli ndarray or torch FloatTensor (T,D,H,W)
-        layer: str layer name
-        gc_idx: ganglion cell of interest
-            if None, uses all cells
-        alpha_steps: int, integration steps
-        batch_size: step size when performing computations on GPU
-        y: torch FloatTensor or ndarray (T,N)
-            if None, ignored
-        lossfxn: some differentiable function
-            if None, ignored
-    Outputs:
-        intg_grad: Integrated Gradients ndarray or FloatTensor (T, C, H1, W1)
-        gc_activs: Activation of the final layer ndarray or FloatTensor (T,N)
-    """
-    # Handle Gradient Settings
-    requires_grad(model, False) # Model gradient unnecessary for integrated gradient
-    prev_grad_state = torch.is_grad_enabled() # Save current grad calculation state
-    torch.set_grad_enabled(True) # Enable grad calculations
-
-    layer_idx = 0
-    for i,seq in enumerate(model.sequential):
-        if layer == "sequential."+str(i):
-            break
-        if isinstance(seq, nn.ReLU):
-            layer_idx += 1
-    intg_grad = torch.zeros(len(X), model.chans[layer_idx], *model.shapes[layer_idx])
-    gc_activs = None
-    model.to(DEVICE)
-    if gc_idx is None:
-        gc_idx = list(range(model.n_units))
-    if batch_size is None:
-        batch_size = len(X)
-    X = torch.FloatTensor(X)
-    X.requires_grad = True
-    idxs = torch.arange(len(X)).long()
-    for batch in range(0, len(X), batch_size):
-        prev_response = None
-        linspace = torch.linspace(0,1,alpha_steps)
-        if verbose:
-            print("Calculating for batch {}/{}".format(batch, len(X)))
-            linspace = tqdm(linspace)
-        idx = idxs[batch:batch+batch_size]
-        for alpha in linspace:
-            x = alpha*X[idx]
-            # Response is dict of activations. response[layer] has shape intg_grad.shape
-            response = inspect(model, x, insp_keys=[layer], batch_size=None,
-                                                    to_numpy=False, to_cpu=False,
-                                                    verbose=False)
-            if prev_response is not None:
-                ins = response[layer]
-                outs = response['outputs'][:,gc_idx]
-                if lossfxn is not None and y is not None:
-                    truth = y[idx,gc_idx]
-                    outs = lossfxn(outs,truth)
-                grad = torch.autograd.grad(outs.sum(), ins)[0]
-                grad = grad.detach().cpu().reshape(len(grad), *intg_grad.shape[1:])
-                act = (response[layer].data.cpu()-prev_response[layer]).reshape(grad.shape)
-                intg_grad[idx] += grad*act
-                if alpha == 1:
-                    if gc_activs is None:
-                        if isinstance(gc_idx, int):
-                            gc_activs = torch.zeros(len(X))
-                        else:
-                            gc_activs = torch.zeros(len(X), len(gc_idx))
-                    gc_activs[idx] = response['outputs'][:,gc_idx].detach().cpu()
-            prev_response = {k:v.data.cpu() for k,v in response.items()}
-    del response
-    del grad
-    if len(gc_activs.shape) == 1:
-        gc_activs = gc_activs.unsqueeze(1) # Create new axis
-
-    # Return to previous gradient calculation state
-    requires_grad(model, True)
-    torch.set_grad_enabled(prev_grad_state) # return to previous grad calculation state
-    if to_numpy:
-        return intg_grad.data.cpu().numpy(), gc_activs.data.cpu().numpy()
-    return intg_grad, gc_activs
-
-def stimulus_importance(model, X, gc_idx=None, alpha_steps=5, batch_size=500, 
-                        to_numpy=False, verbose=False, device=torch.device('cuda:1')):
-    # Handle Gradient Settings
-    requires_grad(model, False) # Model gradient unnecessary for integrated gradient
-    prev_grad_state = torch.is_grad_enabled() # Save current grad calculation state
-    torch.set_grad_enabled(True) # Enable grad calculations
-
-    intg_grad = torch.zeros(len(X), *model.image_shape)
-    if gc_idx is None:
-        gc_idx = list(range(model.n_units))
-    if batch_size is None:
-        batch_size = len(X)
-    X = torch.FloatTensor(X)
-    X.requires_grad = True
-    idxs = torch.arange(len(X)).long()
-    for batch in range(0, len(X), batch_size):
-        linspace = torch.linspace(0,1,alpha_steps)
-        if verbose:
-            print("Calculating for batch {}/{}".format(batch, len(X)))
-            linspace = tqdm(linspace)
-        idx = idxs[batch:batch+batch_size]
-        for alpha in linspace:
-            x = alpha*X[idx]
-            response = inspect(model, x, insp_keys=[], batch_size=None, to_numpy=False, device=device)
-            outs = response['outputs'][:,gc_idx]
-            grad = torch.autograd.grad(outs.sum(), x)[0]
-            grad = grad.detach().cpu().reshape(len(grad), *intg_grad.shape[1:])
-            act = X[idx].detach().cpu()
-            intg_grad[idx] += grad*act
-    del response
-    del grad
-
-    requires_grad(model, True)
-    torch.set_grad_enabled(prev_grad_state) # return to previous grad calculation state
-    if to_numpy:
-        return intg_grad.data.cpu().numpy()
-    return intg_grad
-
 def inspect(model, X, insp_keys={}, batch_size=None, to_numpy=True, device=torch.device('cuda:1')):
     """
     Get the response from the argued layers in the model as np arrays. If model is on cpu,
@@ -220,14 +99,30 @@ def inspect(model, X, insp_keys={}, batch_size=None, to_numpy=True, device=torch
     X - ndarray (T,C,H,W)
     insp_keys - set of str
         name of layers activations to collect
+    batch_size - int or None
+        if None, ndarrays are recorded in batches of 500 and torch tensors
+        are computed in a single batch
     to_numpy - bool
-        if true, activations will all be ndarrays. Otherwise torch tensors
+        if true, activations will all be ndarrays recorded without gradients
+        (see ActivationRecorder). Otherwise torch tensors
     to_cpu - bool
         if true, torch tensors will be on the cpu.
         only effective if to_numpy is false.
 
     returns dict of np arrays or torch cpu tensors
     """
+    if to_numpy:
+        if batch_size is None:
+            batch_size = 500
+        if not next(model.parameters()).is_cuda:
+            device = torch.device('cpu')
+        recorder = ActivationRecorder(model, insp_keys, len(X))
+        with recorder, torch.no_grad():
+            for i in range(0, len(X), batch_size):
+                x = torch.as_tensor(X[i:i+batch_size]).float().to(device)
+                recorder.record('outputs', model(x))
+        return recorder.close()
+
     layer_outs = dict()
     handles = []
     if "all" in insp_keys:
@@ -275,149 +170,20 @@ def inspect(model, X, insp_keys={}, batch_size=None, to_numpy=True, device=torch
     del handles
     return layer_outs
 
-def inspect_rnn(model, X, hs, insp_keys=[]):
-
-    layer_outs = dict()
-    handles = []
-    for key, mod in model.named_modules():
-        if key in insp_keys:
-            hook = get_hook(layer_outs, key, to_numpy=True)
-            handle = mod.register_forward_hook(hook)
-            handles.append(handle)
-
-    resps = []
-    layer_outs_list = {key:[] for key in insp_keys}
-    with torch.no_grad():
-        for i in range(X.shape[0]):
-            resp, hs = model(X[i:i+1], hs)
-            resps.append(resp)
-            for k in layer_outs.keys():
-                layer_outs_list[k].append(layer_outs[k])
-    
-    layer_outs = {k:np.concatenate(v, axis=0) if isinstance(v[0], np.ndarray) else v for k,v in layer_outs_list.items()}
-    resp = torch.cat(resps, dim=0)
-    layer_outs['outputs'] = resp.detach().cpu().numpy()
-    
-    for i in range(len(handles)):
-        handles[i].remove()
-    del handles
-    
-    return layer_outs
-
-def batch_compute_model_response(stimulus, model, batch_size=500, recurrent=False, 
-                                insp_keys={'all'}, cust_h_init=False, verbose=False):
-    '''
-    Computes a model response in batches in pytorch. Returns a dict of lists 
-    where each list is the sequence of batch responses.     
-    Args:
-        stimulus: 3-d checkerboard stimulus in (time, space, space)
-        model: the model
-        batch_size: the size of the batch
-        recurrent: bool
-            use recurrent approach to calculating model response
-        insp_keys: set (or dict) with keys of layers to be inspected in Physio
-    '''
-    phys = Physio(model)
-    model_response = None
-    batch_size = 1 if recurrent else batch_size
-    n_loops, leftover = divmod(stimulus.shape[0], batch_size)
-    hs = None
-    if recurrent:
-        hs = [torch.zeros(1, *h_shape).to(DEVICE) for h_shape in model.h_shapes]
-        if cust_h_init:
-            hs[0][:,0] = 1
-    with torch.no_grad():
-        responses = []
-        rng = range(n_loops)
-        if verbose:
-            rng = tqdm(rng)
-        for i in rng:
-            stim = torch.FloatTensor(stimulus[i*batch_size:(i+1)*batch_size])
-            outs = phys.inspect(stim.to(DEVICE), hs=hs, insp_keys=insp_keys)
-            if type(outs) == type(tuple()):
-                outs, hs = outs[0].copy(), outs[1]
-            else:
-                outs = outs.copy()
-            for k in outs.keys():
-                if type(outs[k]) != type(np.array([])):
-                    outs[k] = outs[k].detach().cpu().numpy()
-            responses.append(outs)
-        if leftover > 0 and hs is None:
-            stim = torch.FloatTensor(stimulus[-leftover:])
-            outs = phys.inspect(stim.to(DEVICE), hs=hs, insp_keys=insp_keys).copy()
-            for k in outs.keys():
-                if type(outs[k]) != type(np.array([])):
-                    outs[k] = outs[k].detach().cpu().numpy()
-            responses.append(outs)
-        model_response = {}
-        for key in responses[0].keys():
-             model_response[key] = np.concatenate([x[key] for x in responses], axis=0)
-        del outs
-
-    # Get the last few samples
-    phys.remove_hooks()
-    phys.remove_refs()
-    del phys
-    return model_response
-
-def get_stim_grad(model, X, layer, cell_idx, batch_size=500, layer_shape=None, verbose=True, I20=None):
+def get_stim_grad(model, X, layer, cell_idx, batch_size=500, layer_shape=None, verbose=True, I20=None,
+                                                                                hs_mode='single'):
     """
     Gets the gradient of the model output at the specified layer and cell idx with respect
-    to the inputs (X). Returns a gradient array with the same shape as X.
+    to the inputs (X). Returns a gradient array with the same shape as X. Models with hidden
+    states run X as a single sequence and hold the hidden state fixed for each gradient.
     """
     if verbose:
         print("layer:", layer)
-    requires_grad(model, False)
-    device = next(model.parameters()).get_device()
-
-    if model.kinetic:
-        hs = get_hs(model, batch_size, device, I20)
-    elif model.recurrent:
-        batch_size = 1
-        hs = [torch.zeros(batch_size, *h_shape).to(device) for h_shape in model.h_shapes]
-
-    hook_outs = dict()
-    module = None
-    for name, modu in model.named_modules():
-        if name == layer:
-            if verbose:
-                print("hook attached to " + name)
-            module = modu
-            hook = get_hook(hook_outs,key=layer,to_numpy=False)
-            hook_handle = module.register_forward_hook(hook)
-
-    # Get gradient with respect to activations
-    model.eval()
-    X.requires_grad = True
-    n_loops = X.shape[0]//batch_size
-    rng = range(n_loops)
-    if verbose:
-        rng = tqdm(rng)
-    for i in rng:
-        idx = i*batch_size
-        x = X[idx:idx+batch_size]
-        x = x.to(device)
-        if model.kinetic:
-            _, hs = model(x, hs)
-            hs[0] = hs[0].detach()
-            hs[1] = deque([h.detach() for h in hs[1]], maxlen=model.seq_len)
-        elif model.recurrent:
-            _, hs = model(x, hs)
-            hs = [h.data for h in hs]
-        else:
-            _ = model(x)
-        # Outs are the activations at the argued layer and cell idx accross the batch
-        if type(cell_idx) == type(int()):
-            fx = hook_outs[layer][:,cell_idx]
-        elif len(cell_idx) == 1:
-            fx = hook_outs[layer][:,cell_idx[0]]
-        else:
-            fx = hook_outs[layer][:, cell_idx[0], cell_idx[1], cell_idx[2]]
-        fx = fx.mean()
-        fx.backward()
-    hook_handle.remove()
-    requires_grad(model, True)
-    return X.grad.data.cpu().numpy()
+    hs = None
+    if hasattr(model, 'h_shapes'):
+        hs = get_hs(model, 1, next(model.parameters()).device, I20, mode=hs_mode)
+    jacs, _ = stim_jacobian(model, X, layer, [cell_idx], hs=hs, chunk_size=batch_size, verbose=verbose)
+    return jacs[0]
 
 def compute_sta(model, contrast, layer, cell_index, layer_shape=None, verbose=True, I20=None):
     """
@@ -437,6 +203,108 @@ def compute_sta(model, contrast, layer, cell_index, layer_shape=None, verbose=Tr
     del X
     return sta
 
+def stream_sta(model, contrast, layer, cell_idx, n_samples=100000, chunk_size=1000, batch_size=500,
+                                n_lanes=None, seed=None, hs_mode='single', I20=None, verbose=True):
+    """
+    Computes the STA as the average of instantaneous receptive fields (gradient
+    of output with respect to input) without materializing the stimulus. White
+    noise is generated chunk by chunk and only a running sum of the input
+    gradients is kept, so memory does not grow with n_samples.
+
+    Models with hidden states are run on n_lanes independent noise streams
+    in parallel. The hidden state of each lane is carried over from window to
+    window and across chunks. It is detached after each step, as in
+    get_stim_grad, so each gradient only reaches the current window.
+
+    model - torch Module
+    contrast - float
+        the standard deviation of the white noise
+    layer - str
+        name of the module whose output is differentiated
+    cell_idx - int or sequence of ints
+        the channel index or the (chan, row, col) index of the unit in the layer output
+    n_samples - int
+        number of stimulus windows averaged over
+    chunk_size - int
+        number of noise frames generated at a time (in each lane)
+    batch_size - int
+        number of windows per forward pass for models without hidden states
+    n_lanes - int or None
+        number of noise streams for models with hidden states. Defaults to batch_size
+    seed - int or None
+        seed of the noise. The same seed and n_lanes give the same noise
+        regardless of chunk_size
+    hs_mode - str
+        hidden state mode of the model. See kinetic.utils.get_hs
+    I20 - ndarray or None
+        optional initial hidden state values. See kinetic.utils.get_hs
+
+    returns:
+        sta - ndarray (img_shape[0], img_shape[1], img_shape[2])
+    """
+    grad_states = [p.requires_grad for p in model.parameters()]
+    training = model.training
+    device = next(model.parameters()).device
+    recurrent = hasattr(model, 'h_shapes')
+    if not recurrent:
+        n_lanes = 1
+    elif n_lanes is None:
+        n_lanes = batch_size
+    nh = model.img_shape[0]
+    rand = np.random.RandomState(seed)
+
+    hook_outs = dict()
+    module = dict(model.named_modules())[layer]
+    hook_handle = module.register_forward_hook(get_hook(hook_outs, key=layer, to_numpy=False))
+    if verbose:
+        pbar = tqdm(total=n_samples)
+    try:
+        requires_grad(model, False)
+        model.eval()
+        if recurrent:
+            hs = get_hs(model, n_lanes, device, I20, mode=hs_mode)
+
+        sta = torch.zeros(model.img_shape, dtype=torch.float64, device=device)
+        frames = np.zeros((0, n_lanes, *model.img_shape[1:]), dtype=np.float32)
+        n = 0
+        while n < n_samples:
+            # Keep the last nh frames so windows continue across chunks
+            noise = contrast*rand.randn(chunk_size, n_lanes, *model.img_shape[1:])
+            frames = np.concatenate([frames[-nh:], noise.astype(np.float32)], axis=0)
+            if len(frames) <= nh:
+                continue
+            n_steps = int(np.ceil((n_samples-n)/n_lanes))
+            windows = rolling_window(frames, nh)[:n_steps] # (T, nh, n_lanes, H, W)
+            if recurrent:
+                for window in windows:
+                    x = torch.from_numpy(np.ascontiguousarray(window.swapaxes(0,1))).to(device)
+                    x.requires_grad = True
+                    _, hs = model(x, hs)
+                    hs = detach_hs(hs, hs_mode)
+                    unit_output(hook_outs[layer], cell_idx).sum().backward()
+                    sta += x.grad.sum(0)
+                    n += len(x)
+                    if verbose:
+                        pbar.update(len(x))
+            else:
+                for i in range(0, len(windows), batch_size):
+                    x = torch.from_numpy(np.ascontiguousarray(windows[i:i+batch_size,:,0])).to(device)
+                    x.requires_grad = True
+                    model(x)
+                    unit_output(hook_outs[layer], cell_idx).sum().backward()
+                    sta += x.grad.sum(0)
+                    n += len(x)
+                    if verbose:
+                        pbar.update(len(x))
+    finally:
+        if verbose:
+            pbar.close()
+        hook_handle.remove()
+        for p, state in zip(model.parameters(), grad_states):
+            p.requires_grad = state
+        model.train(training)
+    return (sta/n).cpu().numpy()
+
 def revcor_sta(model, layers=['sequential.0','sequential.6'], chans=[8,8], verbose=True, device=torch.device('cuda:1')):
     """
     Computes the sta using reverse correlation. Uses the central unit for computation
@@ -461,18 +329,13 @@ def revcor_sta(model, layers=['sequential.0','sequential.6'], chans=[8,8], verbo
         resp = response[layer]
         if len(resp.shape) == 2:
             if layer == "sequential.2":
-                resp = resp.reshape(len(resp), len(chan), *model.shapes[0])
+                resp = resp.reshape(len(resp), chan, *model.shapes[0])
             else:
-                resp = resp.reshape(len(resp), len(chan), *model.shapes[1])
+                resp = resp.reshape(len(resp), chan, *model.shapes[1])
         centers = np.array(resp.shape[2:])//2
-        for c in range(chan):
-            if len(centers) == 2:
-                sta,_ = ft.revcorr(noise, scipy.stats.zscore(resp[:, c, centers[0], centers[1]]),
-                                                             0, filter_size)
-            if len(centers) == 3:
-                sta,_ = ft.revcorr(noise, scipy.stats.zscore(resp[:, c, centers[0], centers[1], centers[2]]),
-                                                             0, filter_size)
-            stas[layer].append(sta)
+        resp = resp[(slice(None), slice(None), *centers)]
+        rcs,_ = batch_revcorr(noise, resp[:, :chan], 0, filter_size, zscore=True)
+        stas[layer] = list(rcs)
     return stas
 
 def revcor_sta_rnn(model, layers, device, I20=None):
@@ -498,14 +361,9 @@ def revcor_sta_rnn(model, layers, device, I20=None):
             else:
                 resp = resp.reshape(len(resp), chan, *model.shapes[1])
         centers = np.array(resp.shape[2:])//2
-        for c in range(chan):
-            if len(centers) == 2:
-                sta,_ = ft.revcorr(noise, scipy.stats.zscore(resp[:, c, centers[0], centers[1]]),
-                                                             0, filter_size)
-            if len(centers) == 3:
-                sta,_ = ft.revcorr(noise, scipy.stats.zscore(resp[:, c, centers[0], centers[1], centers[2]]),
-                                                             0, filter_size)
-            stas[layer].append(sta)
+        resp = resp[(slice(None), slice(None), *centers)]
+        rcs,_ = batch_revcorr(noise, resp[:, :chan], 0, filter_size, zscore=True)
+        stas[layer] = list(rcs)
     return stas
 
 def revcor_sta_ganglion(model, layers=['ganglion.0'], n_units=5,  verbose=True, device=torch.device('cuda:1')):
@@ -529,8 +387,6 @@ def revcor_sta_ganglion(model, layers=['ganglion.0'], n_units=5,  verbose=True,
     response = inspect(model, X, insp_keys=set(layers), batch_size=500, to_numpy=True, device=device)
     stas = {layer:[] for layer in layers}
     for layer in layers:
-        for cell in range(n_units):
-            resp = response[layer]
-            sta,_ = ft.revcorr(noise, scipy.stats.zscore(resp[:, cell]), 0, filter_size)
-            stas[layer].append(sta)
-    return stas
\ No newline at end of file
+        rcs,_ = batch_revcorr(noise, response[layer][:, :n_units], 0, filter_size, zscore=True)
+        stas[layer] = list(rcs)
+    return stas
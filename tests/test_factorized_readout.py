@@ -0,0 +1,38 @@
+import numpy as np
+import torch
+from kinetic.custom_modules import FactorizedReadout, ganglion_readout
+
+def make_readout(window, std):
+    torch.manual_seed(0)
+    readout = FactorizedReadout(4, (13, 11), 5, bias=True, centers=[[0,0],[12,10],[6,5],[3,9],[10,2]],
+                                                                            offset=0, window=window)
+    with torch.no_grad():
+        readout.log_std.fill_(np.log(std))
+        readout.mu.add_(0.3*torch.randn_like(readout.mu))
+        readout.bias.normal_()
+    return readout
+
+def test_sparse_matches_dense_when_std_exceeds_window():
+    x = torch.randn(8, 4*13*11)
+    for std in [0.5, 2., 10.]:
+        readout = make_readout(5, std)
+        readout.train()
+        dense = readout(x)
+        readout.eval()
+        sparse = readout(x)
+        assert torch.allclose(dense, sparse, atol=1e-5)
+
+def test_no_window_uses_full_field():
+    x = torch.randn(8, 4, 13, 11)
+    readout = make_readout(None, 10.)
+    readout.eval()
+    rows = torch.arange(13).float().expand(5, -1)
+    cols = torch.arange(11).float().expand(5, -1)
+    mask = readout.mask(rows, cols)
+    expected = torch.einsum('bchw,uhw,uc->bu', x, mask, readout.chan_weight) + readout.bias
+    assert torch.allclose(readout(x), expected, atol=1e-5)
+
+def test_dense_readout_is_linear():
+    readout = ganglion_readout(4, (13, 11), 5, (15, 11), bias=False)
+    assert isinstance(readout, torch.nn.Linear)
+    assert readout.in_features == 4*13*11
@@ -0,0 +1,37 @@
+import torch
+from kinetic.models import KineticsModelSen, KineticsModelSenConv
+from kinetic.linearize import steady_state
+
+def make_state(model, bs):
+    torch.manual_seed(1)
+    h = torch.rand(bs, *model.h_shapes)
+    h_inh = torch.rand(bs, model.h_shapes[0], 1, model.h_shapes[2])
+    return (h / h.sum(1, keepdim=True), h_inh / h_inh.sum(1, keepdim=True))
+
+def check_fused(model_cls, **kwargs):
+    torch.manual_seed(0)
+    model = model_cls('sen', chans=[3,2], img_shape=(6,20,20), ksizes=(5,3), n_units=4,
+                      ka_offset=True, ksr_gain=True, **kwargs)
+    model.eval()
+    x = torch.randn(5, 3, 6, 20, 20)
+    hs_unfused = hs_fused = make_state(model, 3)
+    with torch.no_grad():
+        for xt in x:
+            model.fused = False
+            out, hs_unfused = model(xt, hs_unfused)
+            model.fused = True
+            fused_out, hs_fused = model(xt, hs_fused)
+            assert torch.equal(out, fused_out)
+            assert all(torch.equal(a, b) for a, b in zip(hs_unfused, hs_fused))
+
+def test_fused_sen_matches_unfused():
+    check_fused(KineticsModelSen)
+
+def test_fused_sen_conv_matches_unfused():
+    check_fused(KineticsModelSenConv)
+
+def test_steady_state_restores_fused():
+    torch.manual_seed(0)
+    model = KineticsModelSen('sen', chans=[3,2], img_shape=(6,20,20), ksizes=(5,3), n_units=4, fused=True)
+    steady_state(model, torch.zeros(1, 6, 20, 20), hs_mode='double')
+    assert model.fused
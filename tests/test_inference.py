@@ -0,0 +1,94 @@
+import torch
+import torch.nn as nn
+from torchdeepretina.torch_utils import *
+from torchdeepretina.inference import optimize_for_inference, inference_error
+
+def randomize(module):
+    """
+    Fills every parameter with signed noise so that abs and square
+    transforms and batchnorm statistics are actually exercised.
+    """
+    torch.manual_seed(0)
+    with torch.no_grad():
+        for name, p in module.named_parameters():
+            if "running_var" in name:
+                p.uniform_(.5, 2)
+            else:
+                p.normal_()
+    return module
+
+def check(module, shape, tol=1e-5):
+    module = randomize(module)
+    optimized = optimize_for_inference(module)
+    X = torch.randn(*shape)
+    assert inference_error(module, optimized, X) < tol
+    return optimized
+
+def test_noise_layers_removed():
+    for layer in [GaussianNoise(std=1.), GaussianNoise1d((10,), noise=1.),
+                  GaussianNoise2d(3, noise=1.), nn.Dropout(.5)]:
+        optimized = check(layer, (4,3,10) if isinstance(layer, GaussianNoise1d) else (4,3,5,5))
+        assert isinstance(optimized, nn.Identity)
+
+def test_abs_conv2d():
+    for abs_bias in [False, True]:
+        optimized = check(AbsConv2d(3, 4, 3, padding=1, abs_bias=abs_bias), (2,3,8,8))
+        assert type(optimized) is nn.Conv2d
+    check(AbsConv2d(3, 4, 3, bias=False), (2,3,8,8))
+
+def test_sqr_conv2d():
+    for abs_bias in [False, True]:
+        optimized = check(SqrConv2d(3, 4, 3, stride=2, abs_bias=abs_bias), (2,3,9,9))
+        assert type(optimized) is nn.Conv2d
+
+def test_abs_conv_transpose2d():
+    for abs_bias in [False, True]:
+        optimized = check(AbsConvTranspose2d(3, 4, 3, stride=2, abs_bias=abs_bias), (2,3,6,6))
+        assert type(optimized) is nn.ConvTranspose2d
+
+def test_abs_linear():
+    for abs_bias in [False, True]:
+        optimized = check(AbsLinear(7, 5, abs_bias=abs_bias), (6,7))
+        assert type(optimized) is nn.Linear
+
+def test_decoupled_linear():
+    optimized = check(DecoupledLinear(7, 5), (6,7))
+    assert type(optimized) is nn.Linear
+
+def test_split_conv2d():
+    for ret_stacked in [True, False]:
+        split = SplitConv2d([(3, 4, 5, 1, 2), (3, 4, 3, 1, 1), (3, 4, 1, 1, 0)], ret_stacked=ret_stacked)
+        optimized = check(split, (2,3,9,9))
+        assert type(optimized) is nn.Conv2d
+
+def test_split_conv2d_unfusable_is_kept():
+    split = SplitConv2d([(3, 4, 3, 1, 0), (3, 4, 3, 2, 0)])
+    optimized = optimize_for_inference(split)
+    assert isinstance(optimized, SplitConv2d)
+
+def test_batchnorms():
+    layers = [(nn.BatchNorm1d(6), (5,6)), (nn.BatchNorm2d(3), (2,3,4,4)),
+              (BatchNorm1d(6), (5,6)), (AbsBatchNorm1d(6), (5,6)),
+              (AbsBatchNorm1d(6, abs_bias=True), (5,6)),
+              (AbsBatchNorm2d(3), (2,3,4,4)), (AbsBatchNorm2d(3, abs_bias=True), (2,3,4,4))]
+    for layer, shape in layers:
+        optimized = check(layer, shape)
+        assert type(optimized) is ScaleShift
+
+def test_abs_scaleshift():
+    optimized = check(AbsScaleShift((6,)), (5,6))
+    assert type(optimized) is ScaleShift
+
+def test_affines_folded_into_sequential():
+    model = nn.Sequential(AbsConv2d(3, 4, 3), AbsBatchNorm2d(4), nn.ReLU(), GaussianNoise(std=1.),
+                          Flatten(), AbsLinear(4*6*6, 5), nn.BatchNorm1d(5), nn.Softplus())
+    optimized = check(model, (2,3,8,8), tol=1e-4)
+    assert len(optimized) == len(model)
+    assert type(optimized[0]) is nn.Conv2d and isinstance(optimized[1], nn.Identity)
+    assert type(optimized[5]) is nn.Linear and isinstance(optimized[6], nn.Identity)
+
+def test_original_untouched():
+    layer = randomize(AbsLinear(7, 5))
+    optimize_for_inference(layer)
+    assert isinstance(layer, AbsLinear)
+    assert layer.linear.weight.requires_grad
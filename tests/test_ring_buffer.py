@@ -0,0 +1,31 @@
+import torch
+from kinetic.models import KineticsChannelModelFilterAmacrine
+from kinetic.utils import get_hs
+
+def make_model():
+    torch.manual_seed(0)
+    model = KineticsChannelModelFilterAmacrine(recur_seq_len=4, chans=[2,2], img_shape=(6,30,30), ksizes=(5,5))
+    model.eval()
+    return model
+
+def test_rolled_filter_matches_ordered_history():
+    model = make_model()
+    hs = get_hs(model, 3, 'cpu', mode='multiple')
+    with torch.no_grad():
+        for _ in range(7):
+            out, hs = model(torch.randn(3,6,30,30), hs)
+            assert model.ganglion[1].shift == 0
+            expected = model.ganglion(hs[1].ordered())
+            assert torch.allclose(out, expected, atol=1e-6)
+
+def test_ganglion_hooks_fire():
+    model = make_model()
+    hs = get_hs(model, 2, 'cpu', mode='multiple')
+    outs = []
+    hook = model.ganglion.register_forward_hook(lambda mod, inp, out: outs.append(out))
+    with torch.no_grad():
+        for _ in range(3):
+            out, hs = model(torch.randn(2,6,30,30), hs)
+    hook.remove()
+    assert len(outs) == 3
+    assert torch.equal(outs[-1], out)
@@ -0,0 +1,38 @@
+import numpy as np
+from scipy.optimize import curve_fit
+from kinetic.utils import sigmoid, batch_sigmoid_fit
+
+def make_rows(n_rows=12, n_points=300, noise=2., seed=0):
+    rng = np.random.RandomState(seed)
+    x = rng.randn(n_rows, n_points) * rng.uniform(.5, 3, (n_rows, 1))
+    true = np.stack([rng.uniform(-5, 5, n_rows), rng.uniform(20, 120, n_rows),
+                     rng.uniform(.5, 4, n_rows), rng.uniform(-1, 1, n_rows)], axis=1)
+    y = sigmoid(x, *[true[:,i:i+1] for i in range(4)]) + noise*rng.randn(n_rows, n_points)
+    return x, y
+
+def cost(x, y, params):
+    return ((y - sigmoid(x, *params))**2).sum()
+
+def test_matches_curve_fit():
+    x, y = make_rows()
+    init = (0., 100., 1., 0.)
+    params = batch_sigmoid_fit(x, y, init_params=init)
+    for k in range(len(x)):
+        ref, _ = curve_fit(sigmoid, x[k], y[k], p0=init, maxfev=50000)
+        assert cost(x[k], y[k], params[k]) <= cost(x[k], y[k], ref) * (1 + 1e-8)
+        assert np.allclose(params[k], ref, rtol=1e-4, atol=1e-4)
+
+def test_exact_data_is_recovered():
+    x, _ = make_rows(n_rows=4)
+    true = np.array([[1., 50., 2., .3]]*4)
+    y = sigmoid(x, *[true[:,i:i+1] for i in range(4)])
+    params = batch_sigmoid_fit(x, y, init_params=(0., 100., 1., 0.))
+    assert np.allclose(params, true, atol=1e-6)
+
+def test_default_init_reaches_curve_fit_cost():
+    x, y = make_rows(n_rows=24, seed=1)
+    init = (0., 1., 1., 0.)
+    params = batch_sigmoid_fit(x, y, init_params=init)
+    for k in range(len(x)):
+        ref, _ = curve_fit(sigmoid, x[k], y[k], p0=init, maxfev=50000)
+        assert cost(x[k], y[k], params[k]) <= cost(x[k], y[k], ref) * (1 + 1e-6)
@@ -0,0 +1,25 @@
+from torchdeepretina.training import SuccessiveHalving
+
+def run_search(scheduler, n_workers=1):
+    running = []
+    while not scheduler.finished():
+        while len(running) < n_workers:
+            config, rung = scheduler.next_job()
+            if config is None:
+                break
+            running.append((config, rung))
+        config, rung = running.pop(0)
+        scheduler.report(config, rung, float(config))
+    return [sorted(scores) for scores in scheduler.scores]
+
+def test_fewer_configs_than_eta_reach_the_top_rung():
+    for n_workers in [1, 2]:
+        scores = run_search(SuccessiveHalving(2, 10, 1, 3), n_workers)
+        assert scores == [[0, 1], [1], [1], [1]]
+
+def test_top_fraction_is_promoted():
+    for n_workers in [1, 4]:
+        scores = run_search(SuccessiveHalving(9, 9, 1, 3), n_workers)
+        assert scores[0] == list(range(9))
+        assert all(set(upper) <= set(lower) for lower, upper in zip(scores, scores[1:]))
+        assert 8 in scores[-1] and len(scores[1]) < 9
@@ -1,5 +1,5 @@
 __version__ = '0.1.0'
-from . import stimuli, datas, intracellular, utils, physiology, retinal_phenomena, torch_utils, models, analysis
+from . import stimuli, datas, intracellular, utils, physiology, retinal_phenomena, torch_utils, models, analysis, inference, battery
 from .analysis import *
 
 #import torchdeepretina.stimuli
@@ -0,0 +1,320 @@
+"""
+Runs the retinal phenomena over many checkpoints. The stimuli of each phenomenon
+are built once and cached on disk by a hash of their parameters. The
+(checkpoint x phenomenon) grid is simulated in a process pool and the numeric
+results are saved separately from the figures so that figures can be re-rendered
+without re-simulating.
+"""
+import os
+import json
+import hashlib
+import pickle
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+import matplotlib.pyplot as plt
+import torchdeepretina.stimuli as stim
+import torchdeepretina.visualizations as viz
+import torchdeepretina.retinal_phenomena as rp
+
+def step_response_stimuli(params):
+    return {'lanes': [rp.step_response_stimuli(**params)]}
+
+def reversing_grating_stimuli(params):
+    return {'lanes': [rp.reversing_grating_stimuli(**params)]}
+
+def osr_stimuli(params):
+    return {'lanes': [rp.osr_stimuli(**params)]}
+
+def contrast_adaptation_stimuli(params):
+    envelope, xs = rp.contrast_adaptation_stimuli(**params)
+    return {'lanes': xs, 'envelope': envelope}
+
+def motion_reversal_stimuli(params):
+    _, rtl, ltr = rp.motion_reversal_stimuli(params['velocity'], params['width'])
+    return {'lanes': [stim.concat(rtl, nh=params['filt_depth']), stim.concat(ltr, nh=params['filt_depth'])]}
+
+def motion_anticipation_stimuli(params):
+    right, left, flash_centers, flashes = rp.motion_anticipation_stimuli(params['velocity'], params['width'],
+                                                            params['flash_duration'], params['filt_depth'])
+    return {'lanes': [right[2], left[2], *flashes], 'c_right': right[0], 'c_left': left[0],
+                                                                'flash_centers': flash_centers}
+
+def oms_stimuli(params):
+    vid_params = {k:v for k,v in params.items() if k != 'filt_depth'}
+    diff_vid, global_vid = rp.oms_random_differential_stimuli(**vid_params)
+    nh = params['filt_depth']
+    return {'lanes': [stim.concat(diff_vid, nh=nh), stim.concat(global_vid, nh=nh)]}
+
+def trace_results(resps, stims, params):
+    return {'stimulus': stims['lanes'][0][:, -1, 0, 0].copy(), 'response': resps[0]}
+
+def osr_results(resps, stims, params):
+    results = trace_results(resps, stims, params)
+    results['metric'] = rp.osr_ratio(resps[0], params['interval'] * 2, params['nflashes'])
+    return results
+
+def contrast_adaptation_results(resps, stims, params):
+    return {'envelope': stims['envelope'][params['filt_depth']:, 0, 0], 'responses': np.asarray(resps)}
+
+def motion_reversal_results(resps, stims, params):
+    rtl, ltr, avg = rp.motion_reversal_curves(*resps)
+    return {'rtl': rtl, 'ltr': ltr, 'avg': avg}
+
+def motion_anticipation_results(resps, stims, params):
+    flash_responses = np.stack(resps[2:])
+    right, left, flash = rp.motion_anticipation_curves(resps[0], resps[1], flash_responses)
+    return {'c_right': stims['c_right'], 'c_left': stims['c_left'], 'flash_centers': stims['flash_centers'],
+            'right': right, 'left': left, 'flash': flash, 'flash_responses': flash_responses}
+
+def oms_results(resps, stims, params):
+    diff_response, global_response = resps
+    tot_frames = int(params['duration'] * params['sample_rate'])
+    window = slice(params['pre_frames']-params['filt_depth'], tot_frames-params['post_frames'])
+    ratios = global_response[window].mean(0)/diff_response[window].mean(0)
+    return {'diff': diff_response, 'global': global_response, 'metric': ratios}
+
+def trace_fig(results, figsize=(10,5)):
+    fig, _ = viz.response1D(results['stimulus'], results['response'], figsize=figsize)
+    return fig
+
+PHENOMENA = {
+    'step_response': {
+        'params': dict(duration=100, delay=50, nsamples=200, intensity=-1., filt_depth=40),
+        'stimuli': step_response_stimuli,
+        'results': trace_results,
+        'render': trace_fig,
+    },
+    'osr': {
+        'params': dict(duration=1, interval=10, nflashes=5, intensity=-2.0, filt_depth=40),
+        'stimuli': osr_stimuli,
+        'results': osr_results,
+        'render': lambda r: trace_fig(r, figsize=(20, 8)),
+    },
+    'reversing_grating': {
+        'params': dict(size=5, phase=0., filt_depth=40),
+        'stimuli': reversing_grating_stimuli,
+        'results': trace_results,
+        'render': trace_fig,
+    },
+    'contrast_adaptation': {
+        'params': dict(c0=.35, c1=.05, duration=50, delay=50, nsamples=140, nrepeats=10, filt_depth=40, seed=0),
+        'stimuli': contrast_adaptation_stimuli,
+        'results': contrast_adaptation_results,
+        'render': lambda r: viz.response1D(r['envelope'], r['responses'].mean(axis=0))[0],
+    },
+    'motion_reversal': {
+        'params': dict(velocity=0.08, width=2, filt_depth=40),
+        'stimuli': motion_reversal_stimuli,
+        'results': motion_reversal_results,
+        'render': lambda r: rp.motion_reversal_fig(r['rtl'], r['ltr'], r['avg'])[0],
+    },
+    'motion_anticipation': {
+        'params': dict(velocity=0.08, width=2, flash_duration=2, filt_depth=40),
+        'stimuli': motion_anticipation_stimuli,
+        'results': motion_anticipation_results,
+        'render': lambda r: rp.motion_anticipation_fig(r['c_right'], r['c_left'], r['flash_centers'],
+                                                        r['right'], r['left'], r['flash'])[0],
+    },
+    'oms': {
+        'params': dict(duration=5, sample_rate=30, pre_frames=40, post_frames=40, img_shape=(50,50),
+                       center=(25,25), radius=8, background_velocity=.3, foreground_velocity=.5,
+                       seed=0, bar_size=2, inner_bar_size=None, filt_depth=40),
+        'stimuli': oms_stimuli,
+        'results': oms_results,
+        'render': lambda r: rp.oms_fig(r['diff'], r['global']),
+    },
+}
+
+def get_params(name, params=dict()):
+    """
+    Returns the default parameters of the phenomenon updated with the argued ones.
+    Parameters that the phenomenon does not take are ignored.
+    """
+    defaults = PHENOMENA[name]['params']
+    return {**defaults, **{k:v for k,v in params.items() if k in defaults}}
+
+def param_hash(name, params):
+    to_json = lambda o: o.tolist() if isinstance(o, np.ndarray) else str(o)
+    s = json.dumps({'name': name, **params}, sort_keys=True, default=to_json)
+    return hashlib.sha1(s.encode()).hexdigest()[:16]
+
+def checkpoint_key(checkpoint):
+    """
+    Identifies a checkpoint file by its path and modification time so that
+    results are recomputed when a checkpoint is overwritten.
+    """
+    path = os.path.abspath(checkpoint)
+    s = "{}_{}".format(path, os.path.getmtime(path))
+    name = os.path.splitext(os.path.basename(path))[0]
+    return "{}_{}".format(name, hashlib.sha1(s.encode()).hexdigest()[:16])
+
+def save_pickle(obj, path):
+    """
+    Writes to a temporary file first so that readers never see a partial file.
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temp = "{}.{}.tmp".format(path, os.getpid())
+    with open(temp, 'wb') as f:
+        pickle.dump(obj, f)
+    os.replace(temp, path)
+
+def load_pickle(path):
+    with open(path, 'rb') as f:
+        return pickle.load(f)
+
+def get_stimuli(name, params, cache_dir):
+    """
+    Builds and caches the stimuli of a phenomenon if they are not cached yet.
+
+    returns the path to the cached stimuli
+    """
+    path = os.path.join(cache_dir, "stimuli", "{}_{}.pkl".format(name, param_hash(name, params)))
+    if not os.path.exists(path):
+        save_pickle(PHENOMENA[name]['stimuli'](params), path)
+    return path
+
+def result_path(checkpoint, name, params, cache_dir, I20=None):
+    if I20 is not None:
+        params = {**params, 'I20': I20}
+    file_name = "{}_{}.pkl".format(name, param_hash(name, params))
+    return os.path.join(cache_dir, "results", checkpoint_key(checkpoint), file_name)
+
+def load_checkpoint(checkpoint):
+    from torchdeepretina.analysis import load_model
+    return load_model(checkpoint)
+
+_worker_model = dict()
+
+def init_worker(n_threads):
+    torch.set_num_threads(n_threads)
+
+def run_task(checkpoint, name, params, stim_path, save_path, device='cpu', load_fn=load_checkpoint,
+                                                                    fast_forward=False, I20=None):
+    """
+    Simulates a single phenomenon for a single checkpoint and saves the results.
+
+    Each process keeps only its most recently loaded model, keyed by the
+    checkpoint, device and load_fn, so that memory stays bounded to one model
+    per worker. run_battery submits the tasks checkpoint by checkpoint, so a
+    worker reloads a model only when it moves on to a new checkpoint.
+    """
+    key = (checkpoint, device, load_fn)
+    if _worker_model.get('key') != key:
+        _worker_model.clear()
+        model = load_fn(checkpoint).to(device)
+        model.eval()
+        _worker_model['key'] = key
+        _worker_model['model'] = model
+    model = _worker_model['model']
+    stims = load_pickle(stim_path)
+    hs_init = None
+    if rp.is_recurrent(model):
+        hs_init = rp.init_hs(model, torch.device(device), I20)
+    resps = rp.simulate(model, stims['lanes'], hs_init, device=torch.device(device), fast_forward=fast_forward)
+    save_pickle(PHENOMENA[name]['results'](resps, stims, params), save_path)
+    return save_path
+
+def run_battery(checkpoints, names=None, params=dict(), cache_dir="phenomena_cache", n_workers=None,
+                                    n_threads=None, device='cpu', load_fn=load_checkpoint, overwrite=False,
+                                    fast_forward=False, I20=None, verbose=True):
+    """
+    Computes the numeric results of the retinal phenomena for each checkpoint.
+    Cached results are reused unless overwrite is true.
+
+    checkpoints - list of str
+        paths to checkpoint files
+    names - list of str or None
+        keys of PHENOMENA to run. If None, all phenomena are run
+    params - dict
+        parameter overrides. Keys can be phenomenon names mapping to dicts of
+        that phenomenon's parameters, or parameter names applying to every
+        phenomenon that takes them (i.e. filt_depth)
+    cache_dir - str
+        directory of the cached stimuli and results
+    n_workers - int or None
+        number of worker processes. Defaults to one per cpu. Tasks run in
+        the calling process if n_workers is 1 or less. Workers are spawned,
+        so scripts calling run_battery need an if __name__ == "__main__" guard
+    n_threads - int or None
+        torch threads of each worker. Defaults to the cpu count divided by n_workers
+    device - str
+        device the models are run on
+    load_fn - callable
+        picklable function that loads a model from a checkpoint path
+    fast_forward - bool
+        if true, static stretches of the stimuli are fast forwarded (see
+        retinal_phenomena.simulate). Results are not recomputed when only
+        this changes
+    I20 - ndarray, pair of ndarrays or None
+        initial I2 occupancy of the kinetic models (see retinal_phenomena.init_hs).
+        Models with an inhibitory kinetics pathway take a pair, i.e.
+        (None, np.array([1.04])). Results are cached separately for each I20
+
+    returns:
+        results - dict {checkpoint: {name: dict of ndarrays}}
+    """
+    if names is None:
+        names = list(PHENOMENA.keys())
+    shared = {k:v for k,v in params.items() if k not in PHENOMENA}
+    phen_params = {n: get_params(n, {**shared, **params.get(n, dict())}) for n in names}
+    stim_paths = {n: get_stimuli(n, phen_params[n], cache_dir) for n in names}
+
+    tasks = []
+    paths = dict()
+    for checkpoint in checkpoints:
+        for name in names:
+            path = result_path(checkpoint, name, phen_params[name], cache_dir, I20)
+            paths[(checkpoint, name)] = path
+            if overwrite or not os.path.exists(path):
+                tasks.append((checkpoint, name, phen_params[name], stim_paths[name], path, device, load_fn,
+                                                                                        fast_forward, I20))
+    if verbose:
+        print("Running {} of {} tasks".format(len(tasks), len(paths)))
+
+    n_cpus = os.cpu_count() or 1
+    if n_workers is None:
+        n_workers = min(len(tasks), n_cpus)
+    if n_workers <= 1:
+        for task in tasks:
+            run_task(*task)
+    else:
+        if n_threads is None:
+            n_threads = max(1, n_cpus//n_workers)
+        ctx = mp.get_context('spawn')
+        with ProcessPoolExecutor(n_workers, mp_context=ctx, initializer=init_worker,
+                                                    initargs=(n_threads,)) as executor:
+            futures = [executor.submit(run_task, *task) for task in tasks]
+            for i,future in enumerate(futures):
+                future.result()
+                if verbose:
+                    print("Finished task {}/{}".format(i+1, len(tasks)), end="     \r")
+
+    results = dict()
+    for (checkpoint, name), path in paths.items():
+        results.setdefault(checkpoint, dict())[name] = load_pickle(path)
+    return results
+
+def render_battery(results, save_folder=None):
+    """
+    Renders the figures of the results of a single checkpoint.
+
+    results - dict {name: dict of ndarrays}
+        one entry of the output of run_battery
+    save_folder - str or None
+        if not None, each figure is saved as <name>.png in this folder
+
+    returns:
+        figs - dict {name: matplotlib figure}
+        metrics - dict {name: metric or None}
+    """
+    figs = dict()
+    metrics = dict()
+    for name, result in results.items():
+        figs[name] = PHENOMENA[name]['render'](result)
+        metrics[name] = result.get('metric', None)
+        if save_folder is not None:
+            figs[name].savefig(os.path.join(save_folder, name + ".png"))
+            plt.close(figs[name])
+    return figs, metrics
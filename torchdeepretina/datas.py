@@ -2,6 +2,9 @@
 Preprocessing utility functions for loading and formatting experimental data
 """
 from collections import namedtuple
+import atexit
+from multiprocessing import shared_memory, resource_tracker
+import warnings
 
 import h5py
 import numpy as np
@@ -51,15 +54,155 @@ SIGMAS = {
 }
 
 Exptdata = namedtuple('Exptdata', ['X','y','spkhist','stats',"cells","centers"])
-__all__ = ['loadexpt','stimcut','CELLS',"CENTERS","DataContainer","DataObj","DataDistributor"]
+__all__ = ['loadexpt','stimcut','CELLS',"CENTERS","DataContainer","DataObj","DataDistributor",
+                                                                        "SharedArray","SharedData"]
+
+# Shared memory segments created and attached by this process, keyed by name
+_OWNED = dict()
+_SEGMENTS = dict()
 
 class DataContainer():
-    def __init__(self, data):
+    def __init__(self, data, normalize=True):
         self.centers = data.centers
         self.stats = data.stats
-        self.X = (data.X - self.stats['mean']) / self.stats['std']
+        if normalize:
+            self.X = (data.X - self.stats['mean']) / self.stats['std']
+        else:
+            self.X = data.X
         self.y = data.y
 
+class SharedArray:
+    """
+    A picklable handle to an ndarray copied into shared memory. The process
+    that creates the handle owns the segment and must unlink it. Other
+    processes open read-only views of it without copying.
+
+    Processes that open the segment must share the resource tracker of the
+    creating process, otherwise the tracker of an exiting process removes
+    the segment. Processes forked after share_resources or spawned from the
+    creating process do.
+    """
+    def __init__(self, array):
+        array = np.ascontiguousarray(array)
+        self.shape = array.shape
+        self.dtype = array.dtype.str
+        shm = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+        self.name = shm.name
+        _OWNED[self.name] = shm
+        view = np.frombuffer(shm.buf, dtype=self.dtype, count=array.size).reshape(self.shape)
+        view[...] = array
+        del view
+
+    def open(self):
+        """
+        returns:
+            array - ndarray
+                a read-only view of the shared array. The view holds the
+                segment open, see close_shared
+        """
+        if self.name in _OWNED:
+            shm = _OWNED[self.name]
+        elif self.name in _SEGMENTS:
+            shm = _SEGMENTS[self.name]
+        else:
+            shm = shared_memory.SharedMemory(name=self.name)
+            _SEGMENTS[self.name] = shm
+        count = int(np.prod(self.shape))
+        array = np.frombuffer(shm.buf, dtype=self.dtype, count=count).reshape(self.shape)
+        array.flags.writeable = False
+        return array
+
+    def unlink(self):
+        """
+        Removes the segment. Views that are still open stay valid until they
+        are deleted.
+        """
+        if self.name in _OWNED:
+            shm = _OWNED.pop(self.name)
+            shm.unlink()
+            close_segment(shm)
+
+def share_resources():
+    """
+    Starts the resource tracker of this process so that processes forked from
+    it share it, see SharedArray
+    """
+    resource_tracker.ensure_running()
+
+def close_segment(shm):
+    """
+    Closes a SharedMemory object. If views of it are still open, its memory is
+    released once the last of those views is deleted.
+    """
+    try:
+        shm.close()
+    except BufferError:
+        # Leave the mapping to the views that export it
+        shm._buf, shm._mmap = None, None
+        shm.close()
+
+def close_shared(keep=set()):
+    """
+    Closes the shared memory segments attached by this process, except for
+    those named in keep. Segments created by this process are left to
+    SharedArray.unlink.
+
+    keep - set of str
+        names of the segments to leave attached
+    """
+    for name in list(_SEGMENTS.keys()):
+        if name not in keep:
+            close_segment(_SEGMENTS.pop(name))
+
+atexit.register(close_shared)
+
+class SharedData:
+    """
+    Experiment data loaded once and shared between processes. The stimulus
+    is stored as normalized float32 frames and windowed in each process, so
+    attaching copies nothing and the shared memory is img_depth times smaller
+    than the windowed stimulus.
+    """
+    def __init__(self, data, n_samples=None):
+        """
+        data - Exptdata
+            as returned by loadexpt
+        n_samples - int or None
+            if argued, only the first n_samples windows are kept
+        """
+        X, y = data.X, data.y
+        if n_samples is not None:
+            X, y = X[:n_samples], y[:n_samples]
+        self.depth = X.shape[1]
+        self.stats = data.stats
+        self.centers = data.centers
+        # Window i of loadexpt is frames[i:i+depth]
+        frames = np.concatenate([X[:,0], X[-1,1:]], axis=0)
+        frames = ((frames - self.stats['mean']) / self.stats['std']).astype(np.float32)
+        self.frames = SharedArray(frames)
+        self.y = SharedArray(y)
+
+    @property
+    def names(self):
+        return {self.frames.name, self.y.name}
+
+    def attach(self):
+        """
+        returns:
+            data - DataContainer
+                read-only views of the shared data with the stimulus in windows
+                of shape (N, img_depth, ...)
+        """
+        close_shared(keep=self.names)
+        frames = self.frames.open()
+        windows = np.lib.stride_tricks.sliding_window_view(frames, self.depth, axis=0)
+        data = Exptdata(np.moveaxis(windows, -1, 1), self.y.open(), None, self.stats, None, self.centers)
+        return DataContainer(data, normalize=False)
+
+    def unlink(self):
+        self.frames.unlink()
+        self.y.unlink()
+
 def loadexpt(expt, cells, filename, train_or_test, history, nskip=0, cutout_width=None,                          
              norm_stats=None, data_path="/home/salamander/experiments/data", sigmas=0.01):
     """Loads an experiment from an h5 file on disk
@@ -267,7 +410,8 @@ class DataDistributor:
     This class is used to abstract away the manipulations required for shuffling or organizing data for rnns.
     """
 
-    def __init__(self, data, val_size=30000, batch_size=512, seq_len=1, shuffle=True, rand_sample=None, recurrent=False, shift_labels=False):
+    def __init__(self, data, val_size=30000, batch_size=512, seq_len=1, shuffle=True, rand_sample=None, recurrent=False, shift_labels=False,
+                                                                                            teacher_y=None):
         """
         data - a class or named tuple containing an X and y member variable.
         val_size - the number of samples dedicated to validation
@@ -282,6 +426,9 @@ class DataDistributor:
                         if left as None
         recurrent - bool describing if model is recurrent
         shift_labels - bool describing if labels should be shifted for null model training
+        teacher_y - optional ndarray of teacher outputs aligned with data.y. If argued, it is
+                    arranged like the labels (but never shifted) and train_sample yields
+                    it as a third element
         """
         self.batch_size = batch_size
         self.is_torch = False
@@ -292,6 +439,8 @@ class DataDistributor:
         self.shift_labels = shift_labels
         self.X = data.X
         self.y = data.y
+        # asarray keeps memmaps as plain ndarray views of the same memory
+        self.teacher_y = None if teacher_y is None else np.asarray(teacher_y)
         if shift_labels:
             self.y = self.shift_in_groups(self.y, group_size=200)
         rand_sample = shuffle if rand_sample is None else rand_sample
@@ -299,9 +448,13 @@ class DataDistributor:
         if seq_len > 1:
             self.X = rolling_window(self.X, seq_len)
             self.y = rolling_window(self.y, seq_len)
+            if self.teacher_y is not None:
+                self.teacher_y = rolling_window(self.teacher_y, seq_len)
         if recurrent:
             self.X = self.order_into_batches(self.X, batch_size)
             self.y = self.order_into_batches(self.y, batch_size)
+            if self.teacher_y is not None:
+                self.teacher_y = self.order_into_batches(self.teacher_y, batch_size)
         if type(self.X) == type(np.array([])):
             if shuffle:
                 self.perm = np.random.permutation(self.X.shape[0]).astype('int')
@@ -317,10 +470,7 @@ class DataDistributor:
             val_size = int(len(self.perm)*0.05)
         self.train_idxs = self.perm[:-val_size]
         self.val_idxs = self.perm[-val_size:]
-        self.train_X = DataObj(self.X, self.train_idxs)
-        self.train_y = DataObj(self.y, self.train_idxs)
-        self.val_X = DataObj(self.X, self.val_idxs)
-        self.val_y = DataObj(self.y, self.val_idxs)
+        self.make_objs()
         self.train_shape = (len(self.train_idxs), *self.X.shape[1:])
         self.val_shape = (len(self.val_idxs), *self.X.shape[1:])
         if self.recurrent:
@@ -328,6 +478,15 @@ class DataDistributor:
         else:
             self.n_loops = self.train_shape[0]//batch_size
 
+    def make_objs(self):
+        self.train_X = DataObj(self.X, self.train_idxs)
+        self.train_y = DataObj(self.y, self.train_idxs)
+        self.val_X = DataObj(self.X, self.val_idxs)
+        self.val_y = DataObj(self.y, self.val_idxs)
+        self.train_teacher = None
+        if self.teacher_y is not None:
+            self.train_teacher = DataObj(self.teacher_y, self.train_idxs)
+
     def __len__(self):
         return len(self.X)
 
@@ -407,29 +566,42 @@ class DataDistributor:
             #    roll_amt = int(np.random.randint(0,len(self.train_y)))
             #    yield self.train_X[idxs], self.train_y.roll(roll_amt, idxs)
             #else:
-            yield self.train_X[idxs], self.train_y[idxs]
+            if self.train_teacher is not None:
+                yield self.train_X[idxs], self.train_y[idxs], self.train_teacher[idxs]
+            else:
+                yield self.train_X[idxs], self.train_y[idxs]
     
+    def as_tensor(self, data):
+        """
+        Shares the memory of float32 arrays, such as the read-only views of
+        SharedData, rather than copying them
+        """
+        shareable = isinstance(data, np.ndarray) and data.dtype == np.float32
+        if shareable and all(stride >= 0 for stride in data.strides):
+            with warnings.catch_warnings():
+                warnings.filterwarnings("ignore", message="The given NumPy array is not writable")
+                return torch.from_numpy(data)
+        return torch.FloatTensor(data)
+
     def torch(self):
         self.is_torch = True
-        self.X = torch.FloatTensor(self.X)
-        self.y = torch.FloatTensor(self.y)
+        self.X = self.as_tensor(self.X)
+        self.y = self.as_tensor(self.y)
+        if self.teacher_y is not None:
+            self.teacher_y = self.as_tensor(self.teacher_y)
         self.perm = torch.LongTensor(self.perm)
         self.train_idxs = self.perm[:-self.val_shape[0]]
         self.val_idxs = self.perm[-self.val_shape[0]:]
-        self.train_X = DataObj(self.X, self.train_idxs)
-        self.train_y = DataObj(self.y, self.train_idxs)
-        self.val_X = DataObj(self.X, self.val_idxs)
-        self.val_y = DataObj(self.y, self.val_idxs)
+        self.make_objs()
 
     def numpy(self):
         self.is_torch = False
         self.X = np.asarray(self.X)
         self.y = np.asarray(self.y)
+        if self.teacher_y is not None:
+            self.teacher_y = np.asarray(self.teacher_y)
         self.perm = np.asarray(self.perm).astype('int')
         self.train_idxs = self.perm[:-self.val_shape[0]]
         self.val_idxs = self.perm[-self.val_shape[0]:]
-        self.train_X = DataObj(self.X, self.train_idxs)
-        self.train_y = DataObj(self.y, self.train_idxs)
-        self.val_X = DataObj(self.X, self.val_idxs)
-        self.val_y = DataObj(self.y, self.val_idxs)
+        self.make_objs()
 
@@ -0,0 +1,251 @@
+"""
+Rewrites trained models into evaluation-only versions with fewer ops per forward pass.
+"""
+import copy
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from torchdeepretina.torch_utils import *
+
+NOISE_MODULES = (GaussianNoise, GaussianNoise1d, GaussianNoise2d, nn.Dropout)
+BNORM_MODULES = (nn.BatchNorm1d, nn.BatchNorm2d, BatchNorm1d, AbsBatchNorm1d, AbsBatchNorm2d)
+
+def optimize_for_inference(model, inplace=False):
+    """
+    Returns a version of the model that computes the same outputs in eval mode
+    with fewer operations. The following rewrites are applied to every submodule:
+
+        - GaussianNoise and Dropout layers are replaced with identities
+        - AbsConv2d, SqrConv2d, AbsConvTranspose2d, AbsLinear and DecoupledLinear
+          are replaced with plain layers holding the already transformed weights
+        - SplitConv2d branches are fused into a single convolution
+        - batchnorms and (Abs)ScaleShifts are precomputed into a single ScaleShift
+          and folded into the preceding Conv2d or Linear layer when the affine is
+          per output channel
+
+    Removed layers are replaced by identities so that the sequential indices used
+    as layer keys throughout the analysis code remain valid. Activations taken
+    before a folded normalization will include the normalization. The returned
+    model is in eval mode and its parameters do not require gradients; it should
+    not be trained. tiled_forward is not supported on the returned model.
+
+    model - torch Module
+    inplace - bool
+        if false, the argued model is left untouched and a copy is optimized.
+        if the model is itself a convertible layer, a new module is returned
+        even when inplace is true
+
+    returns the optimized torch Module
+    """
+    if not inplace:
+        model = copy.deepcopy(model)
+    model.eval()
+    with torch.no_grad():
+        model = convert_module(optimize_module(model))
+    model.eval()
+    for p in model.parameters():
+        p.requires_grad = False
+    return model
+
+def optimize_module(module):
+    """
+    Recursively converts the children of the argued module and folds the
+    affine layers within each Sequential.
+    """
+    for name, child in list(module.named_children()):
+        optimize_module(child)
+        new_child = convert_module(child)
+        if new_child is not child:
+            setattr(module, name, new_child)
+    if isinstance(module, nn.Sequential):
+        fold_affines(module)
+    return module
+
+def convert_module(module):
+    """
+    Converts a single module into its evaluation equivalent. Returns the argued
+    module if no conversion applies.
+    """
+    if isinstance(module, NOISE_MODULES):
+        return nn.Identity()
+    if isinstance(module, (AbsConv2d, SqrConv2d)):
+        conv = module.conv
+        weight = conv.weight.abs() if isinstance(module, AbsConv2d) else conv.weight**2
+        bias = None
+        if module.bias:
+            bias = conv.bias.abs() if module.abs_bias else conv.bias
+        return make_conv2d(conv, weight, bias)
+    if isinstance(module, AbsConvTranspose2d):
+        conv = module.conv
+        new_conv = nn.ConvTranspose2d(conv.in_channels, conv.out_channels, conv.kernel_size,
+                                      conv.stride, conv.padding, bias=module.bias)
+        new_conv.weight.data = conv.weight.data.abs()
+        if module.bias:
+            new_conv.bias.data = conv.bias.data.abs() if module.abs_bias else conv.bias.data.clone()
+        return new_conv
+    if isinstance(module, AbsLinear):
+        lin = module.linear
+        bias = lin.bias
+        if bias is not None and module.abs_bias:
+            bias = bias.abs()
+        return make_linear(lin.weight.abs(), bias)
+    if isinstance(module, DecoupledLinear):
+        norms = torch.norm(module.weight, 2, dim=0)
+        weight = (module.weight / (norms + module.eps)).transpose(1,0)
+        weight = weight * module.scale[:,None]
+        bias = None if module.bias is None else module.bias * module.scale
+        return make_linear(weight, bias)
+    if isinstance(module, SplitConv2d):
+        fused = fuse_split_conv(module)
+        return module if fused is None else fused
+    if isinstance(module, BNORM_MODULES):
+        return bnorm_to_scaleshift(module)
+    if isinstance(module, AbsScaleShift):
+        return make_scaleshift(module.scale_param.abs(), module.shift_param)
+    return module
+
+def make_conv2d(conv, weight, bias):
+    """
+    Makes an nn.Conv2d with the same configuration as conv and the argued weight and bias
+    """
+    new_conv = nn.Conv2d(conv.in_channels, conv.out_channels, conv.kernel_size, conv.stride,
+                         conv.padding, conv.dilation, conv.groups, bias=bias is not None)
+    new_conv.weight.data = weight.data.clone()
+    if bias is not None:
+        new_conv.bias.data = bias.data.clone()
+    return new_conv.to(weight.device)
+
+def make_linear(weight, bias):
+    lin = nn.Linear(weight.shape[1], weight.shape[0], bias=bias is not None)
+    lin.weight.data = weight.data.clone()
+    if bias is not None:
+        lin.bias.data = bias.data.clone()
+    return lin.to(weight.device)
+
+def make_scaleshift(scale, shift):
+    scaleshift = ScaleShift(tuple(scale.shape))
+    scaleshift.scale_param.data = scale.data.clone()
+    scaleshift.shift_param.data = shift.data.clone()
+    return scaleshift.to(scale.device)
+
+def bnorm_to_scaleshift(bnorm):
+    """
+    Precomputes the running statistics and affine parameters of a batchnorm
+    into a single ScaleShift. 2d batchnorms produce (C,1,1) shaped parameters.
+    """
+    mean = bnorm.running_mean.data
+    std = torch.sqrt(bnorm.running_var.data + bnorm.eps)
+    if isinstance(bnorm, (nn.BatchNorm1d, nn.BatchNorm2d)):
+        weight = bnorm.weight if bnorm.affine else torch.ones_like(mean)
+        bias = bnorm.bias if bnorm.affine else torch.zeros_like(mean)
+    else:
+        weight = bnorm.scale.abs() if isinstance(bnorm, (AbsBatchNorm1d, AbsBatchNorm2d)) else bnorm.scale
+        bias = bnorm.shift
+        if getattr(bnorm, "abs_bias", False):
+            bias = bias.abs()
+    scale = weight / std
+    shift = bias - mean * scale
+    if isinstance(bnorm, (nn.BatchNorm2d, AbsBatchNorm2d)):
+        scale = scale[:,None,None]
+        shift = shift[:,None,None]
+    return make_scaleshift(scale, shift)
+
+def fold_affines(sequential):
+    """
+    Folds ScaleShift layers into directly preceding Conv2d or Linear layers when
+    the ScaleShift acts on each output channel independently. Folded ScaleShifts
+    are replaced with identities.
+    """
+    for i in range(1, len(sequential)):
+        layer, affine = sequential[i-1], sequential[i]
+        if not isinstance(affine, ScaleShift):
+            continue
+        if isinstance(layer, nn.Linear):
+            n_out = layer.out_features
+            if affine.scale_param.numel() not in {1, n_out} or affine.scale_param.dim() > 1:
+                continue
+        elif isinstance(layer, nn.Conv2d):
+            n_out = layer.out_channels
+            shape = tuple(affine.scale_param.shape)
+            if shape not in {(1,), (n_out,1,1), (1,1,1)}:
+                continue
+        else:
+            continue
+        scale = (affine.scale_param * torch.ones_like(affine.shift_param)).reshape(-1).expand(n_out)
+        shift = (affine.shift_param * torch.ones_like(affine.scale_param)).reshape(-1).expand(n_out)
+        weight = layer.weight * scale.reshape(-1, *[1 for _ in layer.weight.shape[1:]])
+        bias = shift.clone() if layer.bias is None else layer.bias * scale + shift
+        if isinstance(layer, nn.Linear):
+            sequential[i-1] = make_linear(weight, bias)
+        else:
+            sequential[i-1] = make_conv2d(layer, weight, bias)
+        sequential[i] = nn.Identity()
+    return sequential
+
+def fuse_split_conv(split_conv):
+    """
+    Fuses the parallel branches of a SplitConv2d into a single Conv2d. Branches with
+    smaller kernels are zero padded to the largest kernel. When ret_stacked is false,
+    the branch weights are summed instead of concatenated along the output channels.
+
+    returns None if the branches cannot be expressed as a single convolution
+    """
+    convs = list(split_conv.convs)
+    if len(convs) == 0:
+        return None
+    ksize = max(max(c.kernel_size) for c in convs)
+    base = convs[0]
+    paddings = set()
+    for c in convs:
+        if c.kernel_size[0] != c.kernel_size[1] or (ksize-c.kernel_size[0]) % 2 != 0:
+            return None
+        if c.stride != base.stride or c.dilation != (1,1) or c.groups != 1:
+            return None
+        if c.in_channels != base.in_channels or c.padding[0] != c.padding[1]:
+            return None
+        if not split_conv.ret_stacked and c.out_channels != base.out_channels:
+            return None
+        paddings.add(c.padding[0] + (ksize-c.kernel_size[0])//2)
+    if len(paddings) > 1:
+        return None
+    weights = []
+    biases = []
+    for c in convs:
+        pad = (ksize-c.kernel_size[0])//2
+        weights.append(F.pad(c.weight, (pad, pad, pad, pad)))
+        bias = c.bias if c.bias is not None else torch.zeros(c.out_channels, device=c.weight.device)
+        biases.append(bias)
+    if split_conv.ret_stacked:
+        weight = torch.cat(weights, dim=0)
+        bias = torch.cat(biases, dim=0)
+    else:
+        weight = torch.stack(weights, dim=0).sum(0)
+        bias = torch.stack(biases, dim=0).sum(0)
+    conv = nn.Conv2d(base.in_channels, weight.shape[0], ksize, base.stride, paddings.pop(), bias=True)
+    conv.weight.data = weight.data.clone()
+    conv.bias.data = bias.data.clone()
+    return conv.to(weight.device)
+
+def inference_error(model, optimized, X, hs=None):
+    """
+    Returns the maximum absolute difference between the outputs of the model
+    and its optimized version on the argued inputs. Useful to check that
+    optimize_for_inference preserved a model.
+
+    model - torch Module
+    optimized - torch Module
+        the output of optimize_for_inference(model)
+    X - torch FloatTensor (B, ...)
+    hs - optional hidden states for recurrent models
+    """
+    train_state = model.training
+    model.eval()
+    with torch.no_grad():
+        if hs is None:
+            out = model(X)
+            opt_out = optimized(X)
+        else:
+            out = model(X, copy.deepcopy(hs))[0]
+            opt_out = optimized(X, copy.deepcopy(hs))[0]
+    model.train(train_state)
+    return (out - opt_out).abs().max().item()
@@ -7,6 +7,7 @@ import h5py
 import collections
 import pyret.filtertools as ft
 import numpy as np
+import torch
 import matplotlib.pyplot as plt
 from matplotlib.ticker import MultipleLocator, FormatStrFormatter
 import torchdeepretina.utils as tdrutils
@@ -172,6 +173,312 @@ def pad_to_edge(stim):
     padded_stim[:, y_start:y_start+height, x_start:x_start+width] = stim
     return padded_stim
 
+def sanitize_correlations(cors):
+    """
+    Sets nan and fishy (|r| >= 1) correlations to zero.
+
+    cors: ndarray of correlations
+    """
+    cors = np.where(np.isnan(cors), 0, cors)
+    return np.where(np.abs(cors) >= 1, 0, cors)
+
+def correlation_matrix(mem_pots, model_layer, batch_size=4096, sanitize=True):
+    '''
+    Computes the pearson correlation of each membrane potential with every unit
+    in model_layer. The membrane potentials are z-scored once and the layer is
+    z-scored and multiplied with them in chunks of batch_size units.
+
+    Args:
+        mem_pots: (N, T) or (T,) numpy array of membrane potentials
+        model_layer: (T, ...) layer of activities
+        batch_size: number of units correlated at a time
+        sanitize: sets nan and fishy (|r| >= 1) correlations to zero
+    Returns:
+        cors: (N, ...) numpy array of correlations
+    '''
+    pots = np.asarray(mem_pots, dtype=np.float64)
+    if len(pots.shape) == 1:
+        pots = pots[None]
+    pots = pots - pots.mean(-1, keepdims=True)
+    layer = model_layer.reshape(len(model_layer), -1)
+    cors = np.empty((len(pots), layer.shape[1]))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        pots = pots / np.sqrt((pots**2).sum(-1, keepdims=True))
+        for i in range(0, layer.shape[1], batch_size):
+            chunk = np.asarray(layer[:, i:i+batch_size], dtype=np.float64)
+            chunk = chunk - chunk.mean(0)
+            norms = np.sqrt((chunk**2).sum(0))
+            cors[:, i:i+batch_size] = pots.dot(chunk) / norms
+    if sanitize:
+        cors = sanitize_correlations(cors)
+    return cors.reshape(len(pots), *model_layer.shape[1:])
+
+def lagged_correlation_matrix(mem_pots, model_layer, max_lag=5, min_lag=None, batch_size=None,
+                                                        mem_budget=2**28, sanitize=True):
+    '''
+    Computes the pearson correlation of each membrane potential with every unit
+    in model_layer at each lag in [min_lag, max_lag]. At lag k the potential at
+    time t is paired with the unit at time t-k, so positive lags mean the membrane
+    potential trails the model. Each lag is normalized over its own overlapping
+    samples. The cross products for all lags are computed in a single FFT pass
+    for each chunk of batch_size units. Lag 0 matches correlation_matrix.
+
+    The FFT pass holds about 24*nfft*(N+1) bytes per unit in the chunk, where nfft
+    is the next power of two above T plus the largest lag. For 10 potentials
+    and T=30000 this is roughly 8.6MB per unit.
+
+    Args:
+        mem_pots: (N, T) or (T,) numpy array of membrane potentials
+        model_layer: (T, ...) layer of activities
+        max_lag: int
+        min_lag: int or None
+            defaults to -max_lag
+        batch_size: int or None
+            number of units correlated at a time. if None, the largest
+            chunk that fits in mem_budget is used
+        mem_budget: int
+            approximate number of bytes used by the FFT pass of each chunk
+            when batch_size is None
+        sanitize: sets nan and fishy (|r| >= 1) correlations to zero
+    Returns:
+        cors: (N, L, ...) numpy array of correlations for each of the L lags
+        lags: (L,) numpy array of lags
+    '''
+    if min_lag is None:
+        min_lag = -max_lag
+    pots = np.asarray(mem_pots, dtype=np.float64)
+    if len(pots.shape) == 1:
+        pots = pots[None]
+    T = pots.shape[-1]
+    assert -T < min_lag <= max_lag < T
+    lags = np.arange(min_lag, max_lag+1)
+    n = (T - np.abs(lags)).astype(np.float64)
+    # Window bounds of the paired samples at each lag
+    p_start, p_end = np.maximum(lags, 0), T + np.minimum(lags, 0)
+    x_start, x_end = np.maximum(-lags, 0), T - np.maximum(lags, 0)
+
+    pots = pots - pots.mean(-1, keepdims=True)
+    cum_p = np.concatenate([np.zeros((len(pots), 1)), np.cumsum(pots, -1)], -1)
+    cum_pp = np.concatenate([np.zeros((len(pots), 1)), np.cumsum(pots**2, -1)], -1)
+    sum_p = cum_p[:, p_end] - cum_p[:, p_start]
+    var_p = np.maximum(cum_pp[:, p_end] - cum_pp[:, p_start] - sum_p**2/n, 0)
+    nfft = int(2**np.ceil(np.log2(T + max(abs(min_lag), abs(max_lag)))))
+    fft_p = np.fft.rfft(pots, nfft, axis=-1)
+    if batch_size is None:
+        # cross spectrum, its inverse and the padded chunk
+        batch_size = max(1, int(mem_budget // (24*nfft*(len(pots)+1))))
+
+    layer = model_layer.reshape(T, -1)
+    cors = np.empty((len(pots), len(lags), layer.shape[1]))
+    for i in range(0, layer.shape[1], batch_size):
+        chunk = np.asarray(layer[:, i:i+batch_size], dtype=np.float64)
+        chunk = chunk - chunk.mean(0)
+        cum_x = np.concatenate([np.zeros((1, chunk.shape[1])), np.cumsum(chunk, 0)], 0)
+        cum_xx = np.concatenate([np.zeros((1, chunk.shape[1])), np.cumsum(chunk**2, 0)], 0)
+        sum_x = cum_x[x_end] - cum_x[x_start]
+        var_x = np.maximum(cum_xx[x_end] - cum_xx[x_start] - sum_x**2/n[:,None], 0)
+        fft_x = np.fft.rfft(chunk, nfft, axis=0)
+        # cross[k] = sum_t p[t] x[t-k], negative lags wrap to the end
+        cross = np.fft.irfft(fft_p[:,:,None]*np.conj(fft_x)[None], nfft, axis=1)[:, lags]
+        cov = cross - sum_p[:,:,None]*sum_x[None]/n[None,:,None]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            cors[:,:,i:i+batch_size] = cov / np.sqrt(var_p[:,:,None]*var_x[None])
+    if sanitize:
+        cors = sanitize_correlations(cors)
+    return cors.reshape(len(pots), len(lags), *model_layer.shape[1:]), lags
+
+def argmax_lagged_correlation(mem_pot, model_layer, max_lag=5, min_lag=None, abs_val=False):
+    '''
+    Finds the unit and lag with the highest correlation to a 1d membrane potential.
+    At lag 0 the correlation matches max_correlation.
+
+    Args:
+        mem_pot: nd array (T,)
+        model_layer: (T, C, H, W) or (T, D) layer of activities
+        max_lag: int
+        min_lag: int or None
+            defaults to -max_lag
+        abs_val: use absolute value of correlations
+    Returns:
+        best_idx: tuple (chan, row, col) or (unit,)
+        lag: int
+        max_r: float
+    '''
+    cors, lags = lagged_correlation_matrix(mem_pot, model_layer, max_lag=max_lag, 
+                                                                    min_lag=min_lag)
+    cors = cors[0]
+    if abs_val:
+        cors = np.absolute(cors)
+    max_r, idx = argmax_unit(cors)
+    return idx[1:], int(lags[idx[0]]), max_r
+
+class CorrelationAccumulator:
+    '''
+    Accumulates the pearson correlation of a set of membrane potentials with
+    every unit of a layer as the layer response arrives in consecutive chunks
+    of time. Only running sums are kept, so the full response is never held
+    in memory. Rows received after the end of the membrane potentials are
+    ignored.
+    '''
+    def __init__(self, mem_pots, chunk_size=500):
+        """
+        mem_pots: (N, T) or (T,) numpy array of membrane potentials
+        chunk_size: int
+            number of time steps buffered before the running sums are updated
+        """
+        pots = np.asarray(mem_pots, dtype=np.float64)
+        if len(pots.shape) == 1:
+            pots = pots[None]
+        # Shifts keep the running sums of squares numerically stable
+        self.pots = pots - pots.mean(-1, keepdims=True)
+        self.chunk_size = chunk_size
+        self.buffer = []
+        self.n_buffered = 0
+        self.t = 0
+        self.shape = None
+        self.shift = None
+        self.sum_p = np.zeros(len(pots))
+        self.sum_pp = np.zeros(len(pots))
+        self.sum_x = None
+        self.sum_xx = None
+        self.sum_px = None
+
+    def update(self, x):
+        """
+        x: ndarray or torch tensor (B, ...)
+            the layer response for the next B time steps
+        """
+        if torch.is_tensor(x):
+            x = x.detach().cpu().numpy()
+        if self.shape is None:
+            self.shape = x.shape[1:]
+        self.buffer.append(x.reshape(len(x), -1))
+        self.n_buffered += len(x)
+        if self.n_buffered >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        if len(self.buffer) == 0:
+            return
+        x = np.concatenate(self.buffer, axis=0).astype(np.float64)
+        self.buffer = []
+        self.n_buffered = 0
+        x = x[:self.pots.shape[1]-self.t]
+        if len(x) == 0:
+            return
+        if self.shift is None:
+            self.shift = x.mean(0)
+            self.sum_x = np.zeros(x.shape[1])
+            self.sum_xx = np.zeros(x.shape[1])
+            self.sum_px = np.zeros((len(self.pots), x.shape[1]))
+        x = x - self.shift
+        p = self.pots[:, self.t:self.t+len(x)]
+        self.sum_p += p.sum(-1)
+        self.sum_pp += (p**2).sum(-1)
+        self.sum_x += x.sum(0)
+        self.sum_xx += (x**2).sum(0)
+        self.sum_px += p.dot(x)
+        self.t += len(x)
+
+    def correlations(self, sanitize=True):
+        """
+        Returns the correlations over all time steps received so far.
+
+        sanitize: sets nan and fishy (|r| >= 1) correlations to zero
+
+        returns:
+            cors: (N, ...) numpy array of correlations
+        """
+        self.flush()
+        n = self.t
+        with np.errstate(divide='ignore', invalid='ignore'):
+            cov = self.sum_px - self.sum_p[:,None]*self.sum_x[None]/n
+            var_p = np.maximum(self.sum_pp - self.sum_p**2/n, 0)
+            var_x = np.maximum(self.sum_xx - self.sum_x**2/n, 0)
+            cors = cov / np.sqrt(var_p[:,None]*var_x[None])
+        if sanitize:
+            cors = sanitize_correlations(cors)
+        return cors.reshape(len(cors), *self.shape)
+
+def correlation_hooks(model, mem_pots, layers, transforms=dict(), chunk_size=500):
+    """
+    Registers forward hooks that feed the outputs of the argued layers into
+    CorrelationAccumulators.
+
+    model: torch Module
+    mem_pots: (N, T) numpy array of membrane potentials
+    layers: sequence of str
+        names of the modules to correlate
+    transforms: dict
+        keys: layer names
+        vals: functions mapping the module output to a (B, ...) tensor. Useful
+            for modules with tuple outputs
+    chunk_size: int
+
+    returns:
+        accumulators: dict of CorrelationAccumulators keyed by layer
+        handles: list of hook handles. Remove them when done
+    """
+    accumulators = dict()
+    handles = []
+    for key, mod in model.named_modules():
+        if key in layers:
+            accumulators[key] = CorrelationAccumulator(mem_pots, chunk_size=chunk_size)
+            transform = transforms.get(key, lambda out: out)
+            def hook(module, inp, out, acc=accumulators[key], transform=transform):
+                acc.update(transform(out))
+            handles.append(mod.register_forward_hook(hook))
+    return accumulators, handles
+
+def streaming_correlations(model, stim, mem_pots, layers, batch_size=500, hs=None, 
+                                                transforms=dict(), device=None):
+    """
+    Runs the model over the stimulus and correlates the argued layers with the
+    membrane potentials as it goes. The rolling window of the stimulus is
+    only materialized one batch at a time.
+
+    model: torch Module
+    stim: ndarray (T, H, W)
+        the spatially padded stimulus
+    mem_pots: (N, T-depth) numpy array of membrane potentials where depth
+        is model.img_shape[0]
+    layers: sequence of str
+    batch_size: int
+        ignored for recurrent models, which are run one frame at a time
+    hs: hidden state
+        if not None, the model is treated as recurrent
+    transforms: dict
+        see correlation_hooks
+    device: torch device
+        defaults to the device of the model
+
+    returns:
+        cors: dict of (N, ...) numpy arrays of correlations keyed by layer
+    """
+    if device is None:
+        device = next(model.parameters()).device
+    windows = tdrstim.rolling_window(stim, model.img_shape[0])
+    if hs is not None:
+        batch_size = 1
+    accumulators, handles = correlation_hooks(model, mem_pots, layers, transforms, 
+                                                        chunk_size=max(batch_size, 500))
+    training = model.training
+    model.eval()
+    try:
+        with torch.no_grad():
+            for i in range(0, len(windows), batch_size):
+                x = torch.from_numpy(np.array(windows[i:i+batch_size], dtype=np.float32))
+                x = x.to(device)
+                if hs is None:
+                    model(x)
+                else:
+                    _, hs = model(x, hs)
+    finally:
+        for handle in handles:
+            handle.remove()
+        model.train(training)
+    return {k: acc.correlations() for k, acc in accumulators.items()}
+
 def correlation_map(mem_pot, model_layer):
     '''
     Takes a 1d membrane potential and computes the correlation with every tiled 
@@ -181,16 +488,7 @@ def correlation_map(mem_pot, model_layer):
         mem_pot: 1-d numpy array
         model_layer: (time, space, space) layer of activities
     '''
-    height = model_layer.shape[-2]
-    width = model_layer.shape[-1]
-    correlations = np.zeros((height, width))
-    for y in range(height):
-        for x in range(width):
-            #adjusted_layer = model_layer[:,y,x]/(np.max(model_layer[:,y,x])+1e-40)
-            #r,_ = pearsonr(mem_pot, adjusted_layer)
-            r,_ = pearsonr(mem_pot.squeeze(),model_layer[:,y,x].squeeze())
-            correlations[y,x] = r if not np.isnan(r) and r < 1 and r > -1 else 0
-    return correlations
+    return correlation_matrix(mem_pot.squeeze(), model_layer)[0]
 
 def max_correlation(mem_pot, model_layer, abs_val=False):
     '''
@@ -202,22 +500,10 @@ def max_correlation(mem_pot, model_layer, abs_val=False):
         model_layer: (time, celltype, space, space) layer of activities
         abs_val: take absolute value of correlation
     '''
-    n_chans = model_layer.shape[1]
-    if len(model_layer.shape) > 2:
-        cor_maps = [correlation_map(mem_pot,model_layer[:,c]) for c in range(n_chans)]
-        if abs_val:
-            cor_maps = [np.absolute(m) for m in cor_maps]
-        return np.max([np.max(m) for m in cor_maps])
-    else:
-        pearsons = []
-        for chan in range(model_layer.shape[1]):
-            r,_ = pearsonr(mem_pot, model_layer[:,chan])
-            pearsons.append(r)
-        # Set nan and fishy values to zero
-        pearsons = [r if not np.isnan(r) and r < 1 and r > -1 else 0 for r in pearsons]
-        if abs_val:
-            pearsons = [np.absolute(r) for r in pearsons]
-        return np.max(pearsons)
+    cors = correlation_matrix(mem_pot, model_layer)[0]
+    if abs_val:
+        cors = np.absolute(cors)
+    return np.max(cors)
 
 def sorted_correlation(mem_pot, model_layer):
     '''
@@ -228,16 +514,8 @@ def sorted_correlation(mem_pot, model_layer):
         mem_pot: 1-d numpy array
         model_layer: (time, celltype, space, space) layer of activities
     '''
-    if len(model_layer.shape) > 2:
-        n_chans = model_layer.shape[1]
-        return sorted(
-            [np.max(correlation_map(mem_pot, model_layer[:,c])) for c in range(n_chans)])
-    else:
-        #adjusted_layer = model_layer/(np.max(model_layer)+1e-40)
-        #pearsons = [pearsonr(mem_pot, adjusted_layer)[0] for c in range(model_layer.shape[1])]
-        pearsons = [pearsonr(mem_pot, model_layer[:,c])[0] for c in range(model_layer.shape[1])]
-        pearsons = [r if not np.isnan(r) and r < 1  and r > -1 else 0 for r in pearsons]
-        return sorted(pearsons)
+    cors = correlation_matrix(mem_pot, model_layer)[0]
+    return sorted(cors.reshape(len(cors), -1).max(-1))
 
 def max_correlation_all_layers(mem_pot, model_response, layer_keys=['conv1', 'conv2'], abs_val=False):
     '''
@@ -251,41 +529,45 @@ def max_correlation_all_layers(mem_pot, model_response, layer_keys=['conv1', 'co
     max_cors = [max_correlation(mem_pot, model_response[k], abs_val=abs_val) for k in layer_keys]
     return max(max_cors)
 
+def argmax_unit(cors, idx=tuple()):
+    """
+    Finds the most correlated unit in an array of sanitized correlations. Ties
+    go to the first unit in C order.
+
+    cors: ndarray (...)
+    idx: tuple
+        prepended to the returned index
+
+    Returns:
+        max_r: float
+        best_idx: tuple
+    """
+    if cors.size == 0:
+        return -1, None
+    flat_idx = np.argmax(cors)
+    best_idx = (*idx, *[int(i) for i in np.unravel_index(flat_idx, cors.shape)])
+    return cors.reshape(-1)[flat_idx], best_idx
+
 def argmax_correlation_recurse_helper(mem_pot, model_layer, shape, idx, abs_val=False):
     """
-    Recursively searches model_layer units to find the unit with the best pearsonr.
+    Searches the model_layer units below idx to find the unit with the best pearsonr.
 
     mem_pot: membrane potential ndarray (N,)
     model_layer: ndarray (N,C) or (N,C,H,W)
     shape: list
+        the remaining dims of model_layer below idx
     idx: int
 
     Returns:
         best_idx: tuple (chan, row, col)
             most correlated idx
     """
-    if len(shape) == 0: # base case
-        layer = model_layer[:,idx[0]]
-        # Does nothing if model_layer was originally (time, celltype) dims
-        # Otherwise sequentially widdles layer down to 1 dimension
-        for i in idx[1:]: 
-            # Sequentially selects dims of the model resulting in layer[:,idx[1],idx[2]...]
-            layer = layer[:,i] 
-        r, _ = pearsonr(mem_pot, layer)
-        if abs_val:
-            r = np.absolute(r)
-        if np.isnan(r) or r >= 1 or r <= -1: r = 0
-        return r, idx
-    else:
-        max_r = -1
-        best_idx = None
-        for i in range(shape[0]):
-            args = (mem_pot, model_layer, shape[1:], (*idx, i), abs_val)
-            r, local_idx = argmax_correlation_recurse_helper(*args)
-            if not np.isnan(r) and r < 1 and r > max_r:
-                max_r = r
-                best_idx = local_idx
-        return max_r, best_idx
+    layer = model_layer[(slice(None), *idx)]
+    cors = correlation_matrix(mem_pot, layer, sanitize=False)[0]
+    if abs_val:
+        cors = np.absolute(cors)
+    cors = sanitize_correlations(cors)
+    return argmax_unit(cors, tuple(idx))
 
 def argmax_correlation(mem_pot, model_layer, ret_max_cor=False, abs_val=False):
     '''
@@ -302,14 +584,8 @@ def argmax_correlation(mem_pot, model_layer, ret_max_cor=False, abs_val=False):
         max_r: float
     '''
     assert len(model_layer.shape) >= 2
-    max_r = -1
-    best_idx = None
-    for i in range(model_layer.shape[1]):
-        r, idx = argmax_correlation_recurse_helper(mem_pot,model_layer,
-                                        model_layer.shape[2:],(i,), abs_val=abs_val)
-        if not np.isnan(r) and r < 1 and r > max_r:
-            max_r = r
-            best_idx = idx
+    max_r, best_idx = argmax_correlation_recurse_helper(mem_pot, model_layer,
+                                        model_layer.shape[1:], tuple(), abs_val=abs_val)
     if ret_max_cor:
         return best_idx, max_r
     return best_idx
@@ -356,31 +632,30 @@ def get_intr_cors(model, stim_dict, mem_pot_dict, layers={"sequential.2", "seque
     for cell_file in stim_dict.keys():
         for stim_type in stim_dict[cell_file].keys():
             stim = tdrstim.spatial_pad(stim_dict[cell_file][stim_type],model.img_shape[1])
-            stim = tdrstim.rolling_window(stim, model.img_shape[0])
+            pots = mem_pot_dict[cell_file][stim_type]
             if verbose:
                 temp = cell_file.split("/")[-1].split(".")[0]
                 cellstim = "cell_file:{}, stim_type:{}...".format(temp, stim_type)
-                print("Collecting model response for "+cellstim)
-            response = tdrutils.inspect(model, stim, insp_keys=layers, batch_size=batch_size,
-                                                                               to_numpy=True)
-            pots = mem_pot_dict[cell_file][stim_type]
+                print("Correlating model response for "+cellstim)
+            layer_cors = streaming_correlations(model, stim, pots, layers, 
+                                                        batch_size=batch_size)
+            for layer in layers:
+                cors = layer_cors[layer]
+                if len(cors.shape) == 2 and layer == "sequential.2":
+                    cors = cors.reshape(len(pots), model.chans[0], *model.shapes[0])
+                elif len(cors.shape) == 2 and layer == "sequential.8":
+                    cors = cors.reshape(len(pots), model.chans[1], *model.shapes[1])
+                layer_cors[layer] = cors
             rnge = range(len(pots))
             if verbose:
-                print("Correlating with data...")
                 rnge = tqdm(rnge)
             best_cors = []
             for cell_idx in rnge:
                 best_cor = -1
                 for layer in layers:
-                    resp = response[layer]
-                    if len(resp.shape) == 2 and layer == "sequential.2":
-                        resp = resp.reshape(-1, model.chans[0], *model.shapes[0])
-                    elif len(resp.shape) == 2 and layer == "sequential.8":
-                        resp = resp.reshape(-1, model.chans[1], *model.shapes[1])
-
-                    for chan in range(resp.shape[1]):
-                        r, idx = argmax_correlation_recurse_helper(pots[cell_idx], resp,
-                                                       shape=resp.shape[2:], idx=(chan,))
+                    cors = layer_cors[layer][cell_idx]
+                    for chan in range(cors.shape[0]):
+                        r, idx = argmax_unit(cors[chan], (chan,))
                         _, row, col = idx
                         intr_cors['cell_file'].append(cell_file)
                         intr_cors['cell_idx'].append(cell_idx)
@@ -451,16 +726,17 @@ def get_cor_generalization(model, stim_dict, mem_pot_dict,layers={"sequential.2"
             responses[stim_type] = response
         for stim_type in stim_dict[cell_file].keys():
             pots = mem_pot_dict[cell_file][stim_type]
+            layer_cors = {layer: correlation_matrix(pots, responses[stim_type][layer])
+                                                                    for layer in layers}
             for cell_idx in range(len(pots)):
                 for l,layer in enumerate(layers):
                     if verbose:
                         name = cell_file.split("/")[-1]
                         print("Evaluating file:{}, stim:{}, idx:{}, layer:{}".format(name, 
                                                                  stim_type,cell_idx,layer))
-                    resp = responses[stim_type][layer]
-                    for chan in range(resp.shape[1]):
-                        r, idx = argmax_correlation_recurse_helper(pots[cell_idx], resp,
-                                                       shape=resp.shape[2:], idx=(chan,))
+                    cors = layer_cors[layer][cell_idx]
+                    for chan in range(cors.shape[0]):
+                        r, idx = argmax_unit(cors[chan], (chan,))
                         _, row, col = idx
                         table['cell_file'].append(cell_file)
                         table['cell_idx'].append(cell_idx)
@@ -513,10 +789,11 @@ def get_correlation_stats(mem_pot, model_response,
         model_layer = model_response[layer_key]
         assert len(model_layer.shape) >= 3
         cor_stats[layer_key] = []
+        cors = correlation_matrix(mem_pot, model_layer)[0]
+        if abs_val:
+            cors = np.absolute(cors)
         for chan in range(model_layer.shape[1]):
-            r, idx = argmax_correlation_recurse_helper(mem_pot,model_layer,
-                                                        shape=model_layer.shape[2:],
-                                                        idx=(chan,), abs_val=abs_val)
+            r, idx = argmax_unit(cors[chan], (chan,))
             _, row, col = idx
             cor_stats[layer_key].append((row,col,r))
     return cor_stats
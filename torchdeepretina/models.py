@@ -509,15 +509,15 @@ class KineticsModel(TDRModel):
     def forward(self, x, hs):
         """
         x - FloatTensor (B, C, H, W)
-        hs - list [(B,S,N),(B,D,H1,W1)]
+        hs - list [(B,S,N),RingBuffer (B,D,N)]
             First list element should be a torch FloatTensor of state population values.
-            Second element should be deque of activated population values over past D time steps
+            Second element should be a RingBuffer of activated population values over past D time steps
         """
         fx = self.bipolar(x)
         fx, h0 = self.kinetics(fx, hs[0])
         hs[1].append(fx)
         h1 = hs[1]
-        fx = torch.cat(list(h1), dim=1)
+        fx = h1.ordered().reshape(len(fx), -1)
         if self.scale_kinet:
             fx = self.kinet_scale(fx)
         fx = self.amacrine(fx)
@@ -2,71 +2,101 @@ import torch
 import torch.nn as nn
 
 class Physio:
-    def __init__(self, net):
+    '''
+    Records the activity of the layers of a network through forward hooks.
+    The hooks are registered on the first call to inspect and are reused by
+    later calls with the same layers, so a network can be inspected batch by
+    batch without re-registering them. Gradients are only recorded if
+    requested.
+    '''
+    def __init__(self, net, to_numpy=True, grads=False):
+        """
+        net - torch Module
+        to_numpy - bool
+            if true, activities are stored as ndarrays. Otherwise they are kept
+            as detached tensors on the device of the network
+        grads - bool
+            if true, the gradients of the layer outputs are recorded under
+            <name>_grad during backward passes
+        """
         self.net = net
         self.dict = {}
+        self.to_numpy = to_numpy
+        self.grads = grads
         self.inspect_hooks = False
         self.hooks = []
-    
+        self.hook_keys = None
+
+    def convert(self, out):
+        out = out.detach()
+        if self.to_numpy:
+            return out.cpu().numpy()
+        return out
+
     def layer_activity(self, name):
         def hook(module, inp, out):
-            self.dict[name] = out.cpu().detach().numpy()
+            if torch.is_tensor(out):
+                self.dict[name] = self.convert(out)
         return hook
-      
+
     def layer_grad(self, name):
-        def hook(module, inp, out):
-            self.dict[name+'_grad'] = out[0].cpu().detach().numpy()
+        def hook(module, grad_inp, grad_out):
+            self.dict[name+'_grad'] = self.convert(grad_out[0])
         return hook
 
     def injection(self, subtype, constant):
         def hook(module, inp, out):
             module.weight[subtype, :, :] = module.weight[subtype, :, :] * constant
             module.bias[subtype] = module.bias[subtype] * constant
+        return hook
+
+    def get_modules(self, insp_keys):
+        """
+        Returns the (name, module) pairs selected by insp_keys. "all" selects
+        every submodule of the network.
+        """
+        if "all" in insp_keys:
+            return [(name, mod) for name, mod in self.net.named_modules() if name != ""]
+        return [(name, mod) for name, mod in self.net.named_modules() if name in insp_keys]
+
+    def register_hooks(self, insp_keys):
+        """
+        Registers the hooks of the argued layers, replacing the hooks of a
+        previous selection. Does nothing if the selection is unchanged.
+        """
+        keys = (frozenset(insp_keys), self.grads)
+        if keys == self.hook_keys:
+            return
+        self.remove_hooks()
+        for name, module in self.get_modules(insp_keys):
+            self.hooks.append(module.register_forward_hook(self.layer_activity(name)))
+            if self.grads:
+                self.hooks.append(module.register_full_backward_hook(self.layer_grad(name)))
+        self.hook_keys = keys
 
     # activity_dict = phys.inspect(stim)
     # activity_dict['conv1'] <--- gets the conv2d_1 layer activity
     def inspect(self, stim, hs=None, insp_keys={"all"}):
-        if len(self.hooks) <= 0:
-            for name, module in self.net.named_modules():
-                if name in insp_keys or "all" in insp_keys:
-                    self.hooks.append(module.register_forward_hook(self.layer_activity(name)))
-                    self.hooks.append(module.register_backward_hook(self.layer_grad(name)))
+        self.register_hooks(insp_keys)
         if hs is not None:
             self.dict['output'], hs = self.net(stim, hs)
             return self.dict, hs
         else:
             self.dict['output'] = self.net(stim)
             return self.dict
-    
+
     # phys.inject('conv1', 1, 2)
     # then do a forward pass
     def inject(self, layer, subtype, constant):
         for name, module in self.net.named_modules():
             if name == layer:
                 module.register_forward_hook(self.injection(subtype, constant))
+
     def remove_hooks(self):
         for h in self.hooks:
             h.remove()
         self.hooks = []
+        self.hook_keys = None
 
     def remove_refs(self):
-        for k,v in list(self.dict.items()):
-            try:
-                self.dict[k].detach().cpu()
-                del self.dict[k]
-            except:
-                pass
-
-
-
-
-
-
-
-
-
-
-
-
-
-
+        self.dict = {}
@@ -10,38 +10,210 @@ from itertools import repeat
 import torchdeepretina.stimuli as stim
 import torchdeepretina.visualizations as viz
 from torchdeepretina.utils import compute_sta, batch_compute_model_response, inspect_rnn
+from torchdeepretina.torch_utils import RingBuffer
 from tqdm import tqdm, trange
 import torch
 
 DEVICE = torch.device("cuda:0")
 
-def step_response(device, I20=None, model=None, duration=100, delay=50, nsamples=200, intensity=-1., filt_depth=40):
-    """Step response"""
-    X = stim.concat(stim.flash(duration, delay, nsamples, intensity=intensity), nh=filt_depth)
-    X_torch = torch.from_numpy(X).to(device)
+def is_recurrent(model):
+    """
+    Models with hidden states define h_shapes. The models in kinetic/models.py
+    do not set the recurrent flag of TDRModel.
+    """
+    return getattr(model, 'recurrent', hasattr(model, 'h_shapes'))
+
+def is_kinetic(model):
+    return getattr(model, 'kinetic', not hasattr(model, 'recurrent'))
+
+def init_hs(model, device, I20=None):
+    """
+    Builds the initial hidden state of a single stimulus lane.
+
+    Kinetic models start fully in the resting state with an optional initial
+    I2 occupancy I20, as in kinetic.utils.get_hs. Kinetic models with a list
+    of h_shapes use a ring buffer history as their second state. Models with
+    an inhibitory kinetics pathway (kinetics_inh) use the 'double' mode of
+    get_hs. Other recurrent models start at zeros.
+
+    model - torch Module
+    device - torch device
+    I20 - ndarray or None
+        initial I2 occupancy for kinetic models. For 'double' mode models, a
+        pair of them for the excitatory and inhibitory kinetics
+    """
+    if hasattr(model, 'kinetics_inh'):
+        I20 = (None, None) if I20 is None else I20
+        h_shapes = (model.h_shapes, (model.h_shapes[0], 1, *model.h_shapes[2:]))
+        hs = tuple(torch.zeros(1, *h).to(device) for h in h_shapes)
+        for h, i20 in zip(hs, I20):
+            h[:,0] = 1
+            if isinstance(i20, np.ndarray):
+                h[:,3] = torch.from_numpy(i20)[:,None].to(device)
+        return hs
+    if isinstance(model.h_shapes, list):
+        hs = [torch.zeros(1, *h).to(device) for h in model.h_shapes]
+        if is_kinetic(model):
+            hs[0][:,0] = 1
+            if isinstance(I20, np.ndarray):
+                hs[0][:,3] = torch.from_numpy(I20)[:,None].to(device)
+            hs[1] = RingBuffer(torch.zeros(1, model.seq_len, *model.h_shapes[1]).to(device))
+        return hs
+    hs = torch.zeros(1, *model.h_shapes).to(device)
+    hs[:,0] = 1
+    if isinstance(I20, np.ndarray):
+        hs[:,3] = torch.from_numpy(I20)[:,None].to(device)
+    return hs
+
+def expand_hs(hs, n_lanes):
+    """
+    Repeats a batch size 1 hidden state along the batch dimension.
+
+    hs - FloatTensor, RingBuffer or list/tuple of them
+    n_lanes - int
+    """
+    if isinstance(hs, (list, tuple)):
+        return type(hs)(expand_hs(h, n_lanes) for h in hs)
+    if hasattr(hs, 'idx'):
+        return type(hs)(expand_hs(hs.data, n_lanes), hs.idx)
+    return hs.repeat(n_lanes, *[1 for _ in hs.shape[1:]])
+
+def repeat_lengths(stimuli, chunk_size=64):
+    """
+    Counts, for each time point, the number of consecutive windows starting at
+    that time point that are identical in every lane. Lanes are zero padded to
+    the longest stimulus as in simulate.
+
+    stimuli - list of ndarrays or FloatTensors [(T_i, D, H, W), ...]
+    chunk_size - int
+        number of windows compared at a time
+
+    returns:
+        lengths - ndarray (T,)
+    """
+    n_steps = max(len(s) for s in stimuli)
+    same = np.ones(max(n_steps-1, 0), dtype=bool)
+    for s in stimuli:
+        for i in range(0, len(s)-1, chunk_size):
+            x = torch.as_tensor(s[i:i+chunk_size+1]).reshape(-1, int(np.prod(s.shape[1:])))
+            same[i:i+len(x)-1] &= (x[1:] == x[:-1]).all(1).numpy()
+        if len(s) < n_steps:
+            same[len(s)-1] &= not bool(torch.as_tensor(s[-1]).any())
+    lengths = np.ones(n_steps, dtype=int)
+    for t in reversed(range(n_steps-1)):
+        if same[t]:
+            lengths[t] = lengths[t+1] + 1
+    return lengths
+
+def simulate(model, stimuli, hs_init=None, record=None, batch_size=500, device=None, step_fn=None,
+                                                                    fast_forward=False, min_run=8):
+    """
+    Computes the model responses to a list of stimuli.
+
+    Recurrent models run all stimuli simultaneously as lanes of a single batch,
+    one frame per step, each lane starting from a copy of hs_init. Shorter stimuli
+    are zero padded at their end, which does not affect their responses as the
+    padding comes after them. Feedforward models run each stimulus in batches.
+
+    model - torch Module
+    stimuli - list of ndarrays or FloatTensors [(T_i, D, H, W), ...]
+        the stimuli, already in rolling window form
+    hs_init - hidden state with batch size 1 or None
+        the initial state of each lane. If None, init_hs(model, device) is used.
+        Ignored for feedforward models.
+    record - sequence of str or None
+        names of modules (as in model.named_modules()) whose outputs are recorded
+    batch_size - int
+        batch size used for feedforward models and longest fast forwarded run
+    device - torch device or None
+        defaults to the device of the model parameters
+    step_fn - callable or None
+        used in place of model for each step of recurrent models, i.e.
+        kinetic.compiled.CompiledModel(model). Recorded modules must still
+        be called by step_fn.
+    fast_forward - bool
+        if true, runs of at least min_run identical windows (in every lane) are
+        computed with model.fast_forward(x, hs, n_steps), which computes the
+        layers before the kinetics once and steps the kinetics alone with
+        Kinetics.run. Ignored for models without fast_forward and when recording
+    min_run - int
+        shortest run that is fast forwarded
+
+    returns:
+        responses - list of ndarrays [(T_i, N), ...]
+            the model outputs, aligned with the stimuli
+        recordings - dict of lists of ndarrays {name: [(T_i, ...), ...]}
+            only returned if record is not None
+    """
+    if device is None:
+        device = next(model.parameters()).device
+    if step_fn is None:
+        step_fn = model
+    lengths = [len(s) for s in stimuli]
+
+    outs = {name: [] for name in (record or [])}
+    handles = []
+    for name, mod in model.named_modules():
+        if name in outs:
+            hook = lambda mod, inp, out, name=name: outs[name].append(out.detach().cpu())
+            handles.append(mod.register_forward_hook(hook))
+
+    resps = []
     with torch.no_grad():
-        if model.kinetic:
-            hs = get_hs(model, 1, device, I20)
-            resps = []
-            for i in range(X_torch.shape[0]):
-                resp, hs = model(X_torch[i:i+1], hs)
-                resps.append(resp)
-            resp = torch.cat(resps, dim=0)        
-        elif model.recurrent:
-            hs = [torch.zeros(1,*h).to(device) for h in model.h_shapes]
-            resps = []
-            for i in range(X_torch.shape[0]):
-                resp, hs = model(X_torch[i:i+1], hs)
-                resps.append(resp)
-            resp = torch.cat(resps, dim=0)
+        if is_recurrent(model):
+            hs = init_hs(model, device) if hs_init is None else hs_init
+            hs = expand_hs(hs, len(stimuli))
+            pad = torch.zeros(*stimuli[0].shape[1:])
+            fast_forward = fast_forward and hasattr(model, 'fast_forward') and record is None
+            runs = repeat_lengths(stimuli) if fast_forward else None
+            t = 0
+            while t < max(lengths):
+                x = [torch.as_tensor(s[t]) if t < len(s) else pad for s in stimuli]
+                x = torch.stack(x, dim=0).float().to(device)
+                if fast_forward and runs[t] >= min_run:
+                    n_steps = min(int(runs[t]), batch_size)
+                    resp, hs = model.fast_forward(x, hs, n_steps)
+                    t += n_steps
+                else:
+                    resp, hs = step_fn(x, hs)
+                    resp = resp[:,None]
+                    t += 1
+                resps.append(resp.cpu())
+            resps = torch.cat(resps, dim=1).numpy()
+            responses = [r[:l] for r,l in zip(resps, lengths)]
+            recordings = {k: [r[:l] for r,l in zip(torch.stack(v, dim=1).numpy(), lengths)]
+                                                                for k,v in outs.items()}
         else:
-            resp = model(X_torch)
-    figs = viz.response1D(X[:, -1, 0, 0].copy(), resp.cpu().detach().numpy())
+            for s in stimuli:
+                for i in range(0, len(s), batch_size):
+                    x = torch.as_tensor(s[i:i+batch_size]).float().to(device)
+                    resps.append(model(x).cpu())
+            splits = np.cumsum(lengths)[:-1]
+            responses = np.split(torch.cat(resps, dim=0).numpy(), splits)
+            recordings = {k: np.split(torch.cat(v, dim=0).numpy(), splits) for k,v in outs.items()}
+
+    for handle in handles:
+        handle.remove()
+    if record is None:
+        return responses
+    return responses, recordings
+
+def step_response_stimuli(duration=100, delay=50, nsamples=200, intensity=-1., filt_depth=40):
+    return stim.concat(stim.flash(duration, delay, nsamples, intensity=intensity), nh=filt_depth)
+
+def step_response(device, I20=None, model=None, duration=100, delay=50, nsamples=200, intensity=-1., filt_depth=40,
+                                                                                    hs_init=None, step_fn=None):
+    """Step response"""
+    X = step_response_stimuli(duration, delay, nsamples, intensity, filt_depth)
+    if is_recurrent(model) and hs_init is None:
+        hs_init = init_hs(model, device, I20)
+    resp = simulate(model, [X], hs_init, device=device, step_fn=step_fn)[0]
+    figs = viz.response1D(X[:, -1, 0, 0].copy(), resp)
     (fig, (ax0,ax1)) = figs
     return (fig, (ax0,ax1)), X, resp
 
 
-def paired_flash(model, ifis=(2, 20), duration=1, intensity=-2.0, total=100, delay=40):
+def paired_flash(model, ifis=(2, 20), duration=1, intensity=-2.0, total=100, delay=40, hs_init=None, step_fn=None):
     """Generates responses to a pair of neighboring flashes
     Parameters
     ----------
@@ -54,110 +226,62 @@ def paired_flash(model, ifis=(2, 20), duration=1, intensity=-2.0, total=100, del
     padding : int
         how much padding in frames to put on either side of the flash (default: 50)
     """
-    s1, r1, s2, r2 = [], [], [], []
-    stimuli = []
-    responses = []
-
-    for ifi in tqdm(np.arange(ifis[0], ifis[1], duration)):
+    s1, s2, stimuli = [], [], []
+    xs = []
+    for ifi in np.arange(ifis[0], ifis[1], duration):
         # single flashes
         x1 = stim.paired_flashes(ifi, duration, (intensity, 0), total, delay)
         s1.append(stim.unroll(x1)[:, 0, 0])
-        x1_torch = torch.from_numpy(x1).to(DEVICE)
-        with torch.no_grad():
-            if model.recurrent:
-                hs = [torch.zeros(1,*h).to(device) for h in model.h_shapes]
-                resps = []
-                for i in range(x1_torch.shape[0]):
-                    resp, hs = model(x1_torch[i:i+1], hs)
-                    resps.append(resp)
-                resp = torch.cat(resps, dim=0)
-            else:
-                resp = model(x1_torch)
-        r1.append(stim.prepad(resp.cpu().detach().numpy()))
-
         x2 = stim.paired_flashes(ifi, duration, (0, intensity), total, delay)
-        x2_torch = torch.from_numpy(x2).to(DEVICE)
         s2.append(stim.unroll(x2)[:, 0, 0])
-        with torch.no_grad():
-            if model.recurrent:
-                hs = [torch.zeros(1,*h).to(device) for h in model.h_shapes]
-                resps = []
-                for i in range(x2_torch.shape[0]):
-                    resp, hs = model(x2_torch[i:i+1], hs)
-                    resps.append(resp)
-                resp = torch.cat(resps, dim=0)
-            else:
-                resp = model(x2_torch)
-        r2.append(stim.prepad(resp.cpu().detach().numpy()))
-
         # pair
         x = stim.paired_flashes(ifi, duration, intensity, total, delay)
-        x_torch = torch.from_numpy(x).to(DEVICE)
         stimuli.append(stim.unroll(x)[:, 0, 0])
-        with torch.no_grad():
-            if model.recurrent:
-                hs = [torch.zeros(1,*h).to(device) for h in model.h_shapes]
-                resps = []
-                for i in range(x_torch.shape[0]):
-                    resp, hs = model(x_torch[i:i+1], hs)
-                    resps.append(resp)
-                resp = torch.cat(resps, dim=0)
-            else:
-                resp = model(x_torch)
-        responses.append(stim.prepad(resp.cpu().detach().numpy()))
+        xs.extend([x1, x2, x])
+
+    resps = [stim.prepad(r) for r in simulate(model, xs, hs_init, step_fn=step_fn)]
+    r1, r2, responses = resps[0::3], resps[1::3], resps[2::3]
 
     return map(np.stack, (s1, r1, s2, r2, stimuli, responses))
 
 
-def reversing_grating(device, I20=None, model=None, size=5, phase=0., filt_depth=40):
-    """A reversing grating stimulus"""
+def reversing_grating_stimuli(size=5, phase=0., filt_depth=40):
     grating = stim.grating(barsize=(size, 0), phase=(phase, 0.0), intensity=(1.0, 1.0), us_factor=1, blur=0)
-    X = stim.concat(stim.reverse(grating, halfperiod=50, nsamples=300), nh=filt_depth)
-    X_torch = torch.from_numpy(X).to(device)
-    with torch.no_grad():
-        if model.kinetic:
-            hs = get_hs(model, 1, device, I20)
-            resps = []
-            for i in range(X_torch.shape[0]):
-                resp, hs = model(X_torch[i:i+1], hs)
-                resps.append(resp)
-            resp = torch.cat(resps, dim=0)
-        elif model.recurrent:
-            hs = [torch.zeros(1,*h).to(device) for h in model.h_shapes]
-            resps = []
-            for i in range(X_torch.shape[0]):
-                resp, hs = model(X_torch[i:i+1], hs)
-                resps.append(resp)
-            resp = torch.cat(resps, dim=0)
-        else:
-            resp = model(X_torch)
-    figs = viz.response1D(X[:, -1, 0, 0].copy(), resp.cpu().detach().numpy())
+    return stim.concat(stim.reverse(grating, halfperiod=50, nsamples=300), nh=filt_depth)
+
+def reversing_grating(device, I20=None, model=None, size=5, phase=0., filt_depth=40, hs_init=None, step_fn=None):
+    """A reversing grating stimulus"""
+    X = reversing_grating_stimuli(size, phase, filt_depth)
+    if is_recurrent(model) and hs_init is None:
+        hs_init = init_hs(model, device, I20)
+    resp = simulate(model, [X], hs_init, device=device, step_fn=step_fn)[0]
+    figs = viz.response1D(X[:, -1, 0, 0].copy(), resp)
     (fig, (ax0,ax1)) = figs
     return (fig, (ax0,ax1)), X, resp
 
 
-def contrast_adaptation(model, c0, c1, duration=50, delay=50, nsamples=140, nrepeats=10, filt_depth=40):
-    """Step change in contrast"""
+def contrast_adaptation_stimuli(c0, c1, duration=50, delay=50, nsamples=140, nrepeats=10, filt_depth=40, seed=None):
+    """
+    Builds nrepeats random noise stimuli with a step change in contrast from c0 to c1.
 
-    # the contrast envelope
+    returns:
+        envelope - ndarray (nsamples, 1, 1)
+            the contrast envelope
+        xs - list of nrepeats ndarrays
+    """
+    rng = np.random if seed is None else np.random.RandomState(seed)
     envelope = stim.flash(duration, delay, nsamples, intensity=(c1 - c0))
     envelope += c0
+    xs = [stim.concat(rng.randn(*envelope.shape) * envelope, nh=filt_depth) for _ in range(nrepeats)]
+    return envelope, xs
+
+def contrast_adaptation(model, c0, c1, duration=50, delay=50, nsamples=140, nrepeats=10, filt_depth=40,
+                                                                             hs_init=None, step_fn=None):
+    """Step change in contrast"""
 
     # generate a bunch of responses to random noise with the given contrast envelope
-    responses = []
-    with torch.no_grad():
-        for _ in trange(nrepeats):
-            x = torch.from_numpy(stim.concat(np.random.randn(*envelope.shape) * envelope, nh=filt_depth)).to(DEVICE)
-            if model.recurrent:
-                hs = [torch.zeros(1,*h).to(device) for h in model.h_shapes]
-                resps = []
-                for i in range(x.shape[0]):
-                    resp, hs = model(x[i:i+1], hs)
-                    resps.append(resp)
-                resp = torch.cat(resps, dim=0)
-            else:
-                resp = model(x)
-            responses.append(resp.cpu().detach().numpy())
+    envelope, xs = contrast_adaptation_stimuli(c0, c1, duration, delay, nsamples, nrepeats, filt_depth)
+    responses = simulate(model, xs, hs_init, step_fn=step_fn)
 
     responses = np.asarray(responses)
     figs = viz.response1D(envelope[40:, 0, 0], responses.mean(axis=0))
@@ -165,7 +289,49 @@ def contrast_adaptation(model, c0, c1, duration=50, delay=50, nsamples=140, nrep
 
     return (fig, (ax0,ax1)), envelope, responses
 
-def oms_random_differential(device, I20=None, model=None, duration=5, sample_rate=30, pre_frames=40, post_frames=40, img_shape=(50,50), center=(25,25), radius=8, background_velocity=.3, foreground_velocity=.5, seed=None, bar_size=2, inner_bar_size=None, filt_depth=40):
+def oms_random_differential_stimuli(duration=5, sample_rate=30, pre_frames=40, post_frames=40, img_shape=(50,50),
+                                                center=(25,25), radius=8, background_velocity=.3,
+                                                foreground_velocity=.5, seed=None, bar_size=2, inner_bar_size=None):
+    """
+    Builds the differential and global motion videos of oms_random_differential.
+    See oms_random_differential for the parameters.
+
+    returns:
+        diff_vid - ndarray (T, H, W)
+        global_vid - ndarray (T, H, W)
+    """
+    rng = np.random if seed is None else np.random.RandomState(seed)
+    tot_frames = int(duration * sample_rate)
+    diff_frames = int(tot_frames-pre_frames-post_frames)
+    assert diff_frames > 0
+    differential, _, _ = stim.random_differential_circle(diff_frames, bar_size=bar_size, inner_bar_size=inner_bar_size,
+                                    foreground_velocity=foreground_velocity, 
+                                    background_velocity=background_velocity,
+                                    image_shape=img_shape, center=center, radius=radius, rng=rng)
+    pre_vid = np.repeat(differential[:1], pre_frames, axis=0)
+    post_vid = np.repeat(differential[-1:], post_frames, axis=0)
+    diff_vid = np.concatenate([pre_vid, differential, post_vid], axis=0)
+
+    global_velocity = foreground_velocity if foreground_velocity != 0 else background_velocity
+    global_, _, _ = stim.random_differential_circle(diff_frames, bar_size=bar_size, inner_bar_size=inner_bar_size,
+                                    foreground_velocity=global_velocity, sync_jitters=True,
+                                    background_velocity=global_velocity, 
+                                    image_shape=img_shape, center=center, radius=radius, 
+                                    horizontal_foreground=False, horizontal_background=False, rng=rng)
+    pre_vid = np.repeat(global_[:1], pre_frames, axis=0)
+    post_vid = np.repeat(global_[-1:], post_frames, axis=0)
+    global_vid = np.concatenate([pre_vid, global_, post_vid], axis=0)
+    return diff_vid, global_vid
+
+def oms_fig(diff_response, global_response):
+    fig = plt.figure(figsize=(6, 4))
+    ax = fig.add_subplot(111)
+    ax.plot(diff_response.mean(-1), color="g")
+    ax.plot(global_response.mean(-1), color="b")
+    ax.legend(["diff", "global"])
+    return fig
+
+def oms_random_differential(device, I20=None, model=None, duration=5, sample_rate=30, pre_frames=40, post_frames=40, img_shape=(50,50), center=(25,25), radius=8, background_velocity=.3, foreground_velocity=.5, seed=None, bar_size=2, inner_bar_size=None, filt_depth=40, hs_init=None, step_fn=None):
     """
     Plays a video of differential motion by keeping a circular window fixed in space on a 2d background grating.
     A grating exists behind the circular window that moves counter to the background grating. Each grating is jittered
@@ -196,80 +362,23 @@ def oms_random_differential(device, I20=None, model=None, duration=5, sample_rat
     inner_bar_size: int
         size of grating bars inside circle. If None, set to bar_size
     """
-    if seed is not None:
-        np.random.seed(seed)
+    diff_vid, global_vid = oms_random_differential_stimuli(duration, sample_rate, pre_frames, post_frames,
+                                                img_shape, center, radius, background_velocity,
+                                                foreground_velocity, seed, bar_size, inner_bar_size)
     tot_frames = int(duration * sample_rate)
-    diff_frames = int(tot_frames-pre_frames-post_frames)
-    assert diff_frames > 0
-    differential, _, _ = stim.random_differential_circle(diff_frames, bar_size=bar_size, inner_bar_size=inner_bar_size,
-                                    foreground_velocity=foreground_velocity, 
-                                    background_velocity=background_velocity,
-                                    image_shape=img_shape, center=center, radius=radius) 
-    pre_vid = np.repeat(differential[:1], pre_frames, axis=0)
-    post_vid = np.repeat(differential[-1:], post_frames, axis=0)
-    diff_vid = np.concatenate([pre_vid, differential, post_vid], axis=0)
-
-    global_velocity = foreground_velocity if foreground_velocity != 0 else background_velocity
-    global_, _, _ = stim.random_differential_circle(diff_frames, bar_size=bar_size, inner_bar_size=inner_bar_size,
-                                    foreground_velocity=global_velocity, sync_jitters=True,
-                                    background_velocity=global_velocity, 
-                                    image_shape=img_shape, center=center, radius=radius, 
-                                    horizontal_foreground=False, horizontal_background=False)
-    pre_vid = np.repeat(global_[:1], pre_frames, axis=0)
-    post_vid = np.repeat(global_[-1:], post_frames, axis=0)
-    global_vid = np.concatenate([pre_vid, global_, post_vid], axis=0)
     
     if model is None:
         fig = None
         diff_response = None
         global_response = None
     else:
-        x = torch.FloatTensor(stim.concat(diff_vid, nh=filt_depth)).to(device)
-        with torch.no_grad():
-            if model.kinetic:
-                hs = get_hs(model, 1, device, I20)
-                resps = []
-                for i in range(x.shape[0]):
-                    resp, hs = model(x[i:i+1], hs)
-                    resps.append(resp)
-                resp = torch.cat(resps, dim=0)
-            elif model.recurrent:
-                hs = [torch.zeros(1,*h).to(device) for h in model.h_shapes]
-                resps = []
-                for i in range(x.shape[0]):
-                    resp, hs = model(x[i:i+1], hs)
-                    resps.append(resp)
-                resp = torch.cat(resps, dim=0)
-            else:
-                resp = model(x)
-        diff_response = resp.cpu().detach().numpy()
-
-        x = torch.FloatTensor(stim.concat(global_vid, nh=filt_depth)).to(device)
-        with torch.no_grad():
-            if model.kinetic:
-                hs = get_hs(model, 1, device, I20)
-                resps = []
-                for i in range(x.shape[0]):
-                    resp, hs = model(x[i:i+1], hs)
-                    resps.append(resp)
-                resp = torch.cat(resps, dim=0)
-            elif model.recurrent:
-                hs = [torch.zeros(1,*h).to(device) for h in model.h_shapes]
-                resps = []
-                for i in range(x.shape[0]):
-                    resp, hs = model(x[i:i+1], hs)
-                    resps.append(resp)
-                resp = torch.cat(resps, dim=0)
-            else:
-                resp = model(x)
-        global_response = resp.cpu().detach().numpy()
+        if is_recurrent(model) and hs_init is None:
+            hs_init = init_hs(model, device, I20)
+        xs = [stim.concat(diff_vid, nh=filt_depth), stim.concat(global_vid, nh=filt_depth)]
+        diff_response, global_response = simulate(model, xs, hs_init, device=device, step_fn=step_fn)
 
         # generate the figure
-        fig = plt.figure(figsize=(6, 4))
-        ax = fig.add_subplot(111)
-        ax.plot(diff_response.mean(-1), color="g")
-        ax.plot(global_response.mean(-1), color="b")
-        ax.legend(["diff", "global"])
+        fig = oms_fig(diff_response, global_response)
         diff_response = diff_response[pre_frames-40:tot_frames-post_frames]
         global_response = global_response[pre_frames-40:tot_frames-post_frames]
     return fig, diff_vid, global_vid, diff_response, global_response
@@ -346,7 +455,7 @@ def periodic_differential(duration=5, sample_rate=30, pre_frames=40,
         vid.append(global_vid)
     return np.concatenate(vid, axis=0)
 
-def oms_differential(model, duration=5, sample_rate=30, pre_frames=40, post_frames=40, img_shape=(50,50), center=(25,25), radius=8, background_velocity=0, foreground_velocity=.5, seed=None, bar_size=2, inner_bar_size=None, filt_depth=40):
+def oms_differential(model, duration=5, sample_rate=30, pre_frames=40, post_frames=40, img_shape=(50,50), center=(25,25), radius=8, background_velocity=0, foreground_velocity=.5, seed=None, bar_size=2, inner_bar_size=None, filt_depth=40, hs_init=None, step_fn=None):
     """
     Plays a video of differential motion by keeping a circular window fixed in space on a 2d background grating.
     A grating exists behind the circular window that moves counter to the background grating. 
@@ -405,31 +514,8 @@ def oms_differential(model, duration=5, sample_rate=30, pre_frames=40, post_fram
         diff_response = None
         global_response = None
     else:
-        x = torch.FloatTensor(stim.concat(diff_vid, nh=filt_depth)).to(DEVICE)
-        with torch.no_grad():
-            if model.recurrent:
-                hs = [torch.zeros(1,*h).to(device) for h in model.h_shapes]
-                resps = []
-                for i in range(x.shape[0]):
-                    resp, hs = model(x[i:i+1], hs)
-                    resps.append(resp)
-                resp = torch.cat(resps, dim=0)
-            else:
-                resp = model(x)
-        diff_response = resp.cpu().detach().numpy()
-
-        x = torch.FloatTensor(stim.concat(global_vid, nh=filt_depth)).to(DEVICE)
-        with torch.no_grad():
-            if model.recurrent:
-                hs = [torch.zeros(1,*h).to(device) for h in model.h_shapes]
-                resps = []
-                for i in range(x.shape[0]):
-                    resp, hs = model(x[i:i+1], hs)
-                    resps.append(resp)
-                resp = torch.cat(resps, dim=0)
-            else:
-                resp = model(x)
-        global_response = resp.cpu().detach().numpy()
+        xs = [stim.concat(diff_vid, nh=filt_depth), stim.concat(global_vid, nh=filt_depth)]
+        diff_response, global_response = simulate(model, xs, hs_init, step_fn=step_fn)
 
         # generate the figure
         fig = plt.figure(figsize=(6, 4))
@@ -441,7 +527,7 @@ def oms_differential(model, duration=5, sample_rate=30, pre_frames=40, post_fram
         global_response = global_response[pre_frames-40:tot_frames-post_frames]
     return fig, diff_vid, global_vid, diff_response, global_response
 
-def oms_jitter(model, duration=5, sample_rate=30, pre_frames=40, post_frames=40, img_shape=(50,50), center=(25,25), radius=5, seed=None, bar_size=2, inner_bar_size=None, jitter_freq=.5, step_size=1, filt_depth=40):
+def oms_jitter(model, duration=5, sample_rate=30, pre_frames=40, post_frames=40, img_shape=(50,50), center=(25,25), radius=5, seed=None, bar_size=2, inner_bar_size=None, jitter_freq=.5, step_size=1, filt_depth=40, hs_init=None, step_fn=None):
     """
     Plays a video of a jittered circle window onto a grating different than that of the background.
 
@@ -488,18 +574,7 @@ def oms_jitter(model, duration=5, sample_rate=30, pre_frames=40, post_frames=40,
         fig = None
         response = None
     else:
-        x = torch.FloatTensor(stim.concat(vid, nh=filt_depth)).to(DEVICE)
-        with torch.no_grad():
-            if model.recurrent:
-                hs = [torch.zeros(1,*h).to(device) for h in model.h_shapes]
-                resps = []
-                for i in range(x.shape[0]):
-                    resp, hs = model(x[i:i+1], hs)
-                    resps.append(resp)
-                resp = torch.cat(resps, dim=0)
-            else:
-                resp = model(x)
-        response = resp.cpu().detach().numpy()
+        response = simulate(model, [stim.concat(vid, nh=filt_depth)], hs_init, step_fn=step_fn)[0]
         avg_response = response.mean(-1)
 
         # generate the figure
@@ -577,7 +652,41 @@ def oms(duration=5, sample_rate=0.01, transition_duration=0.07, silent_duration=
     return movie
 
 
-def osr(device, I20=None, model=None, duration=2, interval=10, nflashes=5, intensity=-2.0, filt_depth=40):
+def osr_stimuli(duration=2, interval=10, nflashes=5, intensity=-2.0, filt_depth=40):
+    """
+    Builds the omitted stimulus response stimulus. See osr for the parameters.
+    """
+    single_flash = stim.flash(duration, interval, interval * 2, intensity=intensity)
+    omitted_flash = stim.flash(duration, interval, interval * 2, intensity=0.0)
+    flash_group = list(repeat(single_flash, nflashes))
+    zero_pad = np.zeros((interval, 1, 1))
+    X = stim.concat(zero_pad, *flash_group, omitted_flash, *flash_group, nx=50, nh=filt_depth)
+    X[X!=0] = 1
+    return X
+
+def osr_ratio(resp, flash_len, nflashes=5):
+    """
+    Ratio of the summed response to the omitted flash over the average
+    summed response to the flashes, averaged over cells.
+
+    resp - ndarray (T, N)
+        model response to osr_stimuli
+    flash_len - int
+        length of each flash period in frames, 2*interval
+    nflashes - int
+    """
+    n_full_responses = len(resp)//flash_len
+    responses = [resp[i*flash_len:(i+1)*flash_len] for i in range(n_full_responses)]
+    flash_resps = np.zeros((len(responses), *responses[0].shape))
+    for i,r in enumerate(responses):
+        if i != nflashes:
+            flash_resps[i] = r
+    omitted_resp = np.asarray(responses[nflashes])
+    avg_flash_resp = np.mean(flash_resps, axis=0)
+    return (omitted_resp.sum(0)/avg_flash_resp.sum(0)).mean()
+
+def osr(device, I20=None, model=None, duration=2, interval=10, nflashes=5, intensity=-2.0, filt_depth=40,
+                                                                        hs_init=None, step_fn=None):
     """Omitted stimulus response
     Parameters
     ----------
@@ -592,45 +701,16 @@ def osr(device, I20=None, model=None, duration=2, interval=10, nflashes=5, inten
     """
 
     # generate the stimulus
-    single_flash = stim.flash(duration, interval, interval * 2, intensity=intensity)
-    omitted_flash = stim.flash(duration, interval, interval * 2, intensity=0.0)
-    flash_group = list(repeat(single_flash, nflashes))
-    zero_pad = np.zeros((interval, 1, 1))
-    X = stim.concat(zero_pad, *flash_group, omitted_flash, *flash_group, nx=50, nh=filt_depth)
-    X[X!=0] = 1
+    X = osr_stimuli(duration, interval, nflashes, intensity, filt_depth)
     if model is not None:
-        X_torch = torch.from_numpy(X).to(device)
-        with torch.no_grad():
-            if model.kinetic:
-                hs = get_hs(model, 1, device, I20)
-                resps = []
-                for i in range(X_torch.shape[0]):
-                    resp, hs = model(X_torch[i:i+1], hs)
-                    resps.append(resp)
-                resp = torch.cat(resps, dim=0)
-            elif model.recurrent:
-                hs = [torch.zeros(1,*h).to(device) for h in model.h_shapes]
-                resps = []
-                for i in range(X_torch.shape[0]):
-                    resp, hs = model(X_torch[i:i+1], hs)
-                    resps.append(resp)
-                resp = torch.cat(resps, dim=0)
-            else:
-                resp = model(X_torch)
-        resp = resp.cpu().detach().numpy()
+        if is_recurrent(model) and hs_init is None:
+            hs_init = init_hs(model, device, I20)
+        resp = simulate(model, [X], hs_init, device=device, step_fn=step_fn)[0]
         figs = viz.response1D(X[:, -1, 0, 0].copy(), resp, figsize=(20, 8))
         (fig, (ax0,ax1)) = figs
 
         # Table Metrics
-        n_full_responses = len(resp)//len(single_flash)
-        responses = [resp[i*len(single_flash):(i+1)*len(single_flash)] for i in range(n_full_responses)]
-        flash_resps = np.zeros((len(responses), *responses[0].shape))
-        for i,resp in enumerate(responses):
-            if i != len(flash_group):
-                flash_resps[i] = resp
-        omitted_resp = np.asarray(responses[len(flash_group)])
-        avg_flash_resp = np.mean(flash_resps, axis=0)
-        resp_ratio = (omitted_resp.sum(0)/avg_flash_resp.sum(0)).mean()
+        resp_ratio = osr_ratio(resp, interval * 2, nflashes)
     else:
         fig = None
         ax0,ax1 = None, None
@@ -639,97 +719,33 @@ def osr(device, I20=None, model=None, duration=2, interval=10, nflashes=5, inten
 
     return (fig, (ax0,ax1)), X, resp, resp_ratio
 
-def motion_anticipation(device, I20=None, model=None, scale_factor=55, velocity=0.08, width=2, flash_duration=2, filt_depth=40, make_fig=True):
-    """Generates the Berry motion anticipation stimulus
-    Stimulus from the paper:
-    Anticipation of moving stimuli by the retina,
-    M. Berry, I. Brivanlou, T. Jordan and M. Meister, Nature 1999
-    Parameters
-    ----------
-    model : keras.Model
-    scale_factor = 55       # microns per bar
-    velocity = 0.08         # 0.08 bars/frame == 0.44mm/s, same as Berry et. al.
-    width = 2               # 2 bars == 110 microns, Berry et. al. used 133 microns
-    flash_duration = 2      # 2 frames == 20 ms, Berry et. al. used 15ms
-    Returns
-    -------
-    motion : array_like
-    flashes : array_like
+def motion_anticipation_stimuli(velocity=0.08, width=2, flash_duration=2, filt_depth=40):
     """
-    # moving bar stimulus and responses
-    # c_right and c_left are the center positions of the bar
-    c_right, speed_right, stim_right = stim.driftingbar(velocity, width, x=(-30, 30))
-    x = torch.from_numpy(stim_right).to(device)
-    with torch.no_grad():
-        if model.kinetic:
-            hs = get_hs(model, 1, device, I20)
-            resps = []
-            for i in range(x.shape[0]):
-                resp, hs = model(x[i:i+1], hs)
-                resps.append(resp)
-            resp = torch.cat(resps, dim=0)
-        elif model.recurrent:        
-            hs = [torch.zeros(1,*h).to(device) for h in model.h_shapes]
-            resps = []
-            for i in range(x.shape[0]):
-                resp, hs = model(x[i:i+1], hs)
-                resps.append(resp)
-            resp = torch.cat(resps, dim=0)
-        else:
-            resp = model(x)
-    resp_right = resp.cpu().detach().numpy()
-
-    c_left, speed_left, stim_left = stim.driftingbar(-velocity, width, x=(30, -30))
-    x = torch.from_numpy(stim_left).to(device)
-    with torch.no_grad():
-        if model.kinetic:
-            hs = get_hs(model, 1, device, I20)
-            resps = []
-            for i in range(x.shape[0]):
-                resp, hs = model(x[i:i+1], hs)
-                resps.append(resp)
-            resp = torch.cat(resps, dim=0)        
-        elif model.recurrent:
-            hs = [torch.zeros(1,*h).to(device) for h in model.h_shapes]
-            resps = []
-            for i in range(x.shape[0]):
-                resp, hs = model(x[i:i+1], hs)
-                resps.append(resp)
-            resp = torch.cat(resps, dim=0)
-        else:
-            resp = model(x)
-    resp_left = resp.cpu().detach().numpy()
+    Builds the moving and flashed bar stimuli of motion_anticipation.
 
-    # flashed bar stimulus
+    returns:
+        right - tuple (c_right, speed_right, stim_right)
+        left - tuple (c_left, speed_left, stim_left)
+        flash_centers - ndarray (F,)
+        flashes - list of F ndarrays
+    """
+    # c_right and c_left are the center positions of the bar
+    right = stim.driftingbar(velocity, width, x=(-30, 30))
+    left = stim.driftingbar(-velocity, width, x=(30, -30))
     flash_centers = np.arange(-25, 26)
-    flashes = (stim.flash(flash_duration, 43, 70, intensity=stim.bar((x, 0), width, 50))
-               for x in flash_centers)
+    flashes = [stim.concat(stim.flash(flash_duration, 43, 70, intensity=stim.bar((x, 0), width, 50)), nh=filt_depth)
+                                                                                    for x in flash_centers]
+    return right, left, flash_centers, flashes
 
-    # flash responses are a 3-D array with dimensions (centers, stimulus time, cell)
-    flash_responses = []
-    with torch.no_grad():
-        for f in tqdm(flashes):
-            x = torch.from_numpy(stim.concat(f, nh=filt_depth)).to(device)
-            if model.kinetic:
-                hs = get_hs(model, 1, device, I20)
-                resps = []
-                for i in range(x.shape[0]):
-                    resp, hs = model(x[i:i+1], hs)
-                    resps.append(resp)
-                resp = torch.cat(resps, dim=0)            
-            elif model.recurrent:
-                hs = [torch.zeros(1,*h).to(device) for h in model.h_shapes]
-                resps = []
-                for i in range(x.shape[0]):
-                    resp, hs = model(x[i:i+1], hs)
-                    resps.append(resp)
-                resp = torch.cat(resps, dim=0)
-            else:
-                resp = model(x)
-            flash_responses.append(resp.cpu().detach().numpy())
-        
-    flash_responses = np.stack(flash_responses)
+def motion_anticipation_curves(resp_right, resp_left, flash_responses):
+    """
+    Averages the responses over cells and normalizes them to plot on the same scale.
+    The flash responses are taken at the time of the maximum average flash response.
 
+    resp_right - ndarray (T, N)
+    resp_left - ndarray (T, N)
+    flash_responses - ndarray (F, T, N)
+    """
     # pick off the flash responses at a particular time point (the time of the max response)
     max_resp_idx = flash_responses.mean(axis=-1).mean(axis=0).argmax()
     resp_flash = flash_responses[:, max_resp_idx, :]
@@ -743,29 +759,30 @@ def motion_anticipation(device, I20=None, model=None, scale_factor=55, velocity=
     avg_resp_right /= avg_resp_right.max()
     avg_resp_left /= avg_resp_left.max()
     avg_resp_flash /= avg_resp_flash.max()
+    return avg_resp_right, avg_resp_left, avg_resp_flash
 
-    if make_fig:
-        # generate the figure
-        fig = plt.figure(figsize=(6, 4))
-        ax = fig.add_subplot(111)
-        ax.plot(scale_factor * c_left[40:], avg_resp_left, 'g-', label='Left motion')
-        ax.plot(scale_factor * c_right[40:], avg_resp_right, 'b-', label='Right motion')
-        ax.plot(scale_factor * flash_centers, avg_resp_flash, 'r-', label='Flash')
-        ax.legend(frameon=True, fancybox=True, fontsize=18)
-        ax.set_xlabel('Position ($\mu m$)')
-        ax.set_ylabel('Scaled firing rate')
-        ax.set_xlim(-735, 135)
-
-        return (fig, ax), (speed_left, speed_right), (c_right, stim_right, resp_right),(c_left, stim_left, resp_left), (flash_centers, flash_responses)#, (symmetry, continuity, peak_height, right_anticipation, left_anticipation)
-    return (speed_left, speed_right), (c_right, stim_right, resp_right),(c_left, stim_left, resp_left), (flash_centers, flash_responses)#, (symmetry, continuity, peak_height, right_anticipation, left_anticipation)
+def motion_anticipation_fig(c_right, c_left, flash_centers, avg_resp_right, avg_resp_left, avg_resp_flash,
+                                                                                        scale_factor=55):
+    fig = plt.figure(figsize=(6, 4))
+    ax = fig.add_subplot(111)
+    ax.plot(scale_factor * c_left[40:], avg_resp_left, 'g-', label='Left motion')
+    ax.plot(scale_factor * c_right[40:], avg_resp_right, 'b-', label='Right motion')
+    ax.plot(scale_factor * flash_centers, avg_resp_flash, 'r-', label='Flash')
+    ax.legend(frameon=True, fancybox=True, fontsize=18)
+    ax.set_xlabel('Position ($\mu m$)')
+    ax.set_ylabel('Scaled firing rate')
+    ax.set_xlim(-735, 135)
+    return fig, ax
 
-def motion_reversal(device, I20=None, model=None, scale_factor=55, velocity=0.08, width=2, filt_depth=40):
-    """
-    Moves a bar to the right and reverses it in the center, then does the same to the left. 
-    The responses are averaged.
+def motion_anticipation(device, I20=None, model=None, scale_factor=55, velocity=0.08, width=2, flash_duration=2, filt_depth=40, make_fig=True,
+                                                                                                         hs_init=None, step_fn=None):
+    """Generates the Berry motion anticipation stimulus
+    Stimulus from the paper:
+    Anticipation of moving stimuli by the retina,
+    M. Berry, I. Brivanlou, T. Jordan and M. Meister, Nature 1999
     Parameters
     ----------
-    model : pytorch model
+    model : keras.Model
     scale_factor = 55       # microns per bar
     velocity = 0.08         # 0.08 bars/frame == 0.44mm/s, same as Berry et. al.
     width = 2               # 2 bars == 110 microns, Berry et. al. used 133 microns
@@ -775,6 +792,40 @@ def motion_reversal(device, I20=None, model=None, scale_factor=55, velocity=0.08
     motion : array_like
     flashes : array_like
     """
+    # moving and flashed bar stimuli
+    right, left, flash_centers, flashes = motion_anticipation_stimuli(velocity, width, flash_duration, filt_depth)
+    c_right, speed_right, stim_right = right
+    c_left, speed_left, stim_left = left
+
+    # the bars and all flashes run as lanes of a single simulation
+    if is_recurrent(model) and hs_init is None:
+        hs_init = init_hs(model, device, I20)
+    resps = simulate(model, [stim_right, stim_left, *flashes], hs_init, device=device, step_fn=step_fn)
+    resp_right, resp_left = resps[:2]
+
+    # flash responses are a 3-D array with dimensions (centers, stimulus time, cell)
+    flash_responses = np.stack(resps[2:])
+
+    curves = motion_anticipation_curves(resp_right, resp_left, flash_responses)
+
+    if make_fig:
+        # generate the figure
+        fig, ax = motion_anticipation_fig(c_right, c_left, flash_centers, *curves, scale_factor=scale_factor)
+
+        return (fig, ax), (speed_left, speed_right), (c_right, stim_right, resp_right),(c_left, stim_left, resp_left), (flash_centers, flash_responses)#, (symmetry, continuity, peak_height, right_anticipation, left_anticipation)
+    return (speed_left, speed_right), (c_right, stim_right, resp_right),(c_left, stim_left, resp_left), (flash_centers, flash_responses)#, (symmetry, continuity, peak_height, right_anticipation, left_anticipation)
+
+def motion_reversal_stimuli(velocity=0.08, width=2):
+    """
+    Builds the bars of motion_reversal that reverse direction at the center.
+
+    returns:
+        speeds - tuple (speed_left, speed_right)
+        rtl - ndarray (T, 1, W)
+            the bar moving right then left
+        ltr - ndarray (T, 1, W)
+            the bar moving left then right
+    """
     # moving bar stimuli
     c_right, speed_right, stim_right = stim.driftingbar(velocity, width)
     stim_right = stim_right[:,0]
@@ -800,49 +851,14 @@ def motion_reversal(device, I20=None, model=None, scale_factor=55, velocity=0.08
     elif left_halfway < right_halfway:
         cutoff = right_halfway-left_halfway
         rtl = rtl[cutoff:-cutoff]
- 
-    rtl_blocks = stim.concat(rtl, nh=filt_depth)
-    rtl_blocks = torch.from_numpy(rtl_blocks).to(device)
-    with torch.no_grad():
-        if model.kinetic:
-            hs = get_hs(model, 1, device, I20)
-            resps = []
-            for i in range(rtl_blocks.shape[0]):
-                resp, hs = model(rtl_blocks[i:i+1], hs)
-                resps.append(resp)
-            resp = torch.cat(resps, dim=0)
-        elif model.recurrent:
-            hs = [torch.zeros(1,*h).to(device) for h in model.h_shapes]
-            resps = []
-            for i in range(rtl_blocks.shape[0]):
-                resp, hs = model(rtl_blocks[i:i+1], hs)
-                resps.append(resp)
-            resp = torch.cat(resps, dim=0)
-        else:
-            resp = model(rtl_blocks)
-    resp_rtl = resp.cpu().detach().numpy()
+    return (speed_left, speed_right), rtl, ltr
 
-    ltr_blocks = stim.concat(ltr, nh=filt_depth)
-    ltr_blocks = torch.from_numpy(ltr_blocks).to(device)
-    with torch.no_grad():
-        if model.kinetic:
-            hs = get_hs(model, 1, device, I20)
-            resps = []
-            for i in range(ltr_blocks.shape[0]):
-                resp, hs = model(ltr_blocks[i:i+1], hs)
-                resps.append(resp)
-            resp = torch.cat(resps, dim=0)        
-        elif model.recurrent:
-            hs = [torch.zeros(1,*h).to(device) for h in model.h_shapes]
-            resps = []
-            for i in range(ltr_blocks.shape[0]):
-                resp, hs = model(ltr_blocks[i:i+1], hs)
-                resps.append(resp)
-            resp = torch.cat(resps, dim=0)
-        else:
-            resp = model(ltr_blocks)
-    resp_ltr = resp.cpu().detach().numpy()
+def motion_reversal_curves(resp_rtl, resp_ltr):
+    """
+    Averages the responses over cells and normalizes them to plot on the same scale.
 
+    returns the normalized rtl, ltr and mean of both responses
+    """
     # average the response from multiple cells
     avg_resp_rtl = resp_rtl.mean(axis=-1)
     avg_resp_ltr = resp_ltr.mean(axis=-1)
@@ -851,8 +867,9 @@ def motion_reversal(device, I20=None, model=None, scale_factor=55, velocity=0.08
     avg_resp_rtl /= avg_resp_rtl.max()
     avg_resp_ltr /= avg_resp_ltr.max()
     avg_resp = (avg_resp_rtl + avg_resp_ltr)/2
+    return avg_resp_rtl, avg_resp_ltr, avg_resp
 
-    # generate the figure
+def motion_reversal_fig(avg_resp_rtl, avg_resp_ltr, avg_resp):
     fig = plt.figure(figsize=(6, 4))
     ax = fig.add_subplot(111)
     halfway = avg_resp_ltr.shape[0]//2
@@ -863,6 +880,36 @@ def motion_reversal(device, I20=None, model=None, scale_factor=55, velocity=0.08
     ax.set_xlabel('Frames from reversal')
     ax.set_ylabel('Scaled firing rate')
     ax.set_xlim(-halfway, halfway)
+    return fig, ax
+
+def motion_reversal(device, I20=None, model=None, scale_factor=55, velocity=0.08, width=2, filt_depth=40,
+                                                                            hs_init=None, step_fn=None):
+    """
+    Moves a bar to the right and reverses it in the center, then does the same to the left. 
+    The responses are averaged.
+    Parameters
+    ----------
+    model : pytorch model
+    scale_factor = 55       # microns per bar
+    velocity = 0.08         # 0.08 bars/frame == 0.44mm/s, same as Berry et. al.
+    width = 2               # 2 bars == 110 microns, Berry et. al. used 133 microns
+    flash_duration = 2      # 2 frames == 20 ms, Berry et. al. used 15ms
+    Returns
+    -------
+    motion : array_like
+    flashes : array_like
+    """
+    (speed_left, speed_right), rtl, ltr = motion_reversal_stimuli(velocity, width)
+ 
+    blocks = [stim.concat(rtl, nh=filt_depth), stim.concat(ltr, nh=filt_depth)]
+    if is_recurrent(model) and hs_init is None:
+        hs_init = init_hs(model, device, I20)
+    resp_rtl, resp_ltr = simulate(model, blocks, hs_init, device=device, step_fn=step_fn)
+
+    avg_resp_rtl, avg_resp_ltr, avg_resp = motion_reversal_curves(resp_rtl, resp_ltr)
+
+    # generate the figure
+    (fig, ax) = motion_reversal_fig(avg_resp_rtl, avg_resp_ltr, avg_resp)
 
     return (fig, ax), (speed_left, speed_right), (rtl, resp_rtl), (ltr, resp_ltr), avg_resp
 
@@ -910,12 +957,9 @@ def filter_and_nonlinearity(model, contrast, device, layer_name='sequential.0',
     # Inspecting model response
     if verbose:
         print("Collecting full model response")
-    stim_tensor = torch.FloatTensor(stim.concat(stimulus, nh=filt_depth)).to(device)
-    if model.kinetic:
-        hs = get_hs(model, 1, device, I20)
-        model_response = inspect_rnn(model, stim_tensor, hs, insp_keys=[layer_name])
-    else:
-        model_response = batch_compute_model_response(stim_tensor, model, 500, insp_keys={layer_name},verbose=verbose)
+    hs_init = init_hs(model, device, I20) if is_recurrent(model) else None
+    _, recordings = simulate(model, [stim.concat(stimulus, nh=filt_depth)], hs_init, record=[layer_name], device=device)
+    model_response = {layer_name: recordings[layer_name][0]}
     if type(unit_index) == type(int()):
         response = model_response[layer_name][:,unit_index]
     elif len(unit_index) == 1:
@@ -3,9 +3,10 @@ import torch.nn as nn
 import torch.nn.functional as F
 import sys
 import json
+import os
 import pickle
 import numpy as np
-from .utils import freeze_weights
+from .utils import freeze_weights, cat_hs
 
 def load_json(json_file):
     with open(json_file) as f:
@@ -14,7 +15,7 @@ def load_json(json_file):
     return j
 
 def cuda_if(x):
-    if torch.cuda.is_available:
+    if torch.cuda.is_available():
         return x.cuda()
     return x
 
@@ -81,7 +82,156 @@ class STAAscent:
             loss.backward()
             optim.step()
             print("Loss:", "{:.5f}".format(loss.item()), "--", i/n_epochs, "% done", end='\r')
-        sta_image = sta_image.detach().cpu().numpy().astype(np.float)
+        sta_image = sta_image.detach().cpu().numpy().astype(np.float64)
         self.remove_hook()
         return sta_image
 
+    def batch_sta_ascent(self, model, layer, units, lr=.01, n_epochs=5000, sta_shape=(40,50,50),
+                                    constraint=1, tol=1e-4, patience=100, seq_len=5, seed=None,
+                                    checkpoint=None, cache_dir=None, device=None, verbose=True):
+        """
+        Performs gradient ascent on one randomly initialized image per unit. All
+        images are optimized together as a single batch with a separate loss for
+        each unit, so the result for each unit is the same as optimizing it
+        alone. A unit stops once its loss has not improved by more than tol
+        (relative) for patience epochs, and it is dropped from the batch.
+
+        Recurrent models (i.e. the kinetic models) optimize a sequence of seq_len
+        stimulus windows per unit, starting from the resting hidden state.
+        The objective is the unit's activation at the last window.
+
+        model - pytorch module
+        layer - string
+            name of module of interest
+        units - sequence of ints or coordinate tuples (c,h,w)
+            the units of the layer output
+        sta_shape - tuple of ints
+            shape of a single stimulus window
+        constraint - float
+            the coefficient of the norm of the sta image added to the loss
+        tol - float
+            smallest relative improvement of the loss that resets the patience
+        patience - int
+            number of epochs without improvement before a unit is stopped
+        seq_len - int
+            number of stimulus windows optimized for recurrent models
+        seed - int or None
+            seed of the initial images. Each unit's image is drawn from its own
+            generator seeded with (seed, flat unit index), so it does not depend
+            on the other units being optimized or cached
+        checkpoint - str or None
+            path to the checkpoint of the model. if argued along with cache_dir,
+            the image of each unit is cached per (checkpoint, layer, unit)
+        cache_dir - str or None
+            directory of the cached images
+        device - torch device or None
+            defaults to the device of the model
+
+        returns:
+            sta_images - ndarray (U, *sta_shape) or (U, seq_len, *sta_shape) for recurrent models
+        """
+        if device is None:
+            device = next(model.parameters()).device
+        recurrent = getattr(model, 'recurrent', hasattr(model, 'h_shapes'))
+        img_shape = (seq_len, *sta_shape) if recurrent else tuple(sta_shape)
+        units = [tuple(u) if isinstance(u, (list, tuple)) else int(u) for u in units]
+        sta_images = np.zeros((len(units), *img_shape))
+
+        paths = [None]*len(units)
+        if checkpoint is not None and cache_dir is not None:
+            from torchdeepretina.battery import checkpoint_key, param_hash, load_pickle
+            params = dict(lr=lr, n_epochs=n_epochs, sta_shape=sta_shape, constraint=constraint, tol=tol,
+                                        patience=patience, seq_len=seq_len if recurrent else None, seed=seed)
+            folder = os.path.join(cache_dir, checkpoint_key(checkpoint))
+            for i,unit in enumerate(units):
+                name = "{}_{}".format(layer, unit)
+                paths[i] = os.path.join(folder, "{}_{}.pkl".format(name, param_hash(name, params)))
+                if os.path.exists(paths[i]):
+                    sta_images[i] = load_pickle(paths[i])
+        todo = [i for i in range(len(units)) if paths[i] is None or not os.path.exists(paths[i])]
+        if len(todo) == 0:
+            return sta_images
+
+        training = model.training
+        grad_states = [p.requires_grad for p in model.parameters()]
+        model.eval()
+        freeze_weights(model)
+        vis_module = dict(model.named_modules())[layer]
+        def fwd_hook(module, inp, output):
+            self.activs = output
+        self.hook_handle = vis_module.register_forward_hook(fwd_hook)
+
+        hs = None
+        if recurrent:
+            from torchdeepretina.retinal_phenomena import init_hs
+            hs = init_hs(model, device)
+
+        def forward(x):
+            self.activs = None
+            if not recurrent:
+                model(x)
+            else:
+                lane_hs = cat_hs([hs]*len(x))
+                for t in range(seq_len):
+                    _, lane_hs = model(x[:,t], lane_hs)
+            assert self.activs is not None, "{} is not called in the forward pass".format(layer)
+            return self.activs
+
+        try:
+            # ravel the indices
+            with torch.no_grad():
+                shape = forward(torch.zeros(1, *img_shape, device=device)).shape[1:]
+            flat_units = [int(np.ravel_multi_index(u, shape)) if isinstance(u, tuple) else u for u in units]
+            flat_units = torch.LongTensor(flat_units)[todo].to(device)
+
+            images = []
+            for unit in flat_units.tolist():
+                generator = None
+                if seed is not None:
+                    unit_seed = np.random.SeedSequence([seed, unit]).generate_state(1)[0]
+                    generator = torch.Generator().manual_seed(int(unit_seed))
+                images.append(torch.randn(*img_shape, generator=generator))
+            images = torch.stack(images)*2/(np.prod(sta_shape))
+            images = images.to(device).requires_grad_(True)
+            optim = torch.optim.Adam([images], lr=lr)
+
+            active = torch.arange(len(todo), device=device)
+            best = torch.full((len(todo),), np.inf, device=device)
+            stale = torch.zeros(len(todo), dtype=torch.long, device=device)
+            for epoch in range(n_epochs):
+                optim.zero_grad()
+                x = images[active]
+                activs = forward(x).reshape(len(x), -1)
+                losses = -activs[torch.arange(len(x)), flat_units[active]]
+                if constraint > 0:
+                    losses = losses + x.reshape(len(x), -1).norm(2, dim=1)*constraint
+                losses.sum().backward()
+                optim.step()
+
+                losses = losses.detach()
+                improved = losses < best[active] - tol*best[active].abs()
+                best[active] = torch.where(improved, losses, best[active])
+                stale[active] = torch.where(improved, torch.zeros_like(stale[active]), stale[active]+1)
+                # Converged images are kept as they were at their last evaluation
+                done = stale[active] >= patience
+                for i in active[done].tolist():
+                    sta_images[todo[i]] = x[active==i].detach().cpu().numpy()[0]
+                active = active[~done]
+                if verbose:
+                    print("Loss:", "{:.5f}".format(losses.mean().item()), "-- Active:", len(active),
+                                                        "--", epoch/n_epochs, "% done", end='\r')
+                if len(active) == 0:
+                    break
+            for i in active.tolist():
+                sta_images[todo[i]] = images[i].detach().cpu().numpy()
+        finally:
+            self.remove_hook()
+            for p, state in zip(model.parameters(), grad_states):
+                p.requires_grad = state
+            model.train(training)
+
+        if paths[0] is not None:
+            from torchdeepretina.battery import save_pickle
+            for i in todo:
+                save_pickle(sta_images[i], paths[i])
+        return sta_images
@@ -19,11 +19,11 @@ import numpy as np
 import torch
 from skimage.filters import gaussian
 from skimage.transform import downscale_local_mean
-import skimage.draw
 import cv2
 
 __all__ = ['concat', 'white', 'contrast_steps', 'flash', 'spatialize', 'bar',
-           'driftingbar', 'cmask', 'paired_flashes','rolling_window','get_cutout',"spatial_pad"]
+           'driftingbar', 'cmask', 'paired_flashes','rolling_window','get_cutout',"spatial_pad",
+           'rolling_chunks', 'gratings', 'circle_masks', 'roll_frames', 'shift_frames']
 
 def get_cutout(stimulus, center, span=20, pad_to=50):
     """ 
@@ -221,15 +221,14 @@ def dir_select_vid(img_shape, bar_width, angle, step_size=1, n_frames=90, gratin
     M = np.float32([[1,0,0], [0,1,0]])
     frames = []
     center = [s//2 for s in img_shape]
+    mask = circle_masks([center], img_shape[0]//2, img_shape)[0]
     for i in range(n_frames):
         M[0,-1] = tx*i
         M[1,-1] = ty*i
         new_img = cv2.warpAffine(big_img, M, (cols, rows))
-        img = new_img[idxs]
-        mask = circle_mask(center, img_shape[0]//2, img_shape)
-        img[mask!=1] = 0 # cut out circle for consistent luminance
-        frames.append(img)
-    return np.asarray(frames)
+        frames.append(new_img[idxs])
+    # cut out circle for consistent luminance
+    return np.where(mask, np.asarray(frames), 0)
 
 def motion_reversal(img_shape, start_pt=(0,0), horz_vel=0.5, vert_vel=0, angle=90, 
                                             bar_size=4, n_frames=None, rev_pt=None):
@@ -244,9 +243,10 @@ def motion_reversal(img_shape, start_pt=(0,0), horz_vel=0.5, vert_vel=0, angle=9
     cv2.line(img, pt1, pt2, 1, bar_size)
 
     top_pt = pt1 if pt1[1] < pt2[1] else pt2
+    start_img = img
     if horz_vel != 0:
         n_shifts = top_pt[0]-start_pt[0]
-        start_img = np.roll(img, n_shifts, axis=1)
+        start_img = np.roll(start_img, n_shifts, axis=1)
     if vert_vel != 0:
         n_shifts = top_pt[1]-start_pt[1]
         start_img = np.roll(start_img, n_shifts, axis=0)
@@ -254,16 +254,19 @@ def motion_reversal(img_shape, start_pt=(0,0), horz_vel=0.5, vert_vel=0, angle=9
     if n_frames is None:
         n_frames = abs(int((rev_pt[0]-start_pt[0])/horz_vel*2))
 
-    frames = []
+    # Only the scalar trajectory is stepped through; the frames are
+    # indexed from the start image all at once
+    horz_offsets = np.zeros(n_frames, dtype=int)
+    vert_offsets = np.zeros(n_frames, dtype=int)
     cumu_horz = 0
     cumu_vert = 0
     horz_flip = False
     vert_flip = False
     for i in range(n_frames):
         cumu_horz += horz_vel
-        new_img = np.roll(start_img, int(cumu_horz), axis=1)
         cumu_vert += vert_vel
-        new_img = np.roll(new_img, int(cumu_vert), axis=0)
+        horz_offsets[i] = int(cumu_horz)
+        vert_offsets[i] = int(cumu_vert)
         new_pt = ((start_pt[0]+cumu_horz)%img_shape[0], (start_pt[1]+cumu_vert)%img_shape[1])
         if horz_vel*new_pt[0] >= horz_vel*rev_pt[0] and not horz_flip:
             horz_vel = -horz_vel
@@ -271,8 +274,9 @@ def motion_reversal(img_shape, start_pt=(0,0), horz_vel=0.5, vert_vel=0, angle=9
         if vert_vel*new_pt[1] >= vert_vel*rev_pt[1] and not vert_flip:
             vert_vel = -vert_vel
             vert_flip = True
-        frames.append(new_img)
-    return np.asarray(frames)
+    rows = (np.arange(img_shape[0])[None] - vert_offsets[:,None]) % img_shape[0]
+    cols = (np.arange(img_shape[1])[None] - horz_offsets[:,None]) % img_shape[1]
+    return start_img[rows[:,:,None], cols[:,None,:]]
 
 def circle_mask(center, radius, mask_shape=(50,50)):
     """
@@ -285,11 +289,29 @@ def circle_mask(center, radius, mask_shape=(50,50)):
     mask_shape: sequence of ints len 2
         the shape of the mask
     """
-    row_coords, col_coords = skimage.draw.circle(*center, radius, mask_shape)
-    mask = np.zeros(mask_shape)
-    mask[row_coords, col_coords] = 1
-    return mask
-        
+    return circle_masks([center], radius, mask_shape)[0].astype(float)
+
+def circle_masks(centers, radius, mask_shape=(50,50)):
+    """
+    Creates a boolean circle mask for each of the argued centers using
+    coordinate grid arithmetic. A pixel is inside a circle when its
+    normalized distance to the center is strictly less than 1.
+
+    centers: ndarray or sequence (T,2)
+        the row and column coordinates of the center of each circle
+    radius: float
+        the radius of the circles
+    mask_shape: sequence of ints len 2
+        the shape of each mask
+
+    Returns:
+        masks: bool ndarray (T, mask_shape[0], mask_shape[1])
+    """
+    centers = np.asarray(centers, dtype=float).reshape(-1, 2)
+    rows = np.arange(mask_shape[0], dtype=float)[None,:,None] - centers[:,0,None,None]
+    cols = np.arange(mask_shape[1], dtype=float)[None,None,:] - centers[:,1,None,None]
+    return (rows/radius)**2 + (cols/radius)**2 < 1
+
 def paste_circle(foreground, background, radius, center):
     """
     Pastes the foreground pattern onto the background pattern in a window the shape of a circle.
@@ -303,15 +325,123 @@ def paste_circle(foreground, background, radius, center):
     center: sequence of ints with length 2
         the center coordinates of the circle (0,0 is the upperleftmost pixel)
     """
-    row_coords, col_coords = skimage.draw.circle(*center, radius, background.shape)
-    img = background.copy()
-    img[row_coords, col_coords] = foreground[row_coords, col_coords]
-    return img
+    mask = circle_masks([center], radius, background.shape)[0]
+    return np.where(mask, foreground, background)
+
+def roll_frames(img, offsets, axis=0):
+    """
+    Stacks a copy of the image rolled by each of the offsets. Equivalent to
+    np.stack([np.roll(img, o, axis=axis) for o in offsets]) but indexes
+    the image once instead of rolling it once per frame.
+
+    img: ndarray (H,W)
+        the image to be rolled
+    offsets: sequence of ints (T,)
+        the roll amount of each frame
+    axis: int
+        the axis of the image to roll along. 0 or 1
+
+    Returns:
+        frames: ndarray (T,H,W)
+    """
+    offsets = np.asarray(offsets, dtype=int).reshape(-1)
+    n = img.shape[axis]
+    idxs = (np.arange(n)[None] - offsets[:,None]) % n
+    if axis == 0:
+        return img[idxs]
+    return img[:,idxs].transpose(1,0,2)
+
+def shift_frames(img, shifts, background_fill=0):
+    """
+    Stacks a copy of the image shifted by each of the shifts. Vectorized
+    form of the shift function for integer shifts. The remaining null
+    space is filled with the background fill.
+
+    img: ndarray (H,W)
+        the image to be shifted
+    shifts: sequence of int pairs (T,2)
+        the (vertical, horizontal) shift of each frame
+    background_fill: float
+        the value to fill the null space following the shift
+
+    Returns:
+        frames: ndarray (T,H,W)
+    """
+    shifts = np.asarray(shifts, dtype=int).reshape(-1, 2)
+    rows = np.arange(img.shape[0])[None] - shifts[:,:1]
+    cols = np.arange(img.shape[1])[None] - shifts[:,1:]
+    row_valid = (rows >= 0) & (rows < img.shape[0])
+    col_valid = (cols >= 0) & (cols < img.shape[1])
+    rows = np.clip(rows, 0, img.shape[0]-1)
+    cols = np.clip(cols, 0, img.shape[1]-1)
+    frames = img[rows[:,:,None], cols[:,None,:]]
+    valid = row_valid[:,:,None] & col_valid[:,None,:]
+    return np.where(valid, frames, background_fill).astype(img.dtype)
+
+def synthesize(make_frames, n_frames, chunk_size=None):
+    """
+    Generates the frames of a video from a function of the frame indices.
+
+    make_frames: callable
+        takes an int ndarray of frame indices (T,) and returns the
+        corresponding frames as an ndarray (T,H,W)
+    n_frames: int
+        the total number of frames in the video
+    chunk_size: int or None
+        if None, the whole video is returned as a single ndarray. Otherwise
+        a generator is returned that lazily yields consecutive chunks of
+        at most chunk_size frames
+
+    Returns:
+        frames: ndarray (n_frames,H,W) or generator of ndarrays (chunk_size,H,W)
+    """
+    if chunk_size is None:
+        return make_frames(np.arange(n_frames))
+    return (make_frames(np.arange(i, min(i+chunk_size, n_frames))) for i in range(0, n_frames, chunk_size))
+
+def circle_video(background_grating, background_offsets, background_axis, circle_grating,
+                            circle_offsets, circle_axis, centers, radius, chunk_size=None):
+    """
+    Synthesizes a video of a circle window onto a rolling grating that is
+    pasted on a rolling background grating.
+
+    background_grating: ndarray (H,W)
+    background_offsets: int ndarray (T,)
+        the roll of the background grating at each frame
+    background_axis: int
+        the axis the background grating is rolled along
+    circle_grating: ndarray (H,W)
+    circle_offsets: int ndarray (T,)
+        the roll of the circle grating at each frame
+    circle_axis: int
+        the axis the circle grating is rolled along
+    centers: ndarray (T,2) or (2,)
+        the center of the circle at each frame or a fixed center
+    radius: float
+        the radius of the circle
+    chunk_size: int or None
+        see synthesize
+
+    Returns:
+        frames: ndarray (T,H,W) or generator of ndarrays
+    """
+    centers = np.asarray(centers)
+    if centers.ndim == 1:
+        fixed_mask = circle_masks([centers], radius, background_grating.shape)
+    def make_frames(idxs):
+        frames = roll_frames(background_grating, background_offsets[idxs], axis=background_axis)
+        circles = roll_frames(circle_grating, circle_offsets[idxs], axis=circle_axis)
+        if centers.ndim == 1:
+            masks = fixed_mask
+        else:
+            masks = circle_masks(centers[idxs], radius, background_grating.shape)
+        return np.where(masks, circles, frames)
+    return synthesize(make_frames, len(background_offsets), chunk_size)
 
 def periodic_differential_circle(n_frames=100, period_dur=10, bar_size=4, inner_bar_size=None, 
                         sync_periods=False, image_shape=(50,50), center=(25,25), n_steps=1,
                         radius=5, horizontal_foreground=True, horizontal_background=True,
-                        background_grating=None, circle_grating=None):
+                        background_grating=None, circle_grating=None, chunk_size=None):
     """
     Creates circle window onto a grating with a background grating.
     The foreground and background gratings move periodically up and down.
@@ -346,9 +476,13 @@ def periodic_differential_circle(n_frames=100, period_dur=10, bar_size=4, inner_
             optionally pass custom background image through
         circle_grating: ndarray (H,W)
             optionally pass custom foreground image through
+        chunk_size: int or None
+            if not None, the frames are returned as a generator that lazily
+            yields chunks of at most chunk_size frames
 
     Returns:
         frame sequence of shape (n_frames, image_shape[0], image_shape[1])
+        or a generator of frame chunks if chunk_size is not None
 
     """
     bar_size=int(bar_size)
@@ -364,39 +498,32 @@ def periodic_differential_circle(n_frames=100, period_dur=10, bar_size=4, inner_
         circle_grating = stripes(image_shape, inner_bar_size, angle=angle)
     background_axis = 0 if horizontal_background else 1
     foreground_axis = 0 if horizontal_foreground else 1
-    background_phase = 1
     phase_offset = period_dur//2
+
+    # The background shifts in the second half of each period. The
+    # foreground shifts in the first half unless the periods are synced.
+    # The shift direction reverses at the start of each period.
+    imoddur = np.arange(n_frames) % period_dur
+    shift_dirs = np.where((np.arange(n_frames)//period_dur) % 2 == 0, 1, -1)
+    first_half = imoddur < n_steps
+    second_half = ~first_half & (imoddur >= phase_offset) & (imoddur < phase_offset+n_steps)
+    background_offsets = np.cumsum(shift_dirs*second_half)
     if sync_periods:
-        foreground_phase = background_phase 
+        foreground_offsets = background_offsets
     else:
-        foreground_phase = 1-background_phase
-    row_coords, col_coords = skimage.draw.circle(*center, radius, circle_grating.shape)
+        foreground_offsets = np.cumsum(shift_dirs*first_half)
 
-    frames = []
-    shift_dir = -1
-    for i in range(n_frames):
-        imoddur = i % period_dur
-        if imoddur >= 0 and imoddur < n_steps:
-            shift_dir = -shift_dir if imoddur == 0 else shift_dir
-            if background_phase == 0:
-                background_grating = np.roll(background_grating, shift_dir, axis=background_axis)
-            if foreground_phase == 0:
-                circle_grating = np.roll(circle_grating, shift_dir, axis=foreground_axis)
-        elif imoddur >= phase_offset and imoddur < phase_offset+n_steps:
-            if background_phase == 1:
-                background_grating = np.roll(background_grating, shift_dir, axis=background_axis)
-            if foreground_phase == 1:
-                circle_grating = np.roll(circle_grating, shift_dir, axis=foreground_axis)
-                
-        new_frame = background_grating.copy()
-        new_frame[row_coords, col_coords] = circle_grating[row_coords, col_coords]
-        frames.append(new_frame)
-    return np.asarray(frames), background_grating, circle_grating
+    frames = circle_video(background_grating, background_offsets, background_axis, circle_grating,
+                        foreground_offsets, foreground_axis, center, radius, chunk_size)
+    if n_frames > 0:
+        background_grating = np.roll(background_grating, background_offsets[-1], axis=background_axis)
+        circle_grating = np.roll(circle_grating, foreground_offsets[-1], axis=foreground_axis)
+    return frames, background_grating, circle_grating
 
 def random_differential_circle(n_frames=100, bar_size=4, inner_bar_size=None, foreground_velocity=1, 
                         sync_jitters=False, background_velocity=1, image_shape=(50,50), center=(25,25), 
                         radius=5, horizontal_foreground=True, horizontal_background=True, seed=None,
-                        background_grating=None, circle_grating=None):
+                        background_grating=None, circle_grating=None, chunk_size=None, rng=None):
     """
     Creates circle window onto a grating with a background grating.
     The foreground and background gratings jitter at different rates.
@@ -433,13 +560,21 @@ def random_differential_circle(n_frames=100, bar_size=4, inner_bar_size=None, fo
             optionally pass custom background image through
         circle_grating: ndarray (H,W)
             optionally pass custom foreground image through
+        chunk_size: int or None
+            if not None, the frames are returned as a generator that lazily
+            yields chunks of at most chunk_size frames
+        rng: np.random.RandomState or None
+            source of the jitters. Defaults to the global numpy random state
 
     Returns:
         frame sequence of shape (n_frames, image_shape[0], image_shape[1])
+        or a generator of frame chunks if chunk_size is not None
 
     """
     if seed is not None:
         np.random.seed(seed)
+    if rng is None:
+        rng = np.random
     bar_size=int(bar_size)
     if inner_bar_size is None: 
         inner_bar_size = bar_size
@@ -453,34 +588,32 @@ def random_differential_circle(n_frames=100, bar_size=4, inner_bar_size=None, fo
         background_grating = stripes(image_shape, bar_size, angle=angle)
     background_axis = 0 if horizontal_background else 1
     foreground_axis = 0 if horizontal_foreground else 1
-    background_steps = np.round(np.random.random(n_frames)).astype(np.int)
+    background_steps = np.round(rng.random(n_frames)).astype(int)
     background_steps[background_steps==0] = -1
     if sync_jitters:
-        foreground_steps = background_steps 
+        foreground_steps = background_steps
         foreground_velocity = background_velocity
     else:
-        foreground_steps = np.round(np.random.random(n_frames)).astype(np.int)
+        foreground_steps = np.round(rng.random(n_frames)).astype(int)
         foreground_steps[foreground_steps==0] = -1
-    row_coords, col_coords = skimage.draw.circle(*center, radius, image_shape)
-    frames = []
-    for i in range(n_frames):
-        step = np.random.random(1) < background_velocity
-        if step:
-            background_grating = np.roll(background_grating, background_steps[i], axis=background_axis)
-        new_frame = background_grating.copy()
-            
-        step = np.random.random(1) < foreground_velocity
-        if step:
-            circle_grating = np.roll(circle_grating, foreground_steps[i], axis=foreground_axis)
-
-        new_frame[row_coords, col_coords] = circle_grating[row_coords, col_coords]
-        frames.append(new_frame)
-    return np.asarray(frames), background_grating, circle_grating
+
+    # One background then one foreground draw per frame, in the same
+    # order as drawing them frame by frame
+    draws = rng.random(2*n_frames).reshape(n_frames, 2)
+    background_offsets = np.cumsum(background_steps*(draws[:,0] < background_velocity))
+    foreground_offsets = np.cumsum(foreground_steps*(draws[:,1] < foreground_velocity))
+
+    frames = circle_video(background_grating, background_offsets, background_axis, circle_grating,
+                        foreground_offsets, foreground_axis, center, radius, chunk_size)
+    if n_frames > 0:
+        background_grating = np.roll(background_grating, background_offsets[-1], axis=background_axis)
+        circle_grating = np.roll(circle_grating, foreground_offsets[-1], axis=foreground_axis)
+    return frames, background_grating, circle_grating
 
 def differential_circle(n_frames=100, bar_size=4, inner_bar_size=None, foreground_velocity=0.5, 
                         background_velocity=0, image_shape=(50,50), center=(25,25), radius=5, 
                         init_offset=0, horizontal_foreground=False, horizontal_background=False,
-                        background_grating=None, circle_grating=None):
+                        background_grating=None, circle_grating=None, chunk_size=None):
     """
     Creates circle window onto a grating that has stripes perpendicular to the background.
     The grating behind this window then rolls differently than the background grating.
@@ -516,9 +649,13 @@ def differential_circle(n_frames=100, bar_size=4, inner_bar_size=None, foregroun
             optionally pass custom background image through
         circle_grating: ndarray (H,W)
             optionally pass custom foreground image through
+        chunk_size: int or None
+            if not None, the frames are returned as a generator that lazily
+            yields chunks of at most chunk_size frames
 
     Returns:
         frame sequence of shape (n_frames, image_shape[0], image_shape[1])
+        or a generator of frame chunks if chunk_size is not None
 
     """
     bar_size=int(bar_size)
@@ -535,29 +672,16 @@ def differential_circle(n_frames=100, bar_size=4, inner_bar_size=None, foregroun
     if background_grating is None:
         angle = 0 if horizontal_background else 90
         background_grating = stripes(image_shape, bar_size, angle=angle)
-    row_coords, col_coords = skimage.draw.circle(*center, radius, image_shape)
-    #mask = circle_mask(center, radius, image_shape)
-    frames = []
-    for i in range(n_frames):
-        background_dist = int(background_velocity*i)
-        if background_dist != 0:
-            new_frame = np.roll(background_grating, background_dist, axis=background_axis)
-        else:
-            new_frame = background_grating.copy()
-            
-        foreground_dist = int(foreground_velocity*i)
-        if foreground_dist != 0:
-            new_circ = np.roll(circle_grating, foreground_dist, axis=foreground_axis)
-        else:
-            new_circ = circle_grating.copy()
-        new_frame[row_coords, col_coords] = new_circ[row_coords, col_coords]
-        frames.append(new_frame)
-    return np.asarray(frames), background_grating, circle_grating
+    background_offsets = (background_velocity*np.arange(n_frames)).astype(int)
+    foreground_offsets = (foreground_velocity*np.arange(n_frames)).astype(int)
+    frames = circle_video(background_grating, background_offsets, background_axis, circle_grating,
+                        foreground_offsets, foreground_axis, center, radius, chunk_size)
+    return frames, background_grating, circle_grating
 
 def jittered_circle(n_frames=100, bar_size=4, inner_bar_size=None, foreground_jitter=0.5, 
                         background_jitter=0, image_shape=(50,50), center=(25,25), radius=5, 
                         horizontal_foreground=False, horizontal_background=False, step_size=1,
-                        background_grating=None, circle_grating=None):
+                        background_grating=None, circle_grating=None, chunk_size=None):
     """
     Creates circle window onto a grating that has stripes perpendicular to the background.
     This window then jitters differently than the background grating.
@@ -593,9 +717,13 @@ def jittered_circle(n_frames=100, bar_size=4, inner_bar_size=None, foreground_ji
             optionally pass custom background image through
         circle_grating: ndarray (H,W)
             optionally pass custom foreground image through
+        chunk_size: int or None
+            if not None, the frames are returned as a generator that lazily
+            yields chunks of at most chunk_size frames
 
     Returns:
         frame sequence of shape (n_frames, image_shape[0], image_shape[1])
+        or a generator of frame chunks if chunk_size is not None
 
     """
     bar_size = int(bar_size)
@@ -614,33 +742,29 @@ def jittered_circle(n_frames=100, bar_size=4, inner_bar_size=None, foreground_ji
     circle_grating = np.roll(circle_grating, 2, axis=foreground_axis) # Roll to start with unaligned gratings
     row_shifts = np.random.randint(-step_size,step_size+1, n_frames) # Make random center shifts
     col_shifts = np.random.randint(-step_size,step_size+1, n_frames) # Make random center shifts
-    row_coords, col_coords = skimage.draw.circle(*center, radius, image_shape)
 
     if background_grating is None:
         angle = 0 if horizontal_background else 90
         background_grating = stripes(image_shape, bar_size, angle=angle)
     background_shifts = np.random.randint(-1, 2, n_frames) # Make random background shifts
 
-    frames = []
-    for i in range(n_frames):
-        shift_idx = int(background_jitter*i)
-        if shift_idx != 0:
-            background_grating = np.roll(background_grating, background_shifts[shift_idx], axis=background_axis)
-            background_shifts[shift_idx] = 0
-        new_frame = background_grating.copy()
-            
-        shift_idx = int(foreground_jitter*i)
-        if shift_idx != 0:
-            center = (center[0] + row_shifts[shift_idx], center[1] + col_shifts[shift_idx])
-            row_coords, col_coords = skimage.draw.circle(*center, radius, image_shape)
-            row_shifts[shift_idx], col_shifts[shift_idx] = 0, 0
-        new_frame[row_coords, col_coords] = circle_grating[row_coords, col_coords]
-        frames.append(new_frame)
-    return np.asarray(frames), background_grating, circle_grating
+    # Frame i has taken every shift from index 1 up to int(jitter*i)
+    shift_idxs = (background_jitter*np.arange(n_frames)).astype(int)
+    background_offsets = (np.cumsum(background_shifts)-background_shifts[:1])[shift_idxs]
+    shift_idxs = (foreground_jitter*np.arange(n_frames)).astype(int)
+    centers = np.stack([np.cumsum(row_shifts)-row_shifts[:1], np.cumsum(col_shifts)-col_shifts[:1]], axis=-1)
+    centers = np.asarray(center)[None] + centers[shift_idxs]
+
+    frames = circle_video(background_grating, background_offsets, background_axis, circle_grating,
+                        np.zeros(n_frames, dtype=int), foreground_axis, centers, radius, chunk_size)
+    if n_frames > 0:
+        background_grating = np.roll(background_grating, background_offsets[-1], axis=background_axis)
+    return frames, background_grating, circle_grating
 
 def moving_circle(n_frames=100, bar_size=4, inner_bar_size=None, foreground_velocity=0.5, 
                         background_velocity=0, image_shape=(50,50), center=(25,25), radius=5, 
-                        horizontal_background=False, backround_grating=None, circle_grating=None):
+                        horizontal_background=False, background_grating=None, circle_grating=None,
+                        chunk_size=None):
     """
     Creates circle window onto a grating that has stripes perpendicular to the background.
     This window then translates differently than the background grating.
@@ -671,9 +795,13 @@ def moving_circle(n_frames=100, bar_size=4, inner_bar_size=None, foreground_velo
             optionally pass custom background image through
         circle_grating: ndarray (H,W)
             optionally pass custom foreground image through
+        chunk_size: int or None
+            if not None, the frames are returned as a generator that lazily
+            yields chunks of at most chunk_size frames
 
     Returns:
         frame sequence of shape (n_frames, image_shape[0], image_shape[1])
+        or a generator of frame chunks if chunk_size is not None
 
     """
     bar_size=int(bar_size)
@@ -687,24 +815,16 @@ def moving_circle(n_frames=100, bar_size=4, inner_bar_size=None, foreground_velo
     angle = (angle+90)%180
     if background_grating is None:
         background_grating = stripes(image_shape, bar_size, angle=angle)
-    row_coords, col_coords = skimage.draw.circle(*center, radius, image_shape)
-    frames = []
-    for i in range(n_frames):
-        background_dist = int(background_velocity*i)
-        if background_dist != 0:
-            new_frame = shift(background_grating, background_fill=0, shift=(0,background_dist))
-        else:
-            new_frame = background_grating.copy()
-            
-        foreground_dist = int(foreground_velocity*i)
-        if foreground_dist != 0:
-            new_center = (center[0], center[1]+foreground_dist)
-            new_row_coords, new_col_coords = skimage.draw.circle(*new_center, radius, image_shape)
-        else:
-            new_row_coords, new_col_coords = row_coords, col_coords
-        new_frame[new_row_coords, new_col_coords] = circle_grating[new_row_coords, new_col_coords]
-        frames.append(new_frame)
-    return np.asarray(frames), background_grating, circle_grating
+    background_dists = (background_velocity*np.arange(n_frames)).astype(int)
+    foreground_dists = (foreground_velocity*np.arange(n_frames)).astype(int)
+    def make_frames(idxs):
+        shifts = np.stack([np.zeros(len(idxs), dtype=int), background_dists[idxs]], axis=-1)
+        frames = shift_frames(background_grating, shifts, background_fill=0)
+        centers = np.stack([np.full(len(idxs), center[0]), center[1]+foreground_dists[idxs]], axis=-1)
+        masks = circle_masks(centers, radius, image_shape)
+        return np.where(masks, circle_grating, frames)
+    frames = synthesize(make_frames, n_frames, chunk_size)
+    return frames, background_grating, circle_grating
         
 def shift(img, background_fill=0, shift=(0,0)):
     """
@@ -774,10 +894,40 @@ def concat(*args, nx=50, nh=40):
     nx : int, optional
         Number of spatial dimensions (default: 50)
     """
-    concatenated = np.vstack(map(lambda s: spatialize(s, nx), args)).astype('float32')
+    concatenated = np.vstack([spatialize(s, nx) for s in args]).astype('float32')
     return rolling_window(concatenated, nh)
 
 
+def rolling_chunks(chunks, nx=50, nh=40):
+    """Lazy form of concat. Yields the rolling window of a stimulus that
+    arrives as a sequence of chunks, keeping only the last nh frames
+    between chunks. Concatenating the yielded arrays gives the same
+    result as concat(*chunks, nx=nx, nh=nh)
+
+    Parameters
+    ----------
+    chunks : iterable
+        An iterable of stimuli (numpy arrays), such as the generator
+        returned by the circle stimuli when a chunk_size is argued
+
+    nh : int, optional
+        Number of time steps in the rolling window history (default: 40)
+
+    nx : int, optional
+        Number of spatial dimensions (default: 50)
+    """
+    history = None
+    for chunk in chunks:
+        chunk = spatialize(chunk, nx).astype('float32')
+        if history is not None:
+            chunk = np.concatenate([history, chunk], axis=0)
+        if len(chunk) > nh:
+            yield rolling_window(chunk, nh)
+            history = chunk[-nh:]
+        else:
+            history = chunk
+
+
 def white(nt, nx=1, contrast=1.0):
     """Gaussian white noise with the given contrast
 
@@ -920,7 +1070,7 @@ def driftingbar(velocity, width, intensity=-1., x=(-30, 30)):
     """
     npts = 1 + int((x[1] - x[0]) / velocity)
     centers = np.linspace(x[0], x[1], npts)
-    return centers, velocity, concat(np.stack(map(lambda x: bar((x, 0), width, np.Inf, us_factor=5, blur=0.), centers)))
+    return centers, velocity, concat(np.stack([bar((x, 0), width, np.inf, us_factor=5, blur=0.) for x in centers]))
 
 
 def cmask(center, radius, array):
@@ -957,11 +1107,11 @@ def square(halfperiod, nsamples, phase=0., intensity=1.0):
     offset = int(2 * phase * halfperiod)
 
     # generate one period of the waveform
-    waveform = np.stack(repeat(np.array([intensity, -intensity]), halfperiod)).T.ravel()
+    waveform = np.repeat([intensity, -intensity], halfperiod)
 
     # generate the repeated sequence
     repeats = int(np.ceil(nsamples / (2 * halfperiod)) + 1)
-    sequence = np.hstack(repeat(waveform, repeats))
+    sequence = np.tile(waveform, repeats)
 
     # use the offset to specify the phase
     return sequence[offset:(nsamples + offset)]
@@ -1000,11 +1150,54 @@ def grating(barsize=(5, 0), phase=(0., 0.), nx=50, intensity=(1., 1.), us_factor
     return downsample(np.outer(y, x), us_factor, blur)
 
 
+def gratings(phases, barsize=5, nx=50, intensity=1., us_factor=1, blur=0.):
+    """Returns a vertical grating frame for each of the phases
+
+    Vectorized form of grating with barsize=(barsize, 0) for a sequence
+    of x-phases. The square wave of every frame is indexed at once from
+    a single period of the waveform.
+
+    Parameters
+    ----------
+    phases : array_like
+        The phase of the grating at each frame (as a fraction of the period).
+        Must be between 0 and 1.
+
+    barsize : int, optional
+        Size of the bar in the x-dimension (default: 5)
+
+    nx : int, optional
+        The number of pixels along each dimension of the stimulus (default: 50)
+
+    intensity : float, optional
+        The contrast of the grating (default: 1.)
+
+    us_factor : int
+        Amount to upsample the image by (before downsampling back to 50x50), (default: 1)
+
+    blur : float
+        Amount of blur to applied to the upsampled image (before downsampling), (default: 0.)
+    """
+    phases = np.asarray(phases, dtype=float)
+    assert np.all((0 <= phases) & (phases <= 1)), "Phase must be a fraction between 0 and 1"
+    nsamples = nx * us_factor
+    if barsize == 0:
+        x = np.ones((len(phases), nsamples))
+    else:
+        offsets = (2 * phases * barsize).astype(int)
+        waveform = np.repeat([intensity, -intensity], barsize)
+        x = waveform[(offsets[:, None] + np.arange(nsamples)) % (2 * barsize)]
+    frames = x[:, None, :] * np.ones((nsamples, 1))
+    if us_factor == 1 and blur == 0:
+        return frames
+    frames = gaussian(frames, sigma=(0, blur, blur))
+    return downscale_local_mean(frames, (1, us_factor, us_factor))
+
+
 def jittered_grating(nsamples, sigma=0.1, size=3):
     """Creates a grating that jitters over time according to a random walk"""
     phases = np.cumsum(sigma * np.random.randn(nsamples)) % 1.0
-    frames = np.stack([grating(barsize=(size, 0), phase=(p, 0.)) for p in phases])
-    return frames
+    return gratings(phases, barsize=size)
 
 
 def drifting_grating(nsamples, dt, barsize, us_factor=1, blur=0.):
@@ -1028,10 +1221,7 @@ def drifting_grating(nsamples, dt, barsize, us_factor=1, blur=0.):
         Amount of blur to applied to the upsampled image (before downsampling), (default: 0.)
     """
     phases = np.mod(np.arange(nsamples) * dt, 1)
-    return np.stack([grating(barsize=(barsize, 0),
-                             phase=(phi, 0.),
-                             us_factor=us_factor,
-                             blur=blur) for phi in phases])
+    return gratings(phases, barsize=barsize, us_factor=us_factor, blur=blur)
 
 
 def reverse(img, halfperiod, nsamples):
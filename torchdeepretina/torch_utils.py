@@ -1003,7 +1003,7 @@ class SplitConv2d(nn.Module):
         self.convs = nn.ModuleList([])
         self.ret_stacked = ret_stacked
         for tup in conv_param_tuples:
-            convs.append(nn.Conv2d(*tup))
+            self.convs.append(nn.Conv2d(*tup))
 
     def forward(self, x):
         fxs = []
@@ -1144,16 +1144,96 @@ class Kinetics(nn.Module):
         new_pop[:, 3] = pop[:, 3] + dt * (- ksr + ksi)
         return new_pop[:, 1], new_pop
     
+class RingBuffer:
+    """
+    Fixed length history of tensors stored in a single preallocated (B, D, ...)
+    tensor. Used in place of a deque(maxlen=D) of (B, ...) tensors. New entries
+    overwrite the oldest entry and idx tracks the position of the most recent
+    one, so the chronological order of the buffer is the storage order rolled
+    by shift = idx+1.
+
+    Entries are written in place when gradients are disabled. Otherwise the
+    buffer is copied so that earlier versions stay valid for backpropagation.
+    Buffers returned by detach share memory with the original.
+    """
+    def __init__(self, data, idx=-1):
+        """
+        data - FloatTensor (B, D, ...)
+            the initial history
+        idx - int
+            position of the most recent entry. The default treats
+            data as already being in chronological order.
+        """
+        self.data = data
+        self.idx = idx % data.shape[1]
+
+    @property
+    def maxlen(self):
+        return self.data.shape[1]
+
+    @property
+    def shift(self):
+        """
+        The roll along dim 1 that puts the storage order into chronological order.
+        """
+        return (self.idx+1) % self.maxlen
+
+    def append(self, x):
+        """
+        x - FloatTensor (B, ...)
+        """
+        idx = (self.idx+1) % self.maxlen
+        if torch.is_grad_enabled():
+            index = torch.LongTensor([idx]).to(self.data.device)
+            self.data = self.data.index_copy(1, index, x[:,None])
+        else:
+            self.data[:,idx] = x
+        self.idx = idx
+
+    def ordered(self):
+        """
+        Returns the history in chronological order as a (B, D, ...) tensor.
+        The oldest entry comes first.
+        """
+        if self.shift == 0:
+            return self.data
+        return torch.roll(self.data, -self.shift, dims=1)
+
+    def detach(self):
+        return RingBuffer(self.data.detach(), self.idx)
+
+    def clone(self):
+        return RingBuffer(self.data.clone(), self.idx)
+
+    def to(self, device):
+        return RingBuffer(self.data.to(device), self.idx)
+
+    def __len__(self):
+        return self.maxlen
+
 class Temperal_Filter(nn.Module):
     def __init__(self, tem_len, spatial):
         super().__init__()
         self.spatial = spatial
         spatial_dims = np.ones(spatial).astype(np.int32).tolist()
         self.filter = nn.Parameter(torch.rand(tem_len, *spatial_dims))
+        # Rolls the filter along the temporal dim. Set to the shift of a
+        # RingBuffer to filter its unordered data.
+        self.shift = 0
 
     def forward(self, x):
-        out = (x * self.filter).sum(axis=-self.spatial-1)
-        return out
+        """
+        x - FloatTensor (..., D, *spatial)
+        """
+        filt = self.filter.reshape(-1)
+        if self.shift != 0:
+            filt = torch.roll(filt, self.shift)
+        if self.spatial == 0:
+            return torch.matmul(x, filt)
+        shape = x.shape
+        x = x.reshape(*shape[:len(shape)-self.spatial], -1)
+        out = torch.matmul(filt, x)
+        return out.reshape(*shape[:len(shape)-self.spatial-1], *shape[len(shape)-self.spatial:])
     
 class Chan_Temperal_Filter(nn.Module):
     def __init__(self, chan, tem_len, spatial):
@@ -9,7 +9,7 @@ from torch.nn import PoissonNLLLoss, MSELoss
 import torch.nn.functional as F
 import os.path as path
 from torchdeepretina.utils import get_cuda_info, save_checkpoint, GaussRegularizer
-from torchdeepretina.datas import loadexpt, DataContainer, DataDistributor
+from torchdeepretina.datas import loadexpt, DataContainer, DataDistributor, SharedData, share_resources
 from torchdeepretina.models import *
 import torchdeepretina.analysis as analysis
 import time
@@ -17,11 +17,14 @@ from tqdm import tqdm
 import math
 import torch.multiprocessing as mp
 from queue import Queue
-from collections import deque
+from collections import Counter
 import psutil
 import gc
 import resource
 import json
+import hashlib
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
 
 class Trainer:
     def __init__(self, run_q=None, return_q=None, early_stopping=10, stop_tolerance=0.01):
@@ -57,7 +60,7 @@ class Trainer:
                 print("Caught error",e,"on", train_args[0]['exp_num'], "will retry in 100 seconds...")
                 sleep(100)
 
-    def get_model_and_distr(self, hyps, model_hyps, train_data):
+    def get_model_and_distr(self, hyps, model_hyps, train_data, teacher_y=None):
         """
         hyps: dict
             dict of relevant hyperparameters
@@ -65,6 +68,9 @@ class Trainer:
             dict of relevant hyperparameters
         train_data: DataContainer
             a DataContainer of the training data as returned by get_data
+        teacher_y: ndarray or None
+            teacher outputs aligned with train_data.y as returned by
+            get_teacher_outputs
         """
         model = hyps['model_class'](**model_hyps)
         model = model.to(hyps['device'])
@@ -73,7 +79,7 @@ class Trainer:
         shift_labels = False if 'shift_labels' not in hyps else hyps['shift_labels']
         data_distr = DataDistributor(train_data, num_val, batch_size=hyps['batch_size'], shuffle=hyps['shuffle'], 
                                                                     recurrent=model.recurrent, seq_len=seq_len, 
-                                                                    shift_labels=shift_labels)
+                                                                    shift_labels=shift_labels, teacher_y=teacher_y)
         data_distr.torch()
         return model, data_distr
 
@@ -111,11 +117,40 @@ class Trainer:
             hs = [torch.zeros(batch_size, *h).to(device) for h in model.h_shapes]
             if model.kinetic:
                 hs[0][:,0] = hyps['intl_pop']
-                hs[1] = deque([],maxlen=hyps['recur_seq_len'])
-                for i in range(hyps['recur_seq_len']):
-                    hs[1].append(torch.zeros(batch_size, *model.h_shapes[1]).to(device))
+                hs[1] = RingBuffer(torch.zeros(batch_size, hyps['recur_seq_len'], *model.h_shapes[1]).to(device))
         return hs
 
+    def load_latest(self, hyps, model, optimizer, scheduler):
+        """
+        Loads the latest checkpoint of the save folder into the model,
+        optimizer and scheduler.
+
+        hyps: dict
+            dict of relevant hyperparameters
+        model: torch nn.Module
+        optimizer: torch Optimizer
+        scheduler: torch lr scheduler
+
+        returns:
+            start_epoch: int
+                the epoch following the checkpoint, 0 if there is none
+        """
+        epochs = []
+        for f in os.listdir(hyps['save_folder']):
+            if f.startswith("test_epoch_") and f.endswith(".pth"):
+                epochs.append(int(f[len("test_epoch_"):-len(".pth")]))
+        if len(epochs) == 0:
+            return 0
+        path = os.path.join(hyps['save_folder'], "test_epoch_"+str(max(epochs))+".pth")
+        # The checkpoints hold the hyperparameters, which are not only tensors
+        checkpt = torch.load(path, map_location=hyps['device'], weights_only=False)
+        model.load_state_dict(checkpt['model_state_dict'])
+        optimizer.load_state_dict(checkpt['optim_state_dict'])
+        if 'scheduler_state_dict' in checkpt:
+            scheduler.load_state_dict(checkpt['scheduler_state_dict'])
+        print("Resuming", hyps['save_folder'], "from epoch", checkpt['epoch'])
+        return checkpt['epoch']+1
+
     def print_train_update(self, error, grade, l1, model, n_loops, i):
         loss = error + grade + l1
         s = "Loss: {:.5e} – ".format(loss.item())
@@ -190,7 +225,7 @@ class Trainer:
                 print("{}/{}".format(i*step_size,data_distr.val_y.shape[0]), end="     \r")
         return val_loss, val_preds, val_targs
 
-    def train(self, hyps, model_hyps, device, verbose=False):
+    def train(self, hyps, model_hyps, device, verbose=False, shared_data=None):
         """
         hyps: dict
             dict of relevant hyperparameters
@@ -200,38 +235,55 @@ class Trainer:
             the model to be trained
         train_data: DataContainer
             a DataContainer of the training data as returned by get_data
+        shared_data: tuple of SharedData or None
+            the data loaded by the search driver, see get_data
+
+        If hyps['resume'] is true, training continues from the latest
+        checkpoint in the save folder until hyps['n_epochs'].
         """
         # Initialize miscellaneous parameters 
         torch.cuda.empty_cache()
+        self.prev_acc = None
         hyps['device'] = device
         batch_size = hyps['batch_size']
         if 'skip_nums' in hyps and hyps['skip_nums'] is not None and len(hyps['skip_nums']) > 0 and hyps['exp_num'] in hyps['skip_nums']:
             print("Skipping", hyps['save_folder'])
-            results = {"save_folder":hyps['save_folder'], "Loss":None, "ValAcc":None, "ValLoss":None, "TestPearson":None}
+            results = {"save_folder":hyps['save_folder'], "Loss":None, "ValAcc":None, "ValLoss":None, "TestPearson":None,
+                                                                                "TrainSamples":0, "Epochs":0}
             return results
 
         # Get Data, Make Model, Record Initial Hyps and Model
-        train_data, test_data = get_data(hyps)
+        train_data, test_data = get_data(hyps, shared_data)
         model_hyps["n_units"] = train_data.y.shape[-1]
         model_hyps['centers'] = train_data.centers
-        model, data_distr = self.get_model_and_distr(hyps, model_hyps, train_data)
-        print("train shape:", data_distr.train_shape)
-        print("val shape:", data_distr.val_shape)
-        self.record_session(hyps, model)
         teacher = None
+        teacher_y = None
         if 'teacher' in hyps and hyps['teacher'] is not None:
             teacher = analysis.read_model_file(hyps['teacher'])
             teacher.to(device)
             teacher.eval()
             #if hyps['teacher_layers'] is not None:
+            if 'cache_teacher' not in hyps or hyps['cache_teacher']:
+                teacher_y = get_teacher_outputs(hyps, teacher, train_data)
+        model, data_distr = self.get_model_and_distr(hyps, model_hyps, train_data, teacher_y=teacher_y)
+        print("train shape:", data_distr.train_shape)
+        print("val shape:", data_distr.val_shape)
+        self.record_session(hyps, model)
 
         # Make optimization objects (lossfxn, optimizer, scheduler)
         optimizer, scheduler, loss_fn = get_optim_objs(hyps, model, train_data.centers)
         if 'gauss_reg' in hyps and hyps['gauss_reg'] > 0:
             gauss_reg = GaussRegularizer(model, [0,6], std=hyps['gauss_reg'])
 
+        start_epoch = 0
+        if 'resume' in hyps and hyps['resume']:
+            start_epoch = self.load_latest(hyps, model, optimizer, scheduler)
+
         # Training
-        for epoch in range(hyps['n_epochs']):
+        train_samples = 0
+        epoch = start_epoch-1
+        avg_loss, val_acc, val_loss, avg_pearson = None, None, None, None
+        for epoch in range(start_epoch, hyps['n_epochs']):
             print("Beginning Epoch", epoch, " -- ", hyps['save_folder'])
             print()
             n_loops = data_distr.n_loops
@@ -242,15 +294,18 @@ class Trainer:
             starttime = time.time()
 
             # Train Loop
-            for i,(x,label) in enumerate(data_distr.train_sample()):
+            for i,batch in enumerate(data_distr.train_sample()):
                 optimizer.zero_grad()
+                x, label = batch[:2]
+                answers = batch[2] if len(batch) > 2 else None
                 label = label.float().to(device)
 
                 # Error Evaluation
                 if model.recurrent:
-                    y,error,grade,hs = recurrent_eval(hyps, x, label, model, hs, loss_fn, teacher=teacher)
+                    y,error,grade,hs = recurrent_eval(hyps, x, label, model, hs, loss_fn, teacher=teacher,
+                                                                                        answers=answers)
                 else:
-                    y,error,grade = static_eval(hyps, x, label, model, loss_fn, teacher=teacher)
+                    y,error,grade = static_eval(hyps, x, label, model, loss_fn, teacher=teacher, answers=answers)
                 activity_l1 = torch.zeros(1).to(device) if hyps['l1']<=0 else hyps['l1'] * torch.norm(y, 1).float().mean()
                 if 'gauss_reg' in hyps and hyps['gauss_reg'] > 0:
                     activity_l1 += hyps['gauss_loss_coef']*gauss_reg.get_loss()
@@ -261,6 +316,7 @@ class Trainer:
                 optimizer.step()
 
                 epoch_loss += loss.item()
+                train_samples += int(np.prod(label.shape[:-1]))
                 if verbose:
                     self.print_train_update(error, grade, activity_l1, model, n_loops, i)
                 if math.isnan(epoch_loss) or math.isinf(epoch_loss) or hyps['exp_name']=="test":
@@ -351,6 +407,7 @@ class Trainer:
                 "model_hyps": model_hyps,
                 "model_state_dict":model.state_dict(),
                 "optim_state_dict":optimizer.state_dict(),
+                "scheduler_state_dict":scheduler.state_dict(),
                 "loss": avg_loss,
                 "epoch":epoch,
                 "val_loss":val_loss,
@@ -374,12 +431,13 @@ class Trainer:
                 break
 
         # Final save
-        results = {"save_folder":hyps['save_folder'], "Loss":avg_loss, "ValAcc":val_acc, "ValLoss":val_loss, "TestPearson":avg_pearson}
+        results = {"save_folder":hyps['save_folder'], "Loss":avg_loss, "ValAcc":val_acc, "ValLoss":val_loss, "TestPearson":avg_pearson,
+                                                                "TrainSamples":train_samples, "Epochs":epoch+1}
         with open(hyps['save_folder'] + "/hyperparams.txt",'a') as f:
             f.write("\n" + " ".join([str(k)+":"+str(results[k]) for k in sorted(results.keys())]) + '\n')
         return results
 
-def recurrent_eval(hyps, x, label, model, hs, loss_fn, teacher=None):
+def recurrent_eval(hyps, x, label, model, hs, loss_fn, teacher=None, answers=None):
     """
     hyps: dict
         dict of relevant hyperparameters
@@ -391,36 +449,41 @@ def recurrent_eval(hyps, x, label, model, hs, loss_fn, teacher=None):
         the model to be trained
     hs: list
         the hidden states of the recurrent model as obtained through self.get_hs
+    teacher: torch nn.Module
+        optional teacher network
+    answers: torch FloatTensor (batch_size, recur_seq_len, n_units)
+        optional precomputed teacher outputs for x (see get_teacher_outputs). If
+        argued, the teacher is not run
     """
     hs_out = hs
     batch_size = hyps['batch_size']
     ys = []
-    answers = []
     device = hyps['device']
-    teacher_device = device
-    if teacher is None:
-        teacher = lambda x: None
-        teacher_device = torch.device("cpu")
+    run_teacher = teacher is not None and answers is None
+    if run_teacher:
+        answers = []
     for ri in range(hyps['recur_seq_len']):
         ins = x[:,ri]
         y, hs_out = model(ins.to(device), hs_out)
         ys.append(y.view(batch_size, 1, label.shape[-1]))
-        with torch.no_grad():
-            ans = teacher(x.to(teacher_device))
-        answers.append(ans)
+        if run_teacher:
+            with torch.no_grad():
+                ans = teacher(ins.to(device))
+            answers.append(ans.view(batch_size, 1, label.shape[-1]))
         if ri == 0 and not hyps['reset_hs']:
             if model.kinetic:
                 hs[0] = hs_out[0].data.clone()
-                hs[1] = deque([h.data.clone() for h in hs[1]], maxlen=hyps['recur_seq_len'])
+                hs[1] = hs[1].detach().clone()
             else:
                 hs = [h.data.clone() for h in hs_out]
     y = torch.cat(ys, dim=1)
     error = loss_fn(y,label)/hyps['recur_seq_len']
 
     # Teacher
-    if answers[0] is not None:
-        answers = torch.cat(answers, dim=1)
-        grade = hyps['teacher_coef']*F.mse_loss(y,answers.data)/hyps['recur_seq_len']
+    if answers is not None:
+        if run_teacher:
+            answers = torch.cat(answers, dim=1)
+        grade = hyps['teacher_coef']*F.mse_loss(y,answers.to(device).data)/hyps['recur_seq_len']
         hyps['teacher_coef'] *= hyps['teacher_decay']
     else:
         grade = torch.zeros(1).to(device)
@@ -431,7 +494,7 @@ def recurrent_eval(hyps, x, label, model, hs, loss_fn, teacher=None):
 
     return y, error, grade, hs
 
-def static_eval(hyps, x, label, model, loss_fn, teacher=None):
+def static_eval(hyps, x, label, model, loss_fn, teacher=None, answers=None):
     """
     hyps: dict
         dict of relevant hyperparameters
@@ -443,11 +506,16 @@ def static_eval(hyps, x, label, model, loss_fn, teacher=None):
         the model to be trained
     teacher: torch nn.Module
         optional teacher network
+    answers: torch FloatTensor
+        optional precomputed teacher outputs for x (see get_teacher_outputs). If
+        argued, the teacher is not run
     """
     device = hyps['device']
     y = model(x.to(device))
     error = loss_fn(y,label)
-    if teacher is not None:
+    if answers is not None:
+        grade = F.mse_loss(y,answers.to(device))
+    elif teacher is not None:
         with torch.no_grad():
             ans = teacher(x.to(device))
         grade = F.mse_loss(y,ans.data)
@@ -455,11 +523,65 @@ def static_eval(hyps, x, label, model, loss_fn, teacher=None):
         grade = torch.zeros(1).to(device)
     return y,error,grade
 
-def get_data(hyps):
+def get_teacher_outputs(hyps, teacher, data, batch_size=500):
+    """
+    Computes the outputs of the teacher for every stimulus window of data
+    once and stores them in a memory-mapped .npy cache. The cache is keyed by
+    the teacher file and the data, so later runs and epochs reuse it.
+
+    hyps: dict
+        dict of relevant hyperparameters. The cache is kept in
+        hyps['teacher_cache_dir'], defaulting to <exp_name>/teacher_cache
+    teacher: torch nn.Module
+        the teacher network on hyps['device']
+    data: DataContainer
+        the training data as returned by get_data
+    batch_size: int
+        number of windows per teacher forward pass
+
+    returns:
+        teacher_y: read-only memmap (N, n_units)
+            the teacher outputs aligned with data.y
+    """
+    if 'teacher_cache_dir' in hyps and hyps['teacher_cache_dir'] is not None:
+        cache_dir = hyps['teacher_cache_dir']
+    else:
+        cache_dir = os.path.join(hyps['exp_name'], "teacher_cache")
+    os.makedirs(cache_dir, exist_ok=True)
+    teacher_path = os.path.abspath(hyps['teacher'])
+    key = str((teacher_path, os.path.getmtime(teacher_path), data_key(hyps), len(data.X)))
+    cache_file = os.path.join(cache_dir, hashlib.md5(key.encode()).hexdigest() + ".npy")
+    if not os.path.exists(cache_file):
+        print("Caching teacher outputs to", cache_file)
+        # Written under a temporary name so that concurrent runs never read a
+        # partial cache
+        temp_file = cache_file[:-len(".npy")] + "_" + str(os.getpid()) + ".npy"
+        with torch.no_grad():
+            out = teacher(torch.FloatTensor(data.X[:1]).to(hyps['device']))
+            cache = np.lib.format.open_memmap(temp_file, mode='w+', dtype=np.float32,
+                                                            shape=(len(data.X), out.shape[-1]))
+            for i in range(0, len(data.X), batch_size):
+                x = torch.FloatTensor(data.X[i:i+batch_size]).to(hyps['device'])
+                cache[i:i+batch_size] = teacher(x).cpu().numpy()
+        cache.flush()
+        del cache
+        os.replace(temp_file, cache_file)
+    return np.load(cache_file, mmap_mode='r')
+
+def get_data(hyps, shared_data=None):
     """
     hyps: dict
         dict of relevant hyperparameters
+    shared_data: tuple of SharedData or None
+        the train and test data as returned by load_shared_data. If argued,
+        read-only views of the shared data are returned instead of loading
+        the data from disk
     """
+    if shared_data is not None:
+        train_data, test_data = shared_data
+        if test_data is not None:
+            test_data = test_data.attach()
+        return train_data.attach(), test_data
     img_depth, img_height, img_width = hyps['img_shape']
     train_data = DataContainer(loadexpt(hyps['dataset'],hyps['cells'], hyps['stim_type'],'train',img_depth,0))
     norm_stats = [train_data.stats['mean'], train_data.stats['std']] 
@@ -473,6 +595,80 @@ def get_data(hyps):
         test_data = None
     return train_data, test_data
 
+def load_shared_data(hyps):
+    """
+    Loads the data of get_data into shared memory.
+
+    hyps: dict
+        dict of relevant hyperparameters
+
+    returns:
+        train_data: SharedData
+        test_data: SharedData or None
+    """
+    img_depth, img_height, img_width = hyps['img_shape']
+    train_data = SharedData(loadexpt(hyps['dataset'],hyps['cells'], hyps['stim_type'],'train',img_depth,0))
+    norm_stats = [train_data.stats['mean'], train_data.stats['std']]
+
+    try:
+        test_data = SharedData(loadexpt(hyps['dataset'],hyps['cells'],hyps['stim_type'],'test',img_depth,0,
+                                                                norm_stats=norm_stats), n_samples=500)
+    except:
+        test_data = None
+    return train_data, test_data
+
+def data_key(hyps):
+    """
+    The hyperparameters that determine the data returned by get_data
+    """
+    return (hyps['dataset'], str(hyps['cells']), hyps['stim_type'], hyps['img_shape'][0])
+
+class SharedDataStore:
+    """
+    Loads each distinct dataset of a hyperparameter search into shared memory
+    once, when the first run that uses it is dispatched, and unlinks it when
+    the last run that uses it has finished.
+    """
+    def __init__(self, hypersets):
+        """
+        hypersets: list of [hyps, model_hyps]
+            all runs of the search
+        """
+        self.counts = Counter(data_key(hyperset[0]) for hyperset in hypersets)
+        self.datas = dict()
+        # Workers forked from here on share the resource tracker of the store
+        share_resources()
+
+    def acquire(self, hyps):
+        """
+        returns:
+            shared_data: tuple of SharedData
+                the data for the run of hyps, see get_data
+        """
+        key = data_key(hyps)
+        if key not in self.datas:
+            print("Loading", key, "into shared memory")
+            self.datas[key] = load_shared_data(hyps)
+        return self.datas[key]
+
+    def release(self, hyps):
+        """
+        Marks the run of hyps as finished
+        """
+        key = data_key(hyps)
+        self.counts[key] -= 1
+        if self.counts[key] <= 0 and key in self.datas:
+            self.unlink(key)
+
+    def unlink(self, key):
+        for data in self.datas.pop(key):
+            if data is not None:
+                data.unlink()
+
+    def close(self):
+        for key in list(self.datas.keys()):
+            self.unlink(key)
+
 def get_optim_objs(hyps, model, centers=None):
     """
     hyps: dict
@@ -550,6 +746,134 @@ def fill_hyper_q(hyps, hyp_ranges, keys, hyper_q, idx=0):
             hyper_q = fill_hyper_q(hyps, hyp_ranges, keys, hyper_q, idx+1)
     return hyper_q
 
+class SuccessiveHalving:
+    """
+    Asynchronous successive halving (ASHA) over a fixed set of configurations.
+    Every configuration starts at the lowest rung, which trains for min_epochs.
+    Each rung trains for eta times as many epochs as the one below it, up to
+    max_epochs. Whenever a worker asks for a run, the best configuration that
+    is in the top 1/eta of its rung and has not yet been promoted is resumed
+    at the next rung, searching from the highest rung down. If there is none,
+    the next unstarted configuration is started. Configurations that are never
+    promoted are terminated at their rung. A rung holding fewer than eta
+    configurations promotes its best one once all of them have reported.
+    """
+    def __init__(self, n_configs, max_epochs, min_epochs=1, eta=3, maximize=True):
+        """
+        n_configs: int
+            number of configurations in the search
+        max_epochs: int
+            the number of epochs of the highest rung
+        min_epochs: int
+            the number of epochs of the lowest rung
+        eta: int
+            reduction factor. The top 1/eta of each rung is promoted
+        maximize: bool
+            if true, higher scores are better
+        """
+        assert eta > 1, "eta must be greater than 1"
+        self.n_configs = n_configs
+        self.eta = eta
+        self.maximize = maximize
+        self.budgets = [min(min_epochs, max_epochs)]
+        while self.budgets[-1] < max_epochs:
+            self.budgets.append(min(self.budgets[-1]*eta, max_epochs))
+        self.scores = [dict() for _ in self.budgets]
+        self.promoted = [set() for _ in self.budgets]
+        self.stopped = set()
+        self.running = set()
+        self.next_config = 0
+
+    def promotable(self, rung):
+        """
+        returns:
+            configs: list of int
+                the configurations of the rung that may be promoted, best first
+        """
+        scores = self.scores[rung]
+        ranked = sorted(scores.keys(), key=lambda c: scores[c], reverse=self.maximize)
+        n_top = len(ranked)//self.eta
+        if n_top == 0 and self.rung_complete(rung):
+            n_top = 1
+        top = ranked[:n_top]
+        return [c for c in top if c not in self.promoted[rung] and c not in self.stopped]
+
+    def rung_complete(self, rung):
+        """
+        returns:
+            complete: bool
+                true if every configuration that can reach the rung has
+                reported its score at it
+        """
+        if any(r == rung for _, r in self.running):
+            return False
+        if rung == 0:
+            return self.next_config >= self.n_configs
+        return self.rung_complete(rung-1) and len(self.promotable(rung-1)) == 0
+
+    def has_job(self):
+        if self.next_config < self.n_configs:
+            return True
+        return any(len(self.promotable(k)) > 0 for k in range(len(self.budgets)-1))
+
+    def finished(self):
+        return len(self.running) == 0 and not self.has_job()
+
+    def next_job(self):
+        """
+        returns:
+            config: int or None
+                index of the configuration to train. None if there is no run
+                to start until a running one is reported
+            rung: int
+                the rung to train it to, see budgets
+        """
+        for rung in reversed(range(len(self.budgets)-1)):
+            configs = self.promotable(rung)
+            if len(configs) > 0:
+                self.promoted[rung].add(configs[0])
+                self.running.add((configs[0], rung+1))
+                return configs[0], rung+1
+        if self.next_config < self.n_configs:
+            self.next_config += 1
+            self.running.add((self.next_config-1, 0))
+            return self.next_config-1, 0
+        return None, None
+
+    def report(self, config, rung, score, stopped=False):
+        """
+        Records the score of a finished run.
+
+        config: int
+        rung: int
+        score: float or None
+            None or nan scores rank last
+        stopped: bool
+            if true, the run ended before its budget (i.e. by early stopping)
+            and is not promoted
+        """
+        self.running.discard((config, rung))
+        if score is None or math.isnan(score):
+            score = -math.inf if self.maximize else math.inf
+        self.scores[rung][config] = score
+        if stopped:
+            self.stopped.add(config)
+
+def asha_hyperset(hyperset, rung, scheduler):
+    """
+    Copies a hyperset to train to the budget of the argued rung, resuming from
+    the checkpoint of the previous rung.
+
+    hyperset: list [hyps, model_hyps]
+    rung: int
+    scheduler: SuccessiveHalving
+    """
+    hyps = {k:v for k,v in hyperset[0].items()}
+    hyps['n_epochs'] = scheduler.budgets[rung]
+    hyps['resume'] = rung > 0
+    hyps['rung'] = rung
+    return [hyps, {k:v for k,v in hyperset[1].items()}]
+
 def get_device(visible_devices, cuda_buffer=3000):
     info = get_cuda_info()
     for i,mem_dict in enumerate(info):
@@ -558,7 +882,22 @@ def get_device(visible_devices, cuda_buffer=3000):
     return -1
 
 def mp_hyper_search(hyps, hyp_ranges, keys, n_workers=4, visible_devices={0,1,2,3,4,5}, cuda_buffer=3000,
-                                                    ram_buffer=6000, early_stopping=10, stop_tolerance=.01):
+                                    ram_buffer=6000, early_stopping=10, stop_tolerance=.01, share_data=True,
+                                    asha=False, min_epochs=1, eta=3):
+    """
+    share_data: bool
+        if true, each distinct dataset is loaded once into shared memory and
+        the workers train on read-only views of it (see SharedDataStore)
+        rather than each loading its own copy
+    asha: bool
+        if true, the hypersets are searched with asynchronous successive
+        halving up to hyps['n_epochs'] on the validation accuracy (see
+        SuccessiveHalving) instead of each being trained to completion
+    min_epochs: int
+        the epochs of the lowest successive halving rung
+    eta: int
+        the successive halving reduction factor
+    """
     starttime = time.time()
     # Make results file
     if not os.path.exists(hyps['exp_name']):
@@ -579,6 +918,19 @@ def mp_hyper_search(hyps, hyp_ranges, keys, n_workers=4, visible_devices={0,1,2,
     hyper_q = fill_hyper_q(hyps, hyp_ranges, keys, hyper_q, idx=0)
     total_searches = hyper_q.qsize()
     print("n_searches:", total_searches)
+    store = None
+    scheduler = None
+    running = dict()
+    if share_data or asha:
+        hypersets = [hyper_q.get() for _ in range(total_searches)]
+        for hyperset in hypersets:
+            hyper_q.put(hyperset)
+    if share_data:
+        store = SharedDataStore(hypersets)
+    if asha:
+        scheduler = SuccessiveHalving(total_searches, hyps['n_epochs'], min_epochs=min_epochs, eta=eta)
+        print("Successive halving budgets:", scheduler.budgets)
+        configs = {hyperset[0]['save_folder']: i for i,hyperset in enumerate(hypersets)}
 
     n_workers = min(total_searches, n_workers) # No need to waste resources
     run_q = mp.Queue(n_workers)
@@ -595,33 +947,215 @@ def mp_hyper_search(hyps, hyp_ranges, keys, n_workers=4, visible_devices={0,1,2,
         
     result_count = 0
     print("Starting Hyperloop")
-    while result_count < total_searches:
-        print("Running Time:", time.time()-starttime)
-        device = get_device(visible_devices, cuda_buffer)
-        enough_ram = psutil.virtual_memory().free//1028**2 > ram_buffer
-        # must be careful not to threadlock here
-        if (not enough_ram or device <= -1) and hyper_q.qsize() >= total_searches:
-            print("RAM shortage or no devices available, sleeping for 20s")
-            time.sleep(20)
-        elif not hyper_q.empty() and not run_q.full():
-            hyperset = hyper_q.get()
-            hyperset.append(device)
-            print("Loading hyperset...")
-            run_q.put(hyperset)
-            time.sleep(5) # Timer to ensure ram measurements are completed appropriately
-            print("Loaded", hyperset[0]["exp_num"])
-        else:
-            print("Waiting...")
-            results = return_q.get()[0]
-            print("Collected", results['save_folder'])
-            with open(results_file,'a') as f:
-                results = " -- ".join([str(k)+":"+str(results[k]) for k in sorted(results.keys())])
-                f.write("\n"+results+"\n")
-            result_count += 1
-
-    for proc in procs:
-        proc.terminate()
-        proc.join(timeout=1.0)
+    try:
+        while (result_count < total_searches) if scheduler is None else not scheduler.finished():
+            print("Running Time:", time.time()-starttime)
+            device = get_device(visible_devices, cuda_buffer)
+            enough_ram = psutil.virtual_memory().free//1028**2 > ram_buffer
+            if scheduler is None:
+                idle = hyper_q.qsize() >= total_searches
+                has_job = not hyper_q.empty()
+            else:
+                idle = len(scheduler.running) == 0
+                has_job = scheduler.has_job()
+            # must be careful not to threadlock here
+            if (not enough_ram or device <= -1) and idle:
+                print("RAM shortage or no devices available, sleeping for 20s")
+                time.sleep(20)
+            elif has_job and not run_q.full():
+                if scheduler is None:
+                    hyperset = hyper_q.get()
+                else:
+                    config, rung = scheduler.next_job()
+                    hyperset = asha_hyperset(hypersets[config], rung, scheduler)
+                    print("Rung", rung, "--", scheduler.budgets[rung], "epochs")
+                running[hyperset[0]['save_folder']] = hyperset[0]
+                hyperset.append(device)
+                if store is not None:
+                    hyperset.append(False)
+                    hyperset.append(store.acquire(hyperset[0]))
+                print("Loading hyperset...")
+                run_q.put(hyperset)
+                time.sleep(5) # Timer to ensure ram measurements are completed appropriately
+                print("Loaded", hyperset[0]["exp_num"])
+            else:
+                print("Waiting...")
+                results = return_q.get()[0]
+                print("Collected", results['save_folder'])
+                run_hyps = running.pop(results['save_folder'])
+                # Any run may yet be promoted under successive halving, so its
+                # data are kept until the search ends
+                if store is not None and scheduler is None:
+                    store.release(run_hyps)
+                if scheduler is not None:
+                    stopped = results['Epochs'] < run_hyps['n_epochs']
+                    scheduler.report(configs[run_hyps['save_folder']], run_hyps['rung'], results['ValAcc'],
+                                                                                    stopped=stopped)
+                    results['Rung'] = run_hyps['rung']
+                with open(results_file,'a') as f:
+                    results = " -- ".join([str(k)+":"+str(results[k]) for k in sorted(results.keys())])
+                    f.write("\n"+results+"\n")
+                result_count += 1
+    finally:
+        for proc in procs:
+            proc.terminate()
+            proc.join(timeout=1.0)
+        if store is not None:
+            store.close()
+    if scheduler is not None:
+        best = sorted(scheduler.scores[-1].items(), key=lambda x: x[1], reverse=True)
+        with open(results_file,'a') as f:
+            f.write("\nSuccessive halving ranking of the final rung:\n")
+            for config, score in best:
+                f.write(hypersets[config][0]['save_folder'] + ": " + str(score) + "\n")
+
+def init_cpu_worker(core_q):
+    """
+    Pins a search worker to its own set of cores and matches its torch
+    threads to them.
+
+    core_q - multiprocessing Queue of lists of core ids
+    """
+    cores = core_q.get()
+    if hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, cores)
+    torch.set_num_threads(len(cores))
+
+def run_cpu_task(hyps, model_hyps, early_stopping=10, stop_tolerance=.01, shared_data=None):
+    """
+    Trains a single hyperset on the cpu and times it. shared_data is
+    argued to Trainer.train.
+
+    returns:
+        results - dict
+            the results of Trainer.train with the wall time in seconds and
+            the throughput in training samples per second
+    """
+    starttime = time.time()
+    trainer = Trainer(early_stopping=early_stopping, stop_tolerance=stop_tolerance)
+    results = trainer.train(hyps, model_hyps, "cpu", shared_data=shared_data)
+    results['WallTime'] = time.time()-starttime
+    results['Throughput'] = results['TrainSamples']/results['WallTime']
+    return results
+
+def cpu_hyper_search(hyps, hyp_ranges, keys, n_workers=None, n_threads=None, early_stopping=10,
+                                            stop_tolerance=.01, max_restarts=3, share_data=True):
+    """
+    Hyperparameter search for cpu only machines. Each worker process is pinned
+    to a disjoint set of n_threads cores and uses as many torch threads. A new
+    run is submitted whenever one finishes, so at most n_workers runs are
+    pending at a time and the shared data of a run is only loaded when it is
+    submitted.
+
+    Every finished run is appended to <exp_name>/search_log.jsonl along with its
+    wall time and throughput. Runs that finished without error are skipped when
+    the search is restarted with the same hyperparameters. If a worker dies, the
+    pool is restarted with the unfinished runs, up to max_restarts times.
+
+    hyps - dict
+        see fill_hyper_q
+    hyp_ranges - dict
+        see fill_hyper_q
+    keys - list of str
+        see fill_hyper_q
+    n_workers - int or None
+        number of concurrent runs. Defaults to the number of available cores
+        divided by n_threads, or to one per core if n_threads is also None
+    n_threads - int or None
+        cores (and torch threads) of each worker. Defaults to the available
+        cores divided by n_workers
+    share_data - bool
+        if true, each distinct dataset is loaded once into shared memory and
+        the workers train on read-only views of it (see SharedDataStore)
+    """
+    starttime = time.time()
+    # Make results file
+    if not os.path.exists(hyps['exp_name']):
+        os.mkdir(hyps['exp_name'])
+    results_file = hyps['exp_name']+"/results.txt"
+    with open(results_file,'a') as f:
+        f.write("Hyperparameters:\n")
+        for k in hyps.keys():
+            if k not in hyp_ranges:
+                f.write(str(k) + ": " + str(hyps[k]) + '\n')
+        f.write("\nHyperranges:\n")
+        for k in hyp_ranges.keys():
+            f.write(str(k) + ": [" + ",".join([str(v) for v in hyp_ranges[k]])+']\n')
+        f.write('\n')
+
+    hyper_q = fill_hyper_q(hyps, hyp_ranges, keys, Queue(), idx=0)
+    hypersets = [hyper_q.get() for _ in range(hyper_q.qsize())]
+    log_file = os.path.join(hyps['exp_name'], "search_log.jsonl")
+    finished = set()
+    if os.path.exists(log_file):
+        with open(log_file) as f:
+            logs = [json.loads(line) for line in f if line.strip()]
+        finished = {log['save_folder'] for log in logs if 'Error' not in log}
+    pending = [h for h in hypersets if h[0]['save_folder'] not in finished]
+    print("n_searches:", len(hypersets), "-- already finished:", len(hypersets)-len(pending))
+
+    if hasattr(os, 'sched_getaffinity'):
+        cores = sorted(os.sched_getaffinity(0))
+    else:
+        cores = list(range(os.cpu_count() or 1))
+    if n_workers is None:
+        n_workers = len(cores) if n_threads is None else max(1, len(cores)//n_threads)
+    n_workers = max(1, min(n_workers, len(pending)))
+    if n_threads is None:
+        n_threads = max(1, len(cores)//n_workers)
+    core_sets = [[cores[(i*n_threads+j)%len(cores)] for j in range(n_threads)] for i in range(n_workers)]
+    print("Workers:", n_workers, "-- Threads per worker:", n_threads)
+
+    store = SharedDataStore(pending) if share_data else None
+    ctx = mp.get_context('spawn')
+    restarts = 0
+    try:
+        while len(pending) > 0:
+            core_q = ctx.Queue()
+            for core_set in core_sets:
+                core_q.put(core_set)
+            done = set()
+            try:
+                with ProcessPoolExecutor(n_workers, mp_context=ctx, initializer=init_cpu_worker,
+                                                                initargs=(core_q,)) as executor:
+                    futures = dict()
+                    n_submitted = 0
+                    while n_submitted < len(pending) or len(futures) > 0:
+                        while n_submitted < len(pending) and len(futures) < n_workers:
+                            hyperset = pending[n_submitted]
+                            shared_data = None if store is None else store.acquire(hyperset[0])
+                            future = executor.submit(run_cpu_task, *hyperset, early_stopping, stop_tolerance,
+                                                                                            shared_data)
+                            futures[future] = n_submitted
+                            n_submitted += 1
+                        completed, _ = wait(futures, return_when=FIRST_COMPLETED)
+                        for future in completed:
+                            i = futures.pop(future)
+                            try:
+                                results = future.result()
+                            except BrokenProcessPool:
+                                raise
+                            except Exception as e:
+                                print("Caught error", e, "on", pending[i][0]['exp_num'])
+                                results = {"save_folder": pending[i][0]['save_folder'], "Error": str(e)}
+                            done.add(i)
+                            if store is not None:
+                                store.release(pending[i][0])
+                            with open(log_file,'a') as f:
+                                f.write(json.dumps(results, default=str)+"\n")
+                            with open(results_file,'a') as f:
+                                results = " -- ".join([str(k)+":"+str(results[k]) for k in sorted(results.keys())])
+                                f.write("\n"+results+"\n")
+                            print("Collected", pending[i][0]['save_folder'], "-- Running Time:", time.time()-starttime)
+            except BrokenProcessPool:
+                restarts += 1
+                if restarts > max_restarts:
+                    raise
+                print("A worker died, restarting the pool with", len(pending)-len(done), "unfinished runs")
+            pending = [h for i,h in enumerate(pending) if i not in done]
+    finally:
+        if store is not None:
+            store.close()
 
 def hyper_search(hyps, hyp_ranges, keys, device, early_stopping=10, stop_tolerance=.01):
     starttime = time.time()
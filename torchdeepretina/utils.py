@@ -123,11 +123,181 @@ def get_hook(layer_dict, key, to_numpy=True, to_cpu=False):
             layer_dict[key] = out
     return hook
 
+def open_output(shape, save_path=None, dtype=np.float32):
+    """
+    Allocates a zeroed output array. If save_path is not None, the array is a
+    memory mapped .npy file so that outputs larger than memory can be filled
+    chunk by chunk. It can be reopened with np.load(save_path, mmap_mode='r').
+    """
+    if save_path is None:
+        return np.zeros(shape, dtype=dtype)
+    # New memmap files are zero filled
+    return np.lib.format.open_memmap(save_path, mode='w+', dtype=dtype, shape=tuple(shape))
+
+class ActivationRecorder:
+    """
+    Records layer activations over many forward calls. Activations are copied
+    in place into a preallocated buffer on the device of the layer, and each
+    full buffer is transferred to the host in a single copy. The host arrays
+    are preallocated as well, either in memory or as memory mapped .npy files
+    so that long simulations do not need to fit in RAM.
+
+    Usage:
+        recorder = ActivationRecorder(model, ['sequential.2'], n_samples=len(X))
+        with torch.no_grad():
+            for x in ...:
+                recorder.record('outputs', model(x))
+        layer_outs = recorder.close()
+    """
+    def __init__(self, model, insp_keys, n_samples, chunk_size=1000, dtype=None, decimate=1,
+                                                                                save_dir=None):
+        """
+        model - torch Module
+        insp_keys - collection of str
+            names of the modules whose outputs are recorded. "all" records every
+            module of model.sequential
+        n_samples - int
+            the number of samples that will be recorded for each key, before decimation
+        chunk_size - int
+            number of samples held on the device before they are transferred to the host
+        dtype - numpy dtype or None
+            dtype the activations are stored as (i.e. np.float16). If None,
+            the dtype of the activations is kept
+        decimate - int
+            only every decimate-th sample of each key is kept
+        save_dir - str or None
+            if not None, the activations are written to <save_dir>/<key>.npy
+        """
+        self.n_samples = n_samples
+        self.chunk_size = chunk_size
+        self.dtype = dtype
+        self.decimate = decimate
+        self.save_dir = save_dir
+        if save_dir is not None:
+            os.makedirs(save_dir, exist_ok=True)
+        self.buffers = dict()
+        self.arrays = dict()
+        self.counts = dict()
+        self.fills = dict()
+        self.written = dict()
+        self.handles = []
+        if "all" in insp_keys:
+            modules = [("sequential."+str(i), mod) for i,mod in enumerate(model.sequential)]
+        else:
+            modules = [(k,mod) for k,mod in model.named_modules() if k in insp_keys]
+        for key, mod in modules:
+            self.handles.append(mod.register_forward_hook(self.get_hook(key)))
+
+    def get_hook(self, key):
+        def hook(module, inp, out):
+            if torch.is_tensor(out):
+                self.record(key, out)
+        return hook
+
+    def allocate(self, key, out):
+        if self.dtype is None:
+            torch_dtype = out.dtype
+            np_dtype = torch.empty(0, dtype=out.dtype).numpy().dtype
+        else:
+            np_dtype = np.dtype(self.dtype)
+            torch_dtype = torch.from_numpy(np.empty(0, dtype=np_dtype)).dtype
+        self.buffers[key] = torch.empty(self.chunk_size, *out.shape[1:], dtype=torch_dtype,
+                                                                        device=out.device)
+        n_kept = int(np.ceil(self.n_samples/self.decimate))
+        save_path = None
+        if self.save_dir is not None:
+            save_path = os.path.join(self.save_dir, key+".npy")
+        self.arrays[key] = open_output((n_kept, *out.shape[1:]), save_path, np_dtype)
+        self.fills[key] = 0
+        self.written[key] = 0
+
+    def record(self, key, out):
+        """
+        Appends a batch of activations along the first dimension.
+
+        key - str
+        out - torch tensor (B, ...)
+        """
+        out = out.detach()
+        start = self.counts.get(key, 0)
+        self.counts[key] = start + len(out)
+        if self.decimate > 1:
+            # Keeps the samples whose overall index is a multiple of decimate
+            out = out[(-start) % self.decimate::self.decimate]
+        if key not in self.buffers:
+            self.allocate(key, out)
+        buf = self.buffers[key]
+        while len(out) > 0:
+            fill = self.fills[key]
+            n = min(len(out), self.chunk_size-fill)
+            buf[fill:fill+n].copy_(out[:n])
+            self.fills[key] = fill+n
+            out = out[n:]
+            if self.fills[key] == self.chunk_size:
+                self.flush(key)
+
+    def flush(self, key):
+        """
+        Transfers the buffered activations of key to the host array.
+        """
+        fill = self.fills[key]
+        if fill == 0:
+            return
+        written = self.written[key]
+        self.arrays[key][written:written+fill] = self.buffers[key][:fill].cpu().numpy()
+        self.written[key] = written+fill
+        self.fills[key] = 0
+
+    def remove_hooks(self):
+        for handle in self.handles:
+            handle.remove()
+        self.handles = []
+
+    def close(self):
+        """
+        Flushes all buffers, removes the hooks and frees the device buffers.
+
+        returns:
+            layer_outs - dict of ndarrays or np.memmaps
+                the recorded samples of each key
+        """
+        self.remove_hooks()
+        layer_outs = dict()
+        for key in list(self.buffers.keys()):
+            self.flush(key)
+            arr = self.arrays[key]
+            if isinstance(arr, np.memmap):
+                arr.flush()
+            layer_outs[key] = arr[:self.written[key]]
+        self.buffers = dict()
+        return layer_outs
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.remove_hooks()
+
+def alpha_path(x, alphas):
+    """
+    Scales x by each alpha and folds the alphas into the batch dimension.
+
+    x - FloatTensor (B, ...)
+    alphas - FloatTensor (A,)
+
+    returns FloatTensor (A*B, ...) ordered alpha major
+    """
+    scaled = alphas.reshape(-1, *[1]*x.dim()).to(x.device)*x[None]
+    return scaled.reshape(-1, *x.shape[1:])
+
 def integrated_gradient(model, X, layer='sequential.2', gc_idx=None, alpha_steps=5,
                                                     batch_size=500, y=None, lossfxn=None,
-                                                    to_numpy=False, verbose=False):
+                                                    to_numpy=False, verbose=False,
+                                                    device=None, save_path=None):
     """
     Returns the integrated gradient for a particular stimulus at the arged layer.
+    All alpha steps of a batch are computed in a single forward and backward pass
+    and the activations of the all zero baseline are computed only once.
     Inputs:
         model: PyTorch Deep Retina models
         X: Input stimuli ndarray or torch FloatTensor (T,D,H,W)
@@ -135,215 +305,234 @@ def integrated_gradient(model, X, layer='sequential.2', gc_idx=None, alpha_steps
         gc_idx: ganglion cell of interest
             if None, uses all cells
         alpha_steps: int, integration steps
-        batch_size: step size when performing computations on GPU
+        batch_size: number of samples in each forward pass, counting every
+            alpha step of a stimulus sample
         y: torch FloatTensor or ndarray (T,N)
             if None, ignored
         lossfxn: some differentiable function
             if None, ignored
+        device: torch device. defaults to the device of the model
+        save_path: str or None. if not None, the integrated gradients are
+            written to a memory mapped .npy file at this path and returned
+            as a numpy memmap
     Outputs:
         intg_grad: Integrated Gradients ndarray or FloatTensor (T, C, H1, W1)
         gc_activs: Activation of the final layer ndarray or FloatTensor (T,N)
     """
+    if device is None:
+        device = next(model.parameters()).device
+    if gc_idx is None:
+        gc_idx = list(range(model.n_units))
+    assert alpha_steps > 1, "alpha_steps must be at least 2"
+    alphas = torch.linspace(0,1,alpha_steps)[1:].to(device)
+    n_alphas = len(alphas)
+    if batch_size is None:
+        batch_size = len(X)*n_alphas
+    chunk_size = max(1, batch_size//n_alphas)
+
     # Handle Gradient Settings
+    grad_states = [p.requires_grad for p in model.parameters()]
     requires_grad(model, False) # Model gradient unnecessary for integrated gradient
     prev_grad_state = torch.is_grad_enabled() # Save current grad calculation state
     torch.set_grad_enabled(True) # Enable grad calculations
+    training = model.training
+    model.eval()
 
-    layer_idx = 0
-    for i,seq in enumerate(model.sequential):
-        if layer == "sequential."+str(i):
-            break
-        if isinstance(seq, nn.ReLU):
-            layer_idx += 1
-    intg_grad = torch.zeros(len(X), model.chans[layer_idx], *model.shapes[layer_idx])
-    gc_activs = None
-    model.to(DEVICE)
-    if gc_idx is None:
-        gc_idx = list(range(model.n_units))
-    if batch_size is None:
-        batch_size = len(X)
-    X = torch.FloatTensor(X)
-    X.requires_grad = True
-    idxs = torch.arange(len(X)).long()
-    for batch in range(0, len(X), batch_size):
-        prev_response = None
-        linspace = torch.linspace(0,1,alpha_steps)
+    hook_outs = dict()
+    module = dict(model.named_modules())[layer]
+    hook_handle = module.register_forward_hook(get_hook(hook_outs, key=layer, to_numpy=False))
+    try:
+        with torch.no_grad():
+            base_out = model(torch.zeros(1, *X.shape[1:], device=device))[:,gc_idx]
+        base_act = hook_outs[layer].detach()
+        intg_grad = open_output((len(X), *base_act.shape[1:]), save_path)
+        gc_activs = torch.zeros(len(X), *base_out.shape[1:])
+
+        rng = range(0, len(X), chunk_size)
         if verbose:
-            print("Calculating for batch {}/{}".format(batch, len(X)))
-            linspace = tqdm(linspace)
-        idx = idxs[batch:batch+batch_size]
-        for alpha in linspace:
-            x = alpha*X[idx]
-            # Response is dict of activations. response[layer] has shape intg_grad.shape
-            response = inspect(model, x, insp_keys=[layer], batch_size=None,
-                                                    to_numpy=False, to_cpu=False,
-                                                    verbose=False)
-            if prev_response is not None:
-                ins = response[layer]
-                outs = response['outputs'][:,gc_idx]
-                if lossfxn is not None and y is not None:
-                    truth = y[idx,gc_idx]
-                    outs = lossfxn(outs,truth)
-                grad = torch.autograd.grad(outs.sum(), ins)[0]
-                grad = grad.detach().cpu().reshape(len(grad), *intg_grad.shape[1:])
-                act = (response[layer].data.cpu()-prev_response[layer]).reshape(grad.shape)
-                intg_grad[idx] += grad*act
-                if alpha == 1:
-                    if gc_activs is None:
-                        if isinstance(gc_idx, int):
-                            gc_activs = torch.zeros(len(X))
-                        else:
-                            gc_activs = torch.zeros(len(X), len(gc_idx))
-                    gc_activs[idx] = response['outputs'][:,gc_idx].detach().cpu()
-            prev_response = {k:v.data.cpu() for k,v in response.items()}
-    del response
-    del grad
+            rng = tqdm(rng)
+        for i in rng:
+            x = torch.as_tensor(X[i:i+chunk_size]).detach().float().to(device)
+            # The input requires grad so that the layer activations are part of the graph
+            outs = model(alpha_path(x, alphas).requires_grad_(True))[:,gc_idx]
+            acts = hook_outs[layer]
+            outs = outs.reshape(n_alphas, len(x), *outs.shape[1:])
+            activs = outs[-1].detach().cpu()
+            if lossfxn is not None and y is not None:
+                truth = torch.as_tensor(y[i:i+chunk_size])[:,gc_idx].float().to(device)
+                # The loss is applied to each alpha step separately
+                outs = torch.stack([lossfxn(out,truth).sum() for out in outs])
+            grad = torch.autograd.grad(outs.sum(), acts)[0]
+            grad = grad.reshape(n_alphas, len(x), *base_act.shape[1:])
+            acts = acts.detach().reshape(grad.shape)
+            prev_acts = torch.cat([base_act.expand(1, len(x), *base_act.shape[1:]), acts[:-1]], dim=0)
+            intg_grad[i:i+len(x)] = (grad*(acts-prev_acts)).sum(0).cpu().numpy()
+            gc_activs[i:i+len(x)] = activs
+    finally:
+        hook_handle.remove()
+        # Return to previous gradient calculation state
+        for p, state in zip(model.parameters(), grad_states):
+            p.requires_grad = state
+        torch.set_grad_enabled(prev_grad_state) # return to previous grad calculation state
+        model.train(training)
+
     if len(gc_activs.shape) == 1:
         gc_activs = gc_activs.unsqueeze(1) # Create new axis
-
-    # Return to previous gradient calculation state
-    requires_grad(model, True)
-    torch.set_grad_enabled(prev_grad_state) # return to previous grad calculation state
+    if save_path is not None:
+        intg_grad.flush()
+        return intg_grad, gc_activs.numpy()
     if to_numpy:
-        return intg_grad.data.cpu().numpy(), gc_activs.data.cpu().numpy()
-    return intg_grad, gc_activs
+        return intg_grad, gc_activs.numpy()
+    return torch.from_numpy(intg_grad), gc_activs
+
+def stimulus_importance(model, X, gc_idx=None, alpha_steps=5, batch_size=500,
+                        to_numpy=False, verbose=False, device=None, save_path=None):
+    """
+    Returns the integrated gradient of the summed activity of the argued ganglion
+    cells with respect to the stimulus, using the all zero stimulus as the baseline.
+    All alpha steps of a batch are computed in a single forward and backward pass
+    and the gradient at the baseline is computed only once.
+
+    model - torch Module
+    X - ndarray or FloatTensor (T,D,H,W)
+    gc_idx - int or list of ints or None
+        if None, uses all cells
+    alpha_steps - int
+        integration steps
+    batch_size - int
+        number of samples in each forward pass, counting every alpha step of a
+        stimulus sample
+    device - torch device or None
+        defaults to the device of the model
+    save_path - str or None
+        if not None, the output is written to a memory mapped .npy file at this
+        path and returned as a numpy memmap
+
+    returns:
+        intg_grad - ndarray or FloatTensor (T,D,H,W)
+    """
+    if device is None:
+        device = next(model.parameters()).device
+    if gc_idx is None:
+        gc_idx = list(range(model.n_units))
+    alphas = torch.linspace(0,1,alpha_steps)[1:].to(device)
+    n_alphas = max(len(alphas), 1)
+    if batch_size is None:
+        batch_size = len(X)*n_alphas
+    chunk_size = max(1, batch_size//n_alphas)
 
-def stimulus_importance(model, X, gc_idx=None, alpha_steps=5, batch_size=500, 
-                        to_numpy=False, verbose=False, device=torch.device('cuda:1')):
     # Handle Gradient Settings
+    grad_states = [p.requires_grad for p in model.parameters()]
     requires_grad(model, False) # Model gradient unnecessary for integrated gradient
     prev_grad_state = torch.is_grad_enabled() # Save current grad calculation state
     torch.set_grad_enabled(True) # Enable grad calculations
+    training = model.training
+    model.eval()
+    try:
+        base = torch.zeros(1, *X.shape[1:], device=device, requires_grad=True)
+        base_grad = torch.autograd.grad(model(base)[:,gc_idx].sum(), base)[0]
+        intg_grad = open_output((len(X), *X.shape[1:]), save_path)
 
-    intg_grad = torch.zeros(len(X), *model.image_shape)
-    if gc_idx is None:
-        gc_idx = list(range(model.n_units))
-    if batch_size is None:
-        batch_size = len(X)
-    X = torch.FloatTensor(X)
-    X.requires_grad = True
-    idxs = torch.arange(len(X)).long()
-    for batch in range(0, len(X), batch_size):
-        linspace = torch.linspace(0,1,alpha_steps)
+        rng = range(0, len(X), chunk_size)
         if verbose:
-            print("Calculating for batch {}/{}".format(batch, len(X)))
-            linspace = tqdm(linspace)
-        idx = idxs[batch:batch+batch_size]
-        for alpha in linspace:
-            x = alpha*X[idx]
-            response = inspect(model, x, insp_keys=[], batch_size=None, to_numpy=False, device=device)
-            outs = response['outputs'][:,gc_idx]
-            grad = torch.autograd.grad(outs.sum(), x)[0]
-            grad = grad.detach().cpu().reshape(len(grad), *intg_grad.shape[1:])
-            act = X[idx].detach().cpu()
-            intg_grad[idx] += grad*act
-    del response
-    del grad
-
-    requires_grad(model, True)
-    torch.set_grad_enabled(prev_grad_state) # return to previous grad calculation state
+            rng = tqdm(rng)
+        for i in rng:
+            x = torch.as_tensor(X[i:i+chunk_size]).detach().float().to(device)
+            grad = base_grad
+            if len(alphas) > 0:
+                xs = alpha_path(x, alphas).requires_grad_(True)
+                grads = torch.autograd.grad(model(xs)[:,gc_idx].sum(), xs)[0]
+                grad = grad + grads.reshape(len(alphas), *x.shape).sum(0)
+            intg_grad[i:i+len(x)] = (grad*x).cpu().numpy()
+    finally:
+        for p, state in zip(model.parameters(), grad_states):
+            p.requires_grad = state
+        torch.set_grad_enabled(prev_grad_state) # return to previous grad calculation state
+        model.train(training)
+
+    if save_path is not None:
+        intg_grad.flush()
+        return intg_grad
     if to_numpy:
-        return intg_grad.data.cpu().numpy()
-    return intg_grad
+        return intg_grad
+    return torch.from_numpy(intg_grad)
 
-def inspect(model, X, insp_keys=[]):
-    
-    layer_outs = dict()
-    handles = []
-    for key, mod in model.named_modules():
-        if key in insp_keys:
-            hook = get_hook(layer_outs, key, to_numpy=True)
-            handle = mod.register_forward_hook(hook)
-            handles.append(handle)
-
-    resps = []
-    layer_outs_list = {key:[] for key in insp_keys}
-    with torch.no_grad():
-        for i in range(X.shape[0]):
-            resp = model(X[i:i+1])
-            resps.append(resp)
-            for k in layer_outs.keys():
-                layer_outs_list[k].append(layer_outs[k])
-    
-    layer_outs = {k:np.concatenate(v, axis=0) if isinstance(v[0], np.ndarray) else v for k,v in layer_outs_list.items()}
-    resp = torch.cat(resps, dim=0)
-    layer_outs['outputs'] = resp.detach().cpu().numpy()
-    
-    for i in range(len(handles)):
-        handles[i].remove()
-    del handles
-    
+def inspect(model, X, insp_keys=[], batch_size=500, to_numpy=True, device=None, save_dir=None,
+                                                                    dtype=None, decimate=1):
+    """
+    Get the response from the argued layers in the model. See ActivationRecorder
+    for the save_dir, dtype and decimate arguments.
+
+    model - torch Module
+    X - ndarray or FloatTensor (T,C,H,W)
+    insp_keys - collection of str
+        names of the layers to record. "all" records every module of model.sequential
+    batch_size - int or None
+        if None, the whole stimulus is run as a single batch
+    to_numpy - bool
+        if false, the activations are returned as torch cpu tensors. Ignored
+        if save_dir is argued
+    device - torch device or None
+        defaults to the device of the model
+
+    returns dict of ndarrays (or memmaps) or torch cpu tensors
+    """
+    if device is None:
+        device = next(model.parameters()).device
+    if batch_size is None:
+        batch_size = len(X)
+    recorder = ActivationRecorder(model, insp_keys, len(X), dtype=dtype, decimate=decimate,
+                                                                        save_dir=save_dir)
+    with recorder, torch.no_grad():
+        for i in range(0, len(X), batch_size):
+            x = torch.as_tensor(X[i:i+batch_size]).float().to(device)
+            recorder.record('outputs', model(x))
+    layer_outs = recorder.close()
+    if not to_numpy and save_dir is None:
+        layer_outs = {k:torch.from_numpy(v) for k,v in layer_outs.items()}
     return layer_outs
 
-def inspect_rnn(model, X, hs, insp_keys=[]):
+def inspect_rnn(model, X, hs, insp_keys=[], save_dir=None, dtype=None, decimate=1):
+    """
+    Runs X through a recurrent model one sample at a time and records the
+    response of the argued layers. See ActivationRecorder for the save_dir,
+    dtype and decimate arguments.
 
-    layer_outs = dict()
-    handles = []
-    for key, mod in model.named_modules():
-        if key in insp_keys:
-            hook = get_hook(layer_outs, key, to_numpy=True)
-            handle = mod.register_forward_hook(hook)
-            handles.append(handle)
+    model - torch Module
+    X - FloatTensor (T,C,H,W)
+    hs - the initial hidden state with a batch size of 1
+    insp_keys - collection of str
 
-    resps = []
-    layer_outs_list = {key:[] for key in insp_keys}
-    with torch.no_grad():
+    returns dict of ndarrays or memmaps
+    """
+    recorder = ActivationRecorder(model, insp_keys, len(X), dtype=dtype, decimate=decimate,
+                                                                        save_dir=save_dir)
+    with recorder, torch.no_grad():
         for i in range(X.shape[0]):
             resp, hs = model(X[i:i+1], hs)
-            resps.append(resp)
-            for k in layer_outs.keys():
-                layer_outs_list[k].append(layer_outs[k])
-    
-    layer_outs = {k:np.concatenate(v, axis=0) if isinstance(v[0], np.ndarray) else v for k,v in layer_outs_list.items()}
-    resp = torch.cat(resps, dim=0)
-    layer_outs['outputs'] = resp.detach().cpu().numpy()
-    
-    for i in range(len(handles)):
-        handles[i].remove()
-    del handles
-    
-    return layer_outs
+            recorder.record('outputs', resp)
+    return recorder.close()
 
 def inspect_grad_rnn(model, X, hs, cell_idx, layer='ganglion'):
-    device = next(model.parameters()).get_device()
-    hook_outs = dict()
-    module = None
-    for name, modu in model.named_modules():
-        if name == layer:
-            module = modu
-            hook = get_hook(hook_outs,key=layer,to_numpy=False)
-            hook_handle = module.register_forward_hook(hook)
-
-    # Get gradient with respect to activations
-    model.eval()
-    X.requires_grad = True
-    n_loops = X.shape[0]
-    rng = range(n_loops)
-    responses = []
-    for i in rng:
-        x = X[i:i+1]
-        x = x.to(device)
-        _, hs = model(x, hs)
-        hs = detach_hs(hs, 'single', None)
-        # Outs are the activations at the argued layer and cell idx accross the batch
-        if type(cell_idx) == type(int()):
-            fx = hook_outs[layer][:,cell_idx]
-        elif len(cell_idx) == 1:
-            fx = hook_outs[layer][:,cell_idx[0]]
-        else:
-            fx = hook_outs[layer][:, cell_idx[0], cell_idx[1], cell_idx[2]]
-        fx = fx.mean()
-        fx.backward()
-        responses.append(fx.data.cpu().numpy())
-    hook_handle.remove()
-    responses = np.array(responses)
-    return X.grad.data.cpu().numpy(), responses
+    """
+    Computes the gradient of a unit's activity at each time point with respect to
+    the stimulus window at that time point, holding the hidden state fixed.
+
+    returns:
+        grads - ndarray (T, D, H, W)
+        responses - ndarray (T,)
+    """
+    jacs, outs = stim_jacobian(model, X, layer, [cell_idx], hs=hs, verbose=False)
+    return jacs[0], outs[:,0]
 
 def batch_compute_model_response(stimulus, model, batch_size=500, recurrent=False, 
-                                insp_keys={'all'}, cust_h_init=False, verbose=False):
+                                insp_keys={'all'}, cust_h_init=False, verbose=False,
+                                device=None, transfer_size=5000):
     '''
-    Computes a model response in batches in pytorch. Returns a dict of lists 
-    where each list is the sequence of batch responses.     
+    Computes a model response in batches in pytorch. Returns a dict of ndarrays
+    with the responses of the inspected layers concatenated over the stimulus.
+    Activations are kept on the device and transferred to the host in chunks
+    of transfer_size samples.
     Args:
         stimulus: 3-d checkerboard stimulus in (time, space, space)
         model: the model
@@ -351,141 +540,219 @@ def batch_compute_model_response(stimulus, model, batch_size=500, recurrent=Fals
         recurrent: bool
             use recurrent approach to calculating model response
         insp_keys: set (or dict) with keys of layers to be inspected in Physio
+        device: torch device. defaults to the device of the model
+        transfer_size: int, number of samples gathered before each transfer
     '''
-    phys = Physio(model)
-    model_response = None
+    if device is None:
+        device = next(model.parameters()).device
+    phys = Physio(model, to_numpy=False)
     batch_size = 1 if recurrent else batch_size
     n_loops, leftover = divmod(stimulus.shape[0], batch_size)
     hs = None
     if recurrent:
-        hs = [torch.zeros(1, *h_shape).to(DEVICE) for h_shape in model.h_shapes]
+        hs = [torch.zeros(1, *h_shape).to(device) for h_shape in model.h_shapes]
         if cust_h_init:
             hs[0][:,0] = 1
+
+    responses = dict()
+    pending = dict()
+    def transfer():
+        for k,v in pending.items():
+            responses.setdefault(k, []).append(torch.cat(v, dim=0).cpu().numpy())
+        pending.clear()
+
     with torch.no_grad():
-        responses = []
         rng = range(n_loops)
         if verbose:
             rng = tqdm(rng)
+        n_pending = 0
         for i in rng:
             stim = torch.FloatTensor(stimulus[i*batch_size:(i+1)*batch_size])
-            outs = phys.inspect(stim.to(DEVICE), hs=hs, insp_keys=insp_keys)
+            outs = phys.inspect(stim.to(device), hs=hs, insp_keys=insp_keys)
             if type(outs) == type(tuple()):
-                outs, hs = outs[0].copy(), outs[1]
-            else:
-                outs = outs.copy()
-            for k in outs.keys():
-                if type(outs[k]) != type(np.array([])):
-                    outs[k] = outs[k].detach().cpu().numpy()
-            responses.append(outs)
+                outs, hs = outs
+            for k,v in outs.items():
+                pending.setdefault(k, []).append(v)
+            n_pending += len(stim)
+            if n_pending >= transfer_size:
+                transfer()
+                n_pending = 0
+        # Get the last few samples
         if leftover > 0 and hs is None:
             stim = torch.FloatTensor(stimulus[-leftover:])
-            outs = phys.inspect(stim.to(DEVICE), hs=hs, insp_keys=insp_keys).copy()
-            for k in outs.keys():
-                if type(outs[k]) != type(np.array([])):
-                    outs[k] = outs[k].detach().cpu().numpy()
-            responses.append(outs)
-        model_response = {}
-        for key in responses[0].keys():
-             model_response[key] = np.concatenate([x[key] for x in responses], axis=0)
-        del outs
-
-    # Get the last few samples
+            outs = phys.inspect(stim.to(device), hs=hs, insp_keys=insp_keys)
+            for k,v in outs.items():
+                pending.setdefault(k, []).append(v)
+        transfer()
+        model_response = {k:np.concatenate(v, axis=0) for k,v in responses.items()}
+
     phys.remove_hooks()
     phys.remove_refs()
     del phys
     return model_response
 
-def get_stim_grad_rnn(model, X, layer, cell_idx, batch_size=1, layer_shape=None, verbose=True, I20=None):
+def unit_output(outs, cell_idx):
     """
-    Gets the gradient of the model output at the specified layer and cell idx with respect
-    to the inputs (X). Returns a gradient array with the same shape as X.
+    Selects the activity of a single unit from a layer output across the batch.
+
+    outs - torch FloatTensor (B, C) or (B, C, H, W)
+    cell_idx - int or sequence of ints
+        the channel index or the (chan, row, col) index of the unit
     """
-    if verbose:
-        print("layer:", layer)
-    requires_grad(model, False)
-    device = next(model.parameters()).get_device()
+    if type(cell_idx) == type(int()):
+        return outs[:,cell_idx]
+    elif len(cell_idx) == 1:
+        return outs[:,cell_idx[0]]
+    return outs[:, cell_idx[0], cell_idx[1], cell_idx[2]]
+
+def clone_hs(hs):
+    """
+    Copies a hidden state without its gradient history.
+
+    hs - FloatTensor, RingBuffer or list/tuple of them
+    """
+    if isinstance(hs, (list, tuple)):
+        return type(hs)(clone_hs(h) for h in hs)
+    if hasattr(hs, 'idx'):
+        return type(hs)(hs.data.detach().clone(), hs.idx)
+    return hs.detach().clone()
+
+def cat_hs(hs_list):
+    """
+    Concatenates hidden states along the batch dimension. Ring buffers are
+    put into chronological order so that all entries share the same index.
+
+    hs_list - list of FloatTensors, RingBuffers or lists/tuples of them
+    """
+    hs = hs_list[0]
+    if isinstance(hs, (list, tuple)):
+        return type(hs)(cat_hs([h[i] for h in hs_list]) for i in range(len(hs)))
+    if hasattr(hs, 'idx'):
+        return type(hs)(torch.cat([h.ordered() for h in hs_list], dim=0))
+    return torch.cat(hs_list, dim=0)
+
+def stim_jacobian_chunks(model, X, layer=None, cell_idxs=None, hs=None, chunk_size=100, device=None):
+    """
+    Lazily computes instantaneous receptive fields, the gradients of the activity
+    of each unit at each time point with respect to the stimulus window at that
+    time point. All units and time points of a chunk are differentiated in a
+    single vectorized call (torch.func.vmap over torch.func.vjp), so memory is
+    bounded by the chunk size.
+
+    Recurrent models are first stepped through each chunk without gradients to
+    record the hidden state before every time point. The hidden states are then
+    held fixed, so each gradient only reaches the current window, and the time
+    points of the chunk are differentiated as one batch.
 
-    hs = get_hs(model, batch_size, device, I20)
+    model - torch Module
+    X - ndarray or FloatTensor (T, D, H, W)
+        the stimulus in rolling window form. Recurrent models treat it as one sequence
+    layer - str or None
+        name of the module whose output is differentiated. The model output if None
+    cell_idxs - sequence or None
+        the units of the layer output. Each is a channel index or a (chan,) or
+        (chan, row, col) index (see unit_output). If None, every element of the
+        flattened layer output is a unit
+    hs - hidden state with batch size 1 or None
+        the hidden state of recurrent models before the first time point. If None,
+        retinal_phenomena.init_hs is used
+    chunk_size - int
+        number of time points differentiated at a time
+    device - torch device or None
+        defaults to the device of the model
+
+    yields:
+        jacs - FloatTensor (U, chunk_size, D, H, W)
+        outs - FloatTensor (chunk_size, U)
+            the activities of the units
+    """
+    from torch.func import vjp, vmap
+    if device is None:
+        device = next(model.parameters()).device
+    recurrent = getattr(model, 'recurrent', hasattr(model, 'h_shapes'))
+    if recurrent and hs is None:
+        from torchdeepretina.retinal_phenomena import init_hs
+        hs = init_hs(model, device)
 
     hook_outs = dict()
-    module = None
-    for name, modu in model.named_modules():
-        if name == layer:
-            if verbose:
-                print("hook attached to " + name)
-            module = modu
-            hook = get_hook(hook_outs,key=layer,to_numpy=False)
-            hook_handle = module.register_forward_hook(hook)
-
-    # Get gradient with respect to activations
+    if layer is not None:
+        module = dict(model.named_modules())[layer]
+        hook_handle = module.register_forward_hook(get_hook(hook_outs, key=layer, to_numpy=False))
+
+    def units(x, hs_batch):
+        outs = model(x, hs_batch)[0] if recurrent else model(x)
+        if layer is not None:
+            outs = hook_outs[layer]
+        if cell_idxs is None:
+            return outs.reshape(len(outs), -1)
+        return torch.stack([unit_output(outs, idx) for idx in cell_idxs], dim=1)
+
+    grad_states = [p.requires_grad for p in model.parameters()]
+    training = model.training
+    requires_grad(model, False)
     model.eval()
-    X.requires_grad = True
-    n_loops = X.shape[0]//batch_size
-    rng = range(n_loops)
+    try:
+        for i in range(0, len(X), chunk_size):
+            x = torch.as_tensor(X[i:i+chunk_size]).detach().float().to(device)
+            hs_batch = None
+            if recurrent:
+                states = []
+                with torch.no_grad():
+                    for xt in x:
+                        states.append(clone_hs(hs))
+                        _, hs = model(xt[None], hs)
+                hs_batch = cat_hs(states)
+            outs, vjp_fn = vjp(lambda x: units(x, hs_batch), x)
+            # One cotangent per unit, broadcast over the time points
+            cotangents = torch.eye(outs.shape[1], device=device)[:,None].expand(-1, *outs.shape)
+            jacs, = vmap(vjp_fn)(cotangents)
+            yield jacs.detach(), outs.detach()
+    finally:
+        if layer is not None:
+            hook_handle.remove()
+        for p, state in zip(model.parameters(), grad_states):
+            p.requires_grad = state
+        model.train(training)
+
+def stim_jacobian(model, X, layer=None, cell_idxs=None, hs=None, chunk_size=100, device=None,
+                                                                                verbose=False):
+    """
+    Collects the output of stim_jacobian_chunks into numpy arrays. See
+    stim_jacobian_chunks for the arguments.
+
+    returns:
+        jacs - ndarray (U, T, D, H, W)
+        outs - ndarray (T, U)
+    """
+    chunks = stim_jacobian_chunks(model, X, layer, cell_idxs, hs, chunk_size, device)
     if verbose:
-        rng = tqdm(rng)
-    for i in rng:
-        idx = i*batch_size
-        x = X[idx:idx+batch_size]
-        x = x.to(device)
-        _, hs = model(x, hs)
-        hs = detach_hs(hs, 'single', None)
-        # Outs are the activations at the argued layer and cell idx accross the batch
-        if type(cell_idx) == type(int()):
-            fx = hook_outs[layer][:,cell_idx]
-        elif len(cell_idx) == 1:
-            fx = hook_outs[layer][:,cell_idx[0]]
-        else:
-            fx = hook_outs[layer][:, cell_idx[0], cell_idx[1], cell_idx[2]]
-        fx = fx.mean()
-        fx.backward()
-    hook_handle.remove()
-    requires_grad(model, True)
-    return X.grad.data.cpu().numpy()
+        chunks = tqdm(chunks, total=int(np.ceil(len(X)/chunk_size)))
+    jacs, outs = zip(*[(j.cpu().numpy(), o.cpu().numpy()) for j,o in chunks])
+    return np.concatenate(jacs, axis=1), np.concatenate(outs, axis=0)
 
-def get_stim_grad(model, X, layer, cell_idx, batch_size=500, layer_shape=None, verbose=True):
+def get_stim_grad_rnn(model, X, layer, cell_idx, batch_size=100, layer_shape=None, verbose=True, I20=None):
     """
     Gets the gradient of the model output at the specified layer and cell idx with respect
-    to the inputs (X). Returns a gradient array with the same shape as X.
+    to the inputs (X). Returns a gradient array with the same shape as X. X is run as
+    a single sequence and the hidden state is held fixed for each gradient. batch_size
+    time points are differentiated at a time (the chunk_size of stim_jacobian_chunks).
     """
+    from torchdeepretina.retinal_phenomena import init_hs
     if verbose:
         print("layer:", layer)
-    requires_grad(model, False)
-    device = next(model.parameters()).get_device()
+    hs = init_hs(model, next(model.parameters()).device, I20)
+    jacs, _ = stim_jacobian(model, X, layer, [cell_idx], hs=hs, chunk_size=batch_size, verbose=verbose)
+    return jacs[0]
 
-    hook_outs = dict()
-    module = None
-    for name, modu in model.named_modules():
-        if name == layer:
-            if verbose:
-                print("hook attached to " + name)
-            module = modu
-            hook = get_hook(hook_outs,key=layer,to_numpy=False)
-            hook_handle = module.register_forward_hook(hook)
-
-    # Get gradient with respect to activations
-    model.eval()
-    X.requires_grad = True
-    n_loops = X.shape[0]//batch_size
-    rng = range(n_loops)
+def get_stim_grad(model, X, layer, cell_idx, batch_size=500, layer_shape=None, verbose=True):
+    """
+    Gets the gradient of the model output at the specified layer and cell idx with respect
+    to the inputs (X). Returns a gradient array with the same shape as X.
+    """
     if verbose:
-        rng = tqdm(rng)
-    for i in rng:
-        idx = i*batch_size
-        x = X[idx:idx+batch_size]
-        x = x.to(device)
-        _ = model(x)
-        if type(cell_idx) == type(int()):
-            fx = hook_outs[layer][:,cell_idx]
-        elif len(cell_idx) == 1:
-            fx = hook_outs[layer][:,cell_idx[0]]
-        else:
-            fx = hook_outs[layer][:, cell_idx[0], cell_idx[1], cell_idx[2]]
-        fx = fx.mean()
-        fx.backward()
-    hook_handle.remove()
-    requires_grad(model, True)
-    return X.grad.data.cpu().numpy()
+        print("layer:", layer)
+    jacs, _ = stim_jacobian(model, X, layer, [cell_idx], chunk_size=batch_size, verbose=verbose)
+    return jacs[0]
 
 def compute_sta(model, contrast, layer, cell_index, layer_shape=None, verbose=True):
     """
@@ -534,6 +801,67 @@ def compute_sta_rnn(model, contrast, layer, cell_index, layer_shape=None, verbos
     del X
     return sta
 
+def batch_revcorr(stimulus, responses, nsamples_before, nsamples_after=0, zscore=False, method='gemm',
+                                                                                    chunk_size=128):
+    """
+    Reverse correlation of a stimulus with many responses at once. Gives the same
+    result as pyret.filtertools.revcorr(stimulus, responses[:,k], nsamples_before,
+    nsamples_after) for each unit k, but passes over the stimulus only once.
+
+    stimulus - ndarray (T, ...)
+    responses - ndarray (T,) or (T, K)
+    nsamples_before - int
+    nsamples_after - int
+        see pyret.filtertools.revcorr. The filter length is their sum
+    zscore - bool
+        if true, each response is z-scored (scipy.stats.zscore) before correlating
+    method - str
+        'gemm' computes each lag of the filter as a single matrix product.
+        'fft' computes all lags at once as FFT cross-correlations, which is
+        faster for long filters
+    chunk_size - int
+        number of stimulus pixels transformed at a time when method is 'fft'
+
+    returns:
+        rcs - ndarray (K, nsamples_before+nsamples_after, ...)
+            (nsamples_before+nsamples_after, ...) if responses is 1 dimensional
+        lags - ndarray (nsamples_before+nsamples_after,)
+    """
+    history = nsamples_before + nsamples_after
+    stimulus = np.asarray(stimulus)
+    responses = np.asarray(responses)
+    if len(responses) != len(stimulus):
+        raise ValueError('`stimulus` and `responses` must match in size along the first axis')
+    squeeze = responses.ndim == 1
+    if squeeze:
+        responses = responses[:,None]
+    if zscore:
+        responses = scipy.stats.zscore(responses, axis=0)
+    flat = stimulus.reshape(len(stimulus), -1)
+    n_windows = len(stimulus) - history + 1
+    # The response at the last frame of each window
+    resps = responses[history-1:]
+
+    if method == 'gemm':
+        rcs = np.stack([resps.T @ flat[i:i+n_windows] for i in range(history)], axis=1)
+    elif method == 'fft':
+        # Windows never wrap around, so no padding beyond the stimulus length is needed
+        n_fft = 2**int(np.ceil(np.log2(len(stimulus))))
+        fresps = np.conj(np.fft.rfft(resps, n=n_fft, axis=0))
+        rcs = np.empty((resps.shape[1], history, flat.shape[1]), dtype=np.result_type(flat, resps))
+        for i in range(0, flat.shape[1], chunk_size):
+            fstim = np.fft.rfft(flat[:,i:i+chunk_size], n=n_fft, axis=0)
+            corrs = np.fft.irfft(fstim[:,None]*fresps[:,:,None], n=n_fft, axis=0)[:history]
+            rcs[:,:,i:i+chunk_size] = corrs.transpose(1,0,2)
+    else:
+        raise ValueError("method must be 'gemm' or 'fft'")
+
+    rcs = rcs.reshape(len(rcs), history, *stimulus.shape[1:])
+    lags = np.arange(-nsamples_before + 1, nsamples_after + 1)
+    if squeeze:
+        return rcs[0], lags
+    return rcs, lags
+
 def revcor_sta(model, layers=['sequential.0','sequential.6'], chans=[8,8], verbose=True, device=torch.device('cuda:1')):
     """
     Computes the sta using reverse correlation. Uses the central unit for computation
@@ -558,18 +886,13 @@ def revcor_sta(model, layers=['sequential.0','sequential.6'], chans=[8,8], verbo
         resp = response[layer]
         if len(resp.shape) == 2:
             if layer == "sequential.2":
-                resp = resp.reshape(len(resp), len(chan), *model.shapes[0])
+                resp = resp.reshape(len(resp), chan, *model.shapes[0])
             else:
-                resp = resp.reshape(len(resp), len(chan), *model.shapes[1])
+                resp = resp.reshape(len(resp), chan, *model.shapes[1])
         centers = np.array(resp.shape[2:])//2
-        for c in range(chan):
-            if len(centers) == 2:
-                sta,_ = ft.revcorr(noise, scipy.stats.zscore(resp[:, c, centers[0], centers[1]]),
-                                                             0, filter_size)
-            if len(centers) == 3:
-                sta,_ = ft.revcorr(noise, scipy.stats.zscore(resp[:, c, centers[0], centers[1], centers[2]]),
-                                                             0, filter_size)
-            stas[layer].append(sta)
+        resp = resp[(slice(None), slice(None), *centers)]
+        rcs,_ = batch_revcorr(noise, resp[:, :chan], 0, filter_size, zscore=True)
+        stas[layer] = list(rcs)
     return stas
 
 def revcor_sta_rnn(model, layers, device, I20=None):
@@ -595,14 +918,9 @@ def revcor_sta_rnn(model, layers, device, I20=None):
             else:
                 resp = resp.reshape(len(resp), chan, *model.shapes[1])
         centers = np.array(resp.shape[2:])//2
-        for c in range(chan):
-            if len(centers) == 2:
-                sta,_ = ft.revcorr(noise, scipy.stats.zscore(resp[:, c, centers[0], centers[1]]),
-                                                             0, filter_size)
-            if len(centers) == 3:
-                sta,_ = ft.revcorr(noise, scipy.stats.zscore(resp[:, c, centers[0], centers[1], centers[2]]),
-                                                             0, filter_size)
-            stas[layer].append(sta)
+        resp = resp[(slice(None), slice(None), *centers)]
+        rcs,_ = batch_revcorr(noise, resp[:, :chan], 0, filter_size, zscore=True)
+        stas[layer] = list(rcs)
     return stas
 
 def revcor_sta_ganglion(model, layers=['ganglion.0'], n_units=5,  verbose=True, device=torch.device('cuda:1')):
@@ -626,10 +944,8 @@ def revcor_sta_ganglion(model, layers=['ganglion.0'], n_units=5,  verbose=True,
     response = inspect(model, X, insp_keys=set(layers), batch_size=500, to_numpy=True, device=device)
     stas = {layer:[] for layer in layers}
     for layer in layers:
-        for cell in range(n_units):
-            resp = response[layer]
-            sta,_ = ft.revcorr(noise, scipy.stats.zscore(resp[:, cell]), 0, filter_size)
-            stas[layer].append(sta)
+        rcs,_ = batch_revcorr(noise, response[layer][:, :n_units], 0, filter_size, zscore=True)
+        stas[layer] = list(rcs)
     return stas
 
 def freeze_weights(model, unfreeze=False):